@@ -0,0 +1,423 @@
+"""Audio I/O backends for the client.
+
+A backend opens input and output streams that call sounddevice-style callbacks:
+`callback(indata, frames, time, status)` and `callback(outdata, frames, time, status)` with int16
+arrays of shape (frames, channels). SoundDeviceBackend uses the sound card; NullBackend and
+WavBackend need no hardware and drive the callbacks from a clock thread, in real time or faster,
+so calls can run on headless machines and the whole pipeline can be benchmarked.
+
+Streams take a sounddevice-style `latency` hint ('low', 'high' or seconds) and report the
+latency they actually got in their `latency` attribute, in seconds.
+
+SoundDeviceBackend also caches the device list, and keeps sound card streams open ("warm") for a
+while after a call closes them, so that reconnecting or switching rooms with the same settings
+reuses the open stream instead of opening a new one. Only the output keeps running in between;
+the microphone stream is stopped as soon as the call lets go of it.
+"""
+import threading
+import time
+import wave
+
+import numpy as np
+
+DEFAULT_SAMPLE_RATE = 48000
+BACKENDS = ('sounddevice', 'null', 'wav')
+WARM_STREAM_LINGER = 60.0  # seconds an unused sound card stream stays open for the next call
+
+
+class StreamStatus:
+    """Callback flags of the clock-driven backends; mirrors sounddevice.CallbackFlags."""
+
+    def __init__(self, input_overflow=False, output_underflow=False):
+        self.input_overflow = input_overflow
+        self.output_underflow = output_underflow
+
+
+class SoundDeviceBackend:
+    """The sound card through sounddevice/PortAudio, imported only when this backend is used.
+
+    Device queries are cached until refresh(). Streams are WarmStreams: after close() the
+    PortAudio stream stays open for `linger` seconds (0 closes it at once), and a new stream
+    with the same settings takes it over. An idle output keeps playing silence; an idle input is
+    stopped, so the microphone is not captured between calls. At most one idle stream per
+    direction is kept; use one backend instance for all calls of a process and close() it on exit.
+    """
+    name = 'sounddevice'
+
+    def __init__(self, linger=WARM_STREAM_LINGER):
+        import sounddevice
+        self.sd = sounddevice
+        self.linger = linger
+        self.lock = threading.Lock()
+        self.idle = {True: None, False: None}  # is_input -> WarmStream waiting for the next call
+        self.streams = set()  # every WarmStream not shut down yet
+        self._devices = None
+        self._info = {}
+
+    def devices(self):
+        """All devices as dicts (name, channels, default sample rate and latencies), index = device id."""
+        if self._devices is None:
+            self._devices = [dict(d) for d in self.sd.query_devices()]
+        return self._devices
+
+    def device_info(self, device, is_input=True):
+        key = (device, is_input)
+        info = self._info.get(key)
+        if info is None:
+            info = self._info[key] = dict(self.sd.query_devices(device, 'input' if is_input else 'output'))
+        return info
+
+    def device_sample_rate(self, device, is_input=True):
+        try:
+            return int(self.device_info(device, is_input).get('default_samplerate') or DEFAULT_SAMPLE_RATE)
+        except Exception:
+            return DEFAULT_SAMPLE_RATE
+
+    def refresh(self):
+        """Re-scan the devices, e.g. after one was plugged in or removed.
+
+        PortAudio only sees the change after it is re-initialised, which invalidates every stream,
+        so this closes the idle ones and returns False without doing anything while a call uses one.
+        """
+        with self.lock:
+            if any(s.in_use for s in self.streams):
+                return False
+            self._close_idle()
+            self._reinitialize()
+            self._devices = None
+            self._info = {}
+        return True
+
+    def _reinitialize(self):
+        # sounddevice has no public call for this; its private _terminate/_initialize pair is the
+        # workaround its documentation gives. Without them the devices are only queried again.
+        terminate = getattr(self.sd, '_terminate', None)
+        initialize = getattr(self.sd, '_initialize', None)
+        if terminate is not None and initialize is not None:
+            terminate()
+            initialize()
+
+    def close(self):
+        """Close the idle streams now instead of after the linger time."""
+        with self.lock:
+            self._close_idle()
+
+    def input_stream(self, sample_rate, channels, dtype, blocksize, device, callback, latency=None):
+        return self._acquire(True, (sample_rate, channels, dtype, blocksize, device, latency), callback)
+
+    def output_stream(self, sample_rate, channels, dtype, blocksize, device, callback, latency=None):
+        return self._acquire(False, (sample_rate, channels, dtype, blocksize, device, latency), callback)
+
+    def _acquire(self, is_input, settings, callback):
+        with self.lock:
+            stream = self.idle[is_input]
+            self.idle[is_input] = None
+            if stream is not None and stream.settings != settings:
+                stream.shutdown()  # the device may not allow a second stream next to it
+                stream = None
+        if stream is None:
+            stream = WarmStream(self, is_input, settings)
+        stream.acquire(callback)
+        return stream
+
+    def _release(self, stream):
+        with self.lock:
+            previous = self.idle[stream.is_input]
+            if previous is not None and previous is not stream:
+                previous.shutdown()
+            self.idle[stream.is_input] = stream
+            if self.linger > 0:
+                stream.expire_after(self.linger)
+            else:
+                self._close_idle()
+
+    def _expire(self, stream):
+        with self.lock:
+            if self.idle[stream.is_input] is stream and not stream.in_use:
+                self.idle[stream.is_input] = None
+                stream.shutdown()
+
+    def _close_idle(self):
+        for is_input, stream in self.idle.items():
+            if stream is not None:
+                stream.shutdown()
+                self.idle[is_input] = None
+
+
+class WarmStream:
+    """A sounddevice stream that outlives the call using it.
+
+    The PortAudio callback dispatches to the callback of the current call. start() attaches it
+    (starting the PortAudio stream if it is not running), stop() detaches it: an output stream
+    keeps running and plays silence, an input stream is stopped. close() hands the stream back to
+    the backend, which closes it once it has been idle for the linger time.
+    """
+    def __init__(self, backend, is_input, settings):
+        self.backend = backend
+        self.is_input = is_input
+        self.settings = settings
+        self.callback = None
+        self.pending = None
+        self.in_use = False
+        self.timer = None
+        sample_rate, channels, dtype, blocksize, device, latency = settings
+        cls = backend.sd.InputStream if is_input else backend.sd.OutputStream
+        self.stream = cls(samplerate=sample_rate, channels=channels, dtype=dtype, blocksize=blocksize,
+                          device=device, callback=self._dispatch, latency=latency)
+        backend.streams.add(self)
+
+    @property
+    def latency(self):
+        return self.stream.latency
+
+    def _dispatch(self, data, frames, time_info, status):
+        callback = self.callback
+        if callback is None:
+            if not self.is_input:
+                data.fill(0)
+            return
+        callback(data, frames, time_info, status)
+
+    def acquire(self, callback):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        self.pending = callback
+        self.in_use = True
+
+    def start(self):
+        self.callback = self.pending
+        if not self.stream.active:
+            self.stream.start()
+
+    def stop(self):
+        self.callback = None
+        if self.is_input and self.stream.active:
+            try:
+                self.stream.stop()
+            except Exception:
+                pass  # already gone, e.g. the device was unplugged
+
+    def close(self):
+        if not self.in_use:
+            return
+        self.stop()
+        self.pending = None
+        self.in_use = False
+        self.backend._release(self)
+
+    def expire_after(self, seconds):
+        self.timer = threading.Timer(seconds, self.backend._expire, (self,))
+        self.timer.daemon = True
+        self.timer.start()
+
+    def shutdown(self):
+        """Really close the PortAudio stream."""
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        self.backend.streams.discard(self)
+        try:
+            self.stream.stop()
+            self.stream.close()
+        except Exception:
+            pass  # already gone, e.g. the device was unplugged
+
+
+class ClockedStream:
+    """Stream of a clock-driven backend; start/stop/close like a sounddevice stream.
+
+    There is no device buffer behind it, so its latency is zero whatever was asked for.
+    """
+    latency = 0.0
+
+    def __init__(self, backend, is_input, sample_rate, channels, dtype, blocksize, callback):
+        self.backend = backend
+        self.is_input = is_input
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.dtype = dtype
+        self.blocksize = blocksize
+        self.callback = callback
+        self.active = False
+
+    def start(self):
+        self.backend._start(self)
+
+    def stop(self):
+        self.backend._stop(self)
+
+    def close(self):
+        self.backend._stop(self)
+        self.backend._close(self)
+
+
+class ClockedBackend:
+    """Base of the hardware-free backends.
+
+    One clock thread serves all open streams in lockstep, like a duplex sound card: per block it
+    fills every output stream, hands the block to `sink()`, then feeds every input stream from
+    `source()`. `speed` 1.0 paces blocks in real time, 4.0 runs four times faster and 0 as fast as
+    the callbacks allow. In real time, blocks that start more than one block late are flagged as
+    output underflow/input overflow, as a sound card would. Streams must share one block size.
+    """
+
+    def __init__(self, sample_rate=DEFAULT_SAMPLE_RATE, speed=1.0):
+        self.sample_rate = sample_rate
+        self.speed = speed
+        self.streams = ()
+        self.lock = threading.Lock()
+        self.thread = None
+        self.blocks = 0  # blocks clocked since the first stream started
+        self.late_blocks = 0
+
+    def device_sample_rate(self, device, is_input=True):
+        return self.sample_rate
+
+    def input_stream(self, sample_rate, channels, dtype, blocksize, device, callback, latency=None):
+        return ClockedStream(self, True, sample_rate, channels, dtype, blocksize, callback)
+
+    def output_stream(self, sample_rate, channels, dtype, blocksize, device, callback, latency=None):
+        return ClockedStream(self, False, sample_rate, channels, dtype, blocksize, callback)
+
+    def source(self, stream, frames):
+        """Next input block of shape (frames, channels)."""
+        return np.zeros((frames, stream.channels), dtype=stream.dtype)
+
+    def sink(self, stream, block):
+        """Consume an output block the callback has filled."""
+
+    def _close(self, stream):
+        pass
+
+    def _start(self, stream):
+        with self.lock:
+            if stream.active:
+                return
+            stream.active = True
+            self.streams = self.streams + (stream,)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name=f'{type(self).__name__} clock', daemon=True)
+                self.thread.start()
+
+    def _stop(self, stream):
+        with self.lock:
+            if not stream.active:
+                return
+            stream.active = False
+            self.streams = tuple(s for s in self.streams if s is not stream)
+            thread = self.thread if not self.streams else None
+            if thread is not None:
+                self.thread = None
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+
+    def _run(self):
+        me = threading.current_thread()
+        start = time.monotonic()
+        ticks = 0
+        late = False
+        while self.thread is me:
+            streams = self.streams
+            if not streams:
+                break
+            frames = streams[0].blocksize
+            status = StreamStatus(input_overflow=late, output_underflow=late)
+            for stream in streams:
+                if not stream.is_input:
+                    outdata = np.zeros((frames, stream.channels), dtype=stream.dtype)
+                    stream.callback(outdata, frames, None, status)
+                    self.sink(stream, outdata)
+            for stream in streams:
+                if stream.is_input:
+                    stream.callback(self.source(stream, frames), frames, None, status)
+            ticks += 1
+            self.blocks += 1
+            late = False
+            if self.speed > 0:
+                delay = start + ticks * frames / (streams[0].sample_rate * self.speed) - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                elif self.speed == 1.0 and -delay > frames / streams[0].sample_rate:
+                    late = True
+                    self.late_blocks += 1
+
+
+class NullBackend(ClockedBackend):
+    """Silent microphone, discarded speaker output."""
+    name = 'null'
+
+
+class WavBackend(ClockedBackend):
+    """Reads the microphone from a WAV file and records the speaker output to another.
+
+    The input file must be 16-bit PCM; extra channels are averaged to mono and it loops when
+    `loop` is set, otherwise silence follows its end. Its sample rate is reported as the device
+    rate so the call runs at the file's rate. Without `input_path` the microphone is silent;
+    without `output_path` the output is discarded.
+    """
+    name = 'wav'
+
+    def __init__(self, input_path=None, output_path=None, speed=1.0, loop=True, sample_rate=DEFAULT_SAMPLE_RATE):
+        super().__init__(sample_rate, speed)
+        self.output_path = output_path
+        self.loop = loop
+        self.samples = None
+        self.position = 0
+        self.writer = None
+        if input_path is not None:
+            self.samples, self.sample_rate = read_wav(input_path)
+
+    def source(self, stream, frames):
+        block = np.zeros((frames, stream.channels), dtype=stream.dtype)
+        if self.samples is None or not self.samples.size:
+            return block
+        filled = 0
+        while filled < frames:
+            if self.position >= self.samples.size:
+                if not self.loop:
+                    break
+                self.position = 0
+            n = min(frames - filled, self.samples.size - self.position)
+            block[filled:filled + n, :] = self.samples[self.position:self.position + n, None]
+            self.position += n
+            filled += n
+        return block
+
+    def sink(self, stream, block):
+        if self.output_path is None:
+            return
+        if self.writer is None:
+            self.writer = wave.open(self.output_path, 'wb')
+            self.writer.setnchannels(stream.channels)
+            self.writer.setsampwidth(2)
+            self.writer.setframerate(stream.sample_rate)
+        self.writer.writeframes(np.ascontiguousarray(block, dtype='<i2').tobytes())
+
+    def _close(self, stream):
+        if not stream.is_input and self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+
+def read_wav(path):
+    """Return (int16 mono samples, sample rate) of a 16-bit PCM WAV file."""
+    with wave.open(path, 'rb') as f:
+        if f.getsampwidth() != 2:
+            raise ValueError(f'{path}: only 16-bit PCM WAV files are supported')
+        channels = f.getnchannels()
+        rate = f.getframerate()
+        data = np.frombuffer(f.readframes(f.getnframes()), dtype='<i2')
+    if channels > 1:
+        data = data.reshape(-1, channels).mean(axis=1)
+    return data.astype(np.int16), rate
+
+
+def create_backend(name='sounddevice', input_wav=None, output_wav=None, speed=1.0):
+    if name == 'sounddevice':
+        return SoundDeviceBackend()
+    if name == 'null':
+        return NullBackend(speed=speed)
+    if name == 'wav':
+        return WavBackend(input_wav, output_wav, speed=speed)
+    raise ValueError(f'unknown audio backend: {name}')
@@ -0,0 +1,299 @@
+"""Microbenchmarks for the client's realtime audio path.
+
+Runs the same functions the audio callbacks and the media transport run (input callback with
+metering, VAD, sample-rate conversion, codec encode/decode, jitter buffer, loss protection, mixer
+output callback, packet serialize/parse)
+on synthetic buffers, without opening an audio device. For each block size it reports the CPU time
+per block and the share of the block's real-time budget it uses.
+
+    python bench_audio.py --frame-ms 10 20 --legs 1 4 8 --output bench-audio.json
+"""
+import argparse
+import json
+import math
+import platform
+import time
+
+import numpy as np
+
+import client
+from resample import Resampler
+
+DEFAULT_ITERATIONS = 2000
+RESAMPLE_PAIRS = ((44100, 48000), (48000, 44100), (48000, 16000), (16000, 48000))  # device rate <-> media rate
+WARMUP = 50  # untimed calls before measuring, to fill caches and lazy allocations
+
+
+def synthetic_block(frame_size, seed=0):
+    """Speech-like test signal: a few harmonics plus noise, int16 mono."""
+    rng = np.random.default_rng(seed)
+    t = np.arange(frame_size) / client.DEFAULT_SAMPLE_RATE
+    signal = sum(np.sin(2 * np.pi * f * t) / (i + 1) for i, f in enumerate((180, 360, 720, 1440)))
+    signal = 6000 * signal + rng.normal(0, 300, frame_size)
+    return np.clip(signal, -32768, 32767).astype(np.int16)
+
+
+def measure(fn, iterations, setup=None):
+    """Time `fn()` per call; `setup()` runs untimed before each call. Returns per-call seconds."""
+    for _ in range(WARMUP):
+        if setup is not None:
+            setup()
+        fn()
+    times = []
+    perf = time.perf_counter
+    for _ in range(iterations):
+        if setup is not None:
+            setup()
+        start = perf()
+        fn()
+        times.append(perf() - start)
+    return times
+
+
+def report(name, times, budget, **params):
+    times = sorted(times)
+    mean = sum(times) / len(times)
+    p99 = times[min(len(times) - 1, math.ceil(len(times) * 0.99) - 1)]
+    return {
+        'name': name,
+        **params,
+        'mean_us': mean * 1e6,
+        'p99_us': p99 * 1e6,
+        'max_us': times[-1] * 1e6,
+        'budget_us': budget * 1e6,
+        'mean_budget_pct': 100 * mean / budget,
+        'p99_budget_pct': 100 * p99 / budget,
+    }
+
+
+class FakeStatus:
+    """Stands in for sounddevice.CallbackFlags."""
+    input_overflow = False
+    output_underflow = False
+
+
+def bench_input_callback(sample_rate, frame_size, iterations):
+    """What the input stream callback does per block: meter, copy into the send ring."""
+    indata = synthetic_block(frame_size).reshape(-1, 1)
+    send_ring = client.SendRing(frame_size)
+    meter = client.LevelMeter(frame_size)
+
+    def run():
+        client.audio_input_callback(indata, frame_size, None, FakeStatus, send_ring, meter)
+        send_ring.peek()
+        send_ring.release()
+
+    return measure(run, iterations)
+
+
+def bench_meter(sample_rate, frame_size, iterations):
+    """LevelMeter.update on one block; a UI reads it far less often than blocks arrive."""
+    block = synthetic_block(frame_size)
+    meter = client.LevelMeter(frame_size)
+    return measure(lambda: meter.update(block), iterations)
+
+
+def bench_vad(sample_rate, frame_size, spectral, iterations):
+    vad = client.VoiceActivityDetector(sample_rate, frame_size, spectral=spectral)
+    pcm = synthetic_block(frame_size)
+    return measure(lambda: vad.is_speech(pcm), iterations)
+
+
+def bench_encode(codec_name, sample_rate, frame_size, iterations):
+    codec = client.create_codec(codec_name, sample_rate, frame_size)
+    pcm = synthetic_block(frame_size)
+    return measure(lambda: codec.encode(pcm), iterations)
+
+
+def bench_decode(codec_name, sample_rate, frame_size, iterations):
+    payload = bytes(client.create_codec(codec_name, sample_rate, frame_size).encode(synthetic_block(frame_size)))
+    codec = client.create_codec(codec_name, sample_rate, frame_size)
+    return measure(lambda: codec.decode(payload), iterations)
+
+
+def bench_packet(codec_name, sample_rate, frame_size, iterations):
+    """Serialize one media packet into the sender's preallocated buffer and parse it back."""
+    payload = bytes(client.create_codec(codec_name, sample_rate, frame_size).encode(synthetic_block(frame_size)))
+    buf = bytearray(client.MAX_PACKET_SIZE)
+    view = memoryview(buf)
+    state = {'seq': 0}
+
+    def run():
+        seq = state['seq'] = (state['seq'] + 1) & 0xFFFF
+        size = client.write_packet(buf, client.PT_PCM, seq, seq * frame_size, 1234, payload)
+        client.parse_packet(bytes(view[:size]))
+
+    return measure(run, iterations)
+
+
+def bench_jitter(codec_name, sample_rate, frame_size, iterations):
+    """One put() from the receive thread and one pop() from the output callback."""
+    payload = bytes(client.create_codec(codec_name, sample_rate, frame_size).encode(synthetic_block(frame_size)))
+    jitter = client.JitterBuffer(sample_rate, frame_size)
+    state = {'seq': 0, 'arrival': 0.0}
+    frame_duration = frame_size / sample_rate
+
+    def run():
+        seq = state['seq'] = (state['seq'] + 1) & 0xFFFF
+        state['arrival'] += frame_duration
+        jitter.put(seq, seq * frame_size, payload, state['arrival'])
+        jitter.pop()
+
+    return measure(run, iterations)
+
+
+def bench_fec_encode(codec_name, sample_rate, frame_size, iterations):
+    """Sender side of loss protection: a packet with one redundant payload, folded into XOR parity."""
+    encoder = client.PacketEncoder(client.create_codec(codec_name, sample_rate, frame_size), history=1)
+    payload = bytes(encoder.codec.encode(synthetic_block(frame_size)))
+    state = {'seq': 0}
+
+    def run():
+        seq = state['seq'] = (state['seq'] + 1) & 0xFFFF
+        encoder.write(seq, seq * frame_size, 1234, payload, redundancy=1)
+        encoder.add_parity(seq, payload)
+        if encoder.parity_count >= 3:
+            encoder.write_parity(seq * frame_size, 1234)
+
+    return measure(run, iterations)
+
+
+def bench_fec_recover(codec_name, sample_rate, frame_size, iterations, group=3):
+    """Receiver side: rebuild one lost packet of a parity group from the others."""
+    encoder = client.PacketEncoder(client.create_codec(codec_name, sample_rate, frame_size))
+    payloads = [bytes(encoder.codec.encode(synthetic_block(frame_size, i))) for i in range(group)]
+    for seq, payload in enumerate(payloads):
+        encoder.add_parity(seq, payload)
+    size = encoder.write_parity(0, 1234)
+    start = client.RELAY_HEADER.size + client.MEDIA_HEADER.size
+    count, payload_type, length_xor = client.FEC_HEADER.unpack_from(encoder.parity_packet, start)
+    parity = bytes(encoder.parity_packet[start + client.FEC_HEADER.size:client.RELAY_HEADER.size + size])
+    jitter = client.JitterBuffer(sample_rate, frame_size)
+    state = {'base': 0}
+
+    def setup():
+        # A fresh group with its middle packet missing
+        base = state['base'] = (state['base'] + group) & 0xFFFF
+        for i in (0, 2):
+            jitter.put((base + i) & 0xFFFF, 0, payloads[i], 0.0)
+        while jitter.count:
+            jitter.pop()
+        jitter.next_seq = base
+
+    return measure(lambda: jitter.recover_parity(state['base'], count, payload_type, length_xor, parity),
+                   iterations, setup=setup)
+
+
+def bench_resample(in_rate, out_rate, frame_ms, iterations):
+    """Convert one block of `frame_ms` between a device rate and the media rate."""
+    resampler = Resampler(in_rate, out_rate)
+    block = synthetic_block(client.frame_samples(in_rate, frame_ms))
+    return measure(lambda: resampler.process(block), iterations)
+
+
+def make_mesh(codec_name, sample_rate, frame_size, legs):
+    mesh = client.PeerMesh('bench', [codec_name], sample_rate, frame_size, client.DEFAULT_BITRATE,
+                           client.DEFAULT_COMPLEXITY)
+    mesh.update([{'id': f'peer{i}', 'ip': '127.0.0.1', 'udp_port': 10000 + i, 'codecs': [codec_name],
+                  'ssrc': 1000 + i} for i in range(legs)])
+    return mesh
+
+
+def bench_output_callback(codec_name, sample_rate, frame_size, legs, iterations):
+    """Mixer.write with `legs` active peers: jitter pop, decode, int32 mix, saturate and meter."""
+    mesh = make_mesh(codec_name, sample_rate, frame_size, legs)
+    payloads = [bytes(client.create_codec(codec_name, sample_rate, frame_size).encode(synthetic_block(frame_size, i)))
+                for i in range(legs)]
+    mixer = client.Mixer(mesh, frame_size, client.LevelMeter(frame_size))
+    outdata = np.zeros((frame_size, client.CHANNELS), dtype=np.int16)
+    state = {'seq': 0, 'arrival': 0.0}
+    frame_duration = frame_size / sample_rate
+
+    def feed():
+        # Keep every jitter buffer at a steady depth, as a clean network would
+        seq = state['seq'] = (state['seq'] + 1) & 0xFFFF
+        state['arrival'] += frame_duration
+        for leg, payload in zip(mesh.legs, payloads):
+            leg.jitter.put(seq, seq * frame_size, payload, state['arrival'])
+
+    return measure(lambda: mixer.write(outdata), iterations, setup=feed)
+
+
+def run_suite(args):
+    codecs = [name for name in client.available_codecs(args.sample_rate, client.DEFAULT_FRAME_MS)
+              if name in args.codecs]
+    results = []
+    for frame_ms in args.frame_ms:
+        frame_size = client.frame_samples(args.sample_rate, frame_ms)
+        budget = frame_size / args.sample_rate
+        params = {'frame_ms': frame_ms, 'frame_size': frame_size}
+        n = args.iterations
+
+        results.append(report('input_callback', bench_input_callback(args.sample_rate, frame_size, n), budget,
+                              **params))
+        results.append(report('meter', bench_meter(args.sample_rate, frame_size, n), budget, **params))
+        results.append(report('vad_energy', bench_vad(args.sample_rate, frame_size, False, n), budget, **params))
+        results.append(report('vad_spectral', bench_vad(args.sample_rate, frame_size, True, n), budget, **params))
+        for in_rate, out_rate in RESAMPLE_PAIRS:
+            results.append(report('resample', bench_resample(in_rate, out_rate, frame_ms, n), budget, **params,
+                                  rates=f'{in_rate}>{out_rate}'))
+        for codec_name in codecs:
+            if codec_name == 'opus' and frame_ms not in client.OPUS_FRAME_MS:
+                continue
+            cp = {**params, 'codec': codec_name}
+            results.append(report('encode', bench_encode(codec_name, args.sample_rate, frame_size, n), budget, **cp))
+            results.append(report('decode', bench_decode(codec_name, args.sample_rate, frame_size, n), budget, **cp))
+            results.append(report('packet', bench_packet(codec_name, args.sample_rate, frame_size, n), budget, **cp))
+            results.append(report('jitter_buffer', bench_jitter(codec_name, args.sample_rate, frame_size, n),
+                                  budget, **cp))
+            results.append(report('fec_encode', bench_fec_encode(codec_name, args.sample_rate, frame_size, n),
+                                  budget, **cp))
+            results.append(report('fec_recover', bench_fec_recover(codec_name, args.sample_rate, frame_size, n),
+                                  budget, **cp))
+            for legs in args.legs:
+                results.append(report('output_callback',
+                                       bench_output_callback(codec_name, args.sample_rate, frame_size, legs, n),
+                                       budget, **cp, legs=legs))
+    return results
+
+
+def print_table(results):
+    print(f"{'benchmark':<16} {'frame':>6} {'codec/rates':>11} {'legs':>4} {'mean us':>9} {'p99 us':>9} "
+          f"{'budget us':>10} {'mean %':>7} {'p99 %':>7}")
+    for r in results:
+        print(f"{r['name']:<16} {r['frame_ms']:>6g} {r.get('codec', r.get('rates', '-')):>11} {r.get('legs', '-'):>4} "
+              f"{r['mean_us']:>9.1f} {r['p99_us']:>9.1f} {r['budget_us']:>10.0f} "
+              f"{r['mean_budget_pct']:>7.2f} {r['p99_budget_pct']:>7.2f}")
+
+
+def main():
+    p = argparse.ArgumentParser(description='Benchmark the client audio hot path on synthetic buffers')
+    p.add_argument('--sample-rate', type=int, default=client.DEFAULT_SAMPLE_RATE)
+    # The --low-latency frame is included so that 5 ms blocks at 44.1 kHz, the worst case for the resampler, are covered
+    p.add_argument('--frame-ms', type=float, nargs='+', default=[client.LOW_LATENCY_FRAME_MS, 10, 20, 40],
+                   help='Block durations to test')
+    p.add_argument('--codecs', nargs='+', choices=client.CODEC_PREFERENCE, default=list(client.CODEC_PREFERENCE))
+    p.add_argument('--legs', type=int, nargs='+', default=[1, 4, 8], help='Peer counts for the mixer benchmark')
+    p.add_argument('--iterations', type=int, default=DEFAULT_ITERATIONS, help='Timed calls per benchmark')
+    p.add_argument('--output', default=None, help='Write results as JSON to this file')
+    args = p.parse_args()
+
+    results = run_suite(args)
+    print_table(results)
+    if args.output:
+        report_doc = {
+            'benchmark': 'audio',
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'platform': platform.platform(),
+            'config': vars(args),
+            'results': results,
+        }
+        with open(args.output, 'w') as f:
+            json.dump(report_doc, f, indent=2)
+        print(f'Results written to {args.output}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,353 @@
+"""Load generator for the rendezvous server.
+
+Starts server.py in a child process through `create_server_runner` (or targets a running server
+with --server) and drives it with simulated websocket clients speaking the real register/list/chat
+protocol, without any audio. Reports registration-to-peers latency, list latency, chat fan-out
+latency, server memory per connection and the highest sustainable join rate, and writes the
+results as JSON so runs of different versions can be compared.
+
+    python bench_server.py --clients 2000 --room-size 10 --output bench-server.json
+"""
+import argparse
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import subprocess
+import sys
+import time
+
+import aiohttp
+
+import server
+
+CONNECT_TIMEOUT = 10  # seconds to wait for a reply before a client counts as failed
+
+
+def percentile(values, q):
+    """Nearest-rank percentile of `values` (0 < q <= 100), or None for an empty list."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(1, -(-len(ordered) * q // 100))
+    return ordered[int(rank) - 1]
+
+
+def summarize(values):
+    """Latency summary in milliseconds."""
+    ms = [v * 1000 for v in values]
+    return {
+        'count': len(ms),
+        'p50_ms': percentile(ms, 50),
+        'p99_ms': percentile(ms, 99),
+        'max_ms': max(ms) if ms else None,
+    }
+
+
+def process_rss(pid):
+    """Resident set size of a process in bytes, or None where /proc is not available."""
+    try:
+        with open(f'/proc/{pid}/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return None
+
+
+def raise_fd_limit():
+    """Lift the soft open-files limit to the hard limit, since every client holds a socket."""
+    try:
+        import resource
+    except ImportError:  # Windows
+        return float('inf')
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+            soft = hard
+        except (ValueError, OSError):
+            pass
+    return soft
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_server(port, send_queue_size, policy, verbose, port_q):
+    """Child process: serve until terminated and report the bound port back to the parent."""
+    if not verbose:
+        logging.getLogger().setLevel(logging.WARNING)
+
+    async def serve():
+        runner = await server.create_server_runner(port, send_queue_size=send_queue_size,
+                                                   slow_consumer_policy=policy)
+        port_q.put(runner.addresses[0][1])
+        await asyncio.Event().wait()
+
+    raise_fd_limit()
+    asyncio.run(serve())
+
+
+class BenchClient:
+    """One simulated peer: a websocket plus the futures the benchmark waits on."""
+
+    def __init__(self, session, url, room, peer_id):
+        self.session = session
+        self.url = url
+        self.room = room
+        self.id = peer_id
+        self.ws = None
+        self.task = None
+        self.peers = None  # future resolved by the 'peers' reply
+        self.rooms = None  # future resolved by the 'rooms' reply
+        self.chat_latencies = []
+        self.error = None
+
+    async def join(self):
+        """Connect and register; returns the register-to-peers latency in seconds."""
+        loop = asyncio.get_running_loop()
+        self.ws = await asyncio.wait_for(self.session.ws_connect(self.url), CONNECT_TIMEOUT)
+        self.peers = loop.create_future()
+        self.task = asyncio.create_task(self._read_loop())
+        start = time.perf_counter()
+        await self.ws.send_json({'type': 'register', 'room': self.room, 'id': self.id, 'udp_port': 9,
+                                 'codecs': ['opus', 'pcm'], 'ssrc': hash((self.room, self.id)) & 0xFFFFFFFF})
+        await asyncio.wait_for(asyncio.shield(self.peers), CONNECT_TIMEOUT)
+        return time.perf_counter() - start
+
+    async def list_rooms(self):
+        self.rooms = asyncio.get_running_loop().create_future()
+        start = time.perf_counter()
+        await self.ws.send_json({'type': 'list'})
+        await asyncio.wait_for(asyncio.shield(self.rooms), CONNECT_TIMEOUT)
+        return time.perf_counter() - start
+
+    async def chat(self):
+        # Sender and receivers share this process, so the send time travels in the message itself
+        await self.ws.send_json({'type': 'chat', 'text': json.dumps({'sent': time.perf_counter()})})
+
+    async def close(self):
+        if self.ws is not None:
+            # Hang up like the real client, so the server frees the slot now instead of holding
+            # the session for its grace period
+            if not self.ws.closed:
+                try:
+                    await self.ws.send_json({'type': 'leave'})
+                except (ConnectionError, RuntimeError):
+                    pass
+            await self.ws.close()
+        if self.task is not None:
+            await asyncio.gather(self.task, return_exceptions=True)
+
+    async def _read_loop(self):
+        async for msg in self.ws:
+            if msg.type != aiohttp.WSMsgType.TEXT:
+                continue
+            data = json.loads(msg.data)
+            t = data.get('type')
+            if t == 'peers' and not self.peers.done():
+                self.peers.set_result(data['peers'])
+            elif t == 'rooms' and self.rooms is not None and not self.rooms.done():
+                self.rooms.set_result(data['rooms'])
+            elif t == 'chat':
+                self.chat_latencies.append(time.perf_counter() - json.loads(data['text'])['sent'])
+            elif t == 'error':
+                self.error = data.get('message')
+                if not self.peers.done():
+                    self.peers.set_exception(RuntimeError(self.error))
+
+
+async def join_clients(session, url, count, room_size, rate, prefix):
+    """Join `count` clients at `rate` joins/s; returns (clients, latencies, failures, elapsed)."""
+    clients = [BenchClient(session, url, f'{prefix}-room-{i // room_size}', f'{prefix}-{i}') for i in range(count)]
+    latencies = []
+    failures = 0
+
+    async def join_one(client):
+        nonlocal failures
+        try:
+            latencies.append(await client.join())
+        except (aiohttp.ClientError, asyncio.TimeoutError, RuntimeError, OSError):
+            failures += 1
+
+    start = time.perf_counter()
+    tasks = []
+    for i, client in enumerate(clients):
+        delay = start + i / rate - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        tasks.append(asyncio.create_task(join_one(client)))
+    await asyncio.gather(*tasks)
+    return clients, latencies, failures, time.perf_counter() - start
+
+
+async def close_clients(clients):
+    await asyncio.gather(*(c.close() for c in clients), return_exceptions=True)
+
+
+async def measure_chat(clients, rounds):
+    """Every room's first member sends `rounds` messages; returns fan-out latencies and delivery ratio."""
+    rooms = {}
+    for c in clients:
+        rooms.setdefault(c.room, []).append(c)
+        c.chat_latencies.clear()
+    senders = [members[0] for members in rooms.values()]
+    for _ in range(rounds):
+        await asyncio.gather(*(s.chat() for s in senders))
+        await asyncio.sleep(0.05)
+    expected = sum(len(members) - 1 for members in rooms.values()) * rounds
+    deadline = time.monotonic() + CONNECT_TIMEOUT
+    while sum(len(c.chat_latencies) for c in clients) < expected and time.monotonic() < deadline:
+        await asyncio.sleep(0.05)
+    latencies = [lat for c in clients for lat in c.chat_latencies]
+    return latencies, len(latencies) / expected if expected else None
+
+
+async def find_max_join_rate(session, url, args):
+    """Double the join rate until p99 registration latency exceeds the SLO or joins fail."""
+    steps = []
+    best = None
+    rate = args.ramp_start
+    while rate <= args.ramp_max:
+        count = max(args.room_size, int(rate * args.ramp_seconds))
+        clients, latencies, failures, elapsed = await join_clients(session, url, count, args.room_size, rate,
+                                                                   f'ramp{rate}')
+        step = {'rate': rate, 'clients': count, 'failures': failures,
+                'achieved_rate': len(latencies) / elapsed if elapsed else None, **summarize(latencies)}
+        steps.append(step)
+        await close_clients(clients)
+        ok = failures == 0 and step['p99_ms'] is not None and step['p99_ms'] <= args.latency_slo_ms
+        print(f"  {rate:>6} joins/s: p99 {step['p99_ms'] or 0:.1f} ms, {failures} failures -> "
+              f"{'ok' if ok else 'saturated'}")
+        if not ok:
+            break
+        best = rate
+        rate *= 2
+        await asyncio.sleep(0.5)  # let the server finish the leaves
+    return best, steps
+
+
+async def run_bench(args, url, server_pid):
+    connector = aiohttp.TCPConnector(limit=0)
+    results = {}
+    async with aiohttp.ClientSession(connector=connector) as session:
+        rss_before = process_rss(server_pid) if server_pid else None
+        print(f'Joining {args.clients} clients at {args.join_rate}/s in rooms of {args.room_size}...')
+        clients, latencies, failures, elapsed = await join_clients(session, url, args.clients, args.room_size,
+                                                                   args.join_rate, 'bench')
+        results['join'] = {'failures': failures, 'elapsed_s': elapsed, **summarize(latencies)}
+        await asyncio.sleep(0.5)
+        rss_after = process_rss(server_pid) if server_pid else None
+        connected = args.clients - failures
+        results['memory'] = {
+            'server_rss_before': rss_before,
+            'server_rss_after': rss_after,
+            'bytes_per_connection': (rss_after - rss_before) / connected
+            if rss_before is not None and rss_after is not None and connected else None,
+        }
+
+        live = [c for c in clients if c.ws is not None and not c.ws.closed]
+        sample = live[:args.list_samples]
+        list_latencies = await asyncio.gather(*(c.list_rooms() for c in sample), return_exceptions=True)
+        results['list'] = summarize([lat for lat in list_latencies if isinstance(lat, float)])
+
+        print(f'Chat fan-out: {args.chat_rounds} rounds from {len({c.room for c in live})} rooms...')
+        chat_latencies, delivered = await measure_chat(live, args.chat_rounds)
+        results['chat_fanout'] = {'delivered_ratio': delivered, **summarize(chat_latencies)}
+        await close_clients(clients)
+
+        if args.ramp_max:
+            print('Searching for the highest sustainable join rate...')
+            await asyncio.sleep(0.5)
+            best, steps = await find_max_join_rate(session, url, args)
+            results['max_join_rate'] = {'sustainable_joins_per_s': best, 'latency_slo_ms': args.latency_slo_ms,
+                                        'steps': steps}
+    return results
+
+
+def print_summary(results):
+    def line(name, s):
+        if s.get('count'):
+            print(f"{name:<22} n={s['count']:<6} p50 {s['p50_ms']:.2f} ms  p99 {s['p99_ms']:.2f} ms  "
+                  f"max {s['max_ms']:.2f} ms")
+        else:
+            print(f'{name:<22} no samples')
+
+    line('register -> peers', results['join'])
+    print(f"{'':<22} {results['join']['failures']} failures")
+    line('list -> rooms', results['list'])
+    line('chat fan-out', results['chat_fanout'])
+    if results['chat_fanout']['delivered_ratio'] is not None:
+        print(f"{'':<22} {results['chat_fanout']['delivered_ratio']:.1%} delivered")
+    per_conn = results['memory']['bytes_per_connection']
+    print(f"{'memory/connection':<22} {per_conn / 1024:.1f} KiB" if per_conn is not None
+          else f"{'memory/connection':<22} n/a")
+    if 'max_join_rate' in results:
+        print(f"{'max joins/s':<22} {results['max_join_rate']['sustainable_joins_per_s']}")
+
+
+def main():
+    p = argparse.ArgumentParser(description='Load test the rendezvous server')
+    p.add_argument('--server', default=None, help='ws URL of a running server; by default one is started')
+    p.add_argument('--port', type=int, default=0, help='Port for the started server (0 = any free port)')
+    p.add_argument('--clients', type=int, default=500, help='Simulated clients to join')
+    p.add_argument('--room-size', type=int, default=10, help='Clients per room')
+    p.add_argument('--join-rate', type=float, default=500, help='Joins per second in the main phase')
+    p.add_argument('--list-samples', type=int, default=100, help='Clients that send a list request')
+    p.add_argument('--chat-rounds', type=int, default=5, help='Chat messages sent by each room')
+    p.add_argument('--ramp-start', type=int, default=100, help='First join rate of the ramp, joins/s')
+    p.add_argument('--ramp-max', type=int, default=6400, help='Last join rate of the ramp; 0 skips the ramp')
+    p.add_argument('--ramp-seconds', type=float, default=2, help='Duration of each ramp step')
+    p.add_argument('--latency-slo-ms', type=float, default=250,
+                   help='p99 register latency a join rate must stay under to count as sustainable')
+    p.add_argument('--send-queue-size', type=int, default=server.SEND_QUEUE_SIZE)
+    p.add_argument('--slow-consumer-policy', choices=server.SLOW_CONSUMER_POLICIES, default='drop')
+    p.add_argument('--server-log', action='store_true', help='Keep the started server\'s INFO log')
+    p.add_argument('--output', default=None, help='Write results as JSON to this file')
+    args = p.parse_args()
+
+    fd_limit = raise_fd_limit()
+    if fd_limit < args.clients + 64:
+        print(f'Warning: open-files limit is {fd_limit}, lower than the number of clients', file=sys.stderr)
+
+    proc = None
+    if args.server:
+        url = args.server
+    else:
+        port_q = multiprocessing.Queue()
+        proc = multiprocessing.Process(target=run_server, daemon=True,
+                                       args=(args.port, args.send_queue_size, args.slow_consumer_policy,
+                                             args.server_log, port_q))
+        proc.start()
+        url = f'ws://127.0.0.1:{port_q.get(timeout=CONNECT_TIMEOUT)}/ws'
+    try:
+        results = asyncio.run(run_bench(args, url, proc.pid if proc else None))
+    finally:
+        if proc is not None:
+            proc.terminate()
+            proc.join(timeout=5)
+
+    print_summary(results)
+    if args.output:
+        report = {
+            'benchmark': 'server',
+            'revision': git_revision(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'config': vars(args),
+            'results': results,
+        }
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f'Results written to {args.output}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,144 @@
+"""Cold-start benchmark of the entry points.
+
+Starts each mode in a fresh interpreter, several times, and measures the wall time until it is
+usable: until the server accepts TCP connections, or until the process exits for modes that only
+import and parse arguments. One extra run per mode under `python -X importtime` lists which heavy
+modules (GUI toolkit, audio, numpy, aiohttp, codecs) that mode loads at all.
+
+    python bench_startup.py --repeat 10 --output bench-startup.json
+"""
+import argparse
+import json
+import os
+import platform
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_REPEAT = 5
+LISTEN_TIMEOUT = 30  # seconds a server mode may take to accept connections
+POLL_INTERVAL = 0.005
+HEAVY_MODULES = ('tkinter', 'sounddevice', 'numpy', 'aiohttp', 'opuslib')
+
+# mode -> (arguments after the interpreter, whether it serves on the port given by {port})
+MODES = {
+    'python': (['-c', 'pass'], False),  # bare interpreter, the floor for everything else
+    'server': (['server.py', '--port', '{port}'], True),
+    'gui-server': (['gui.py', '--server', '--port', '{port}'], True),  # the frozen EXE in server mode
+    'client': (['client.py', '--help'], False),  # CLI client up to argument parsing
+    'gui': (['-c', 'import gui'], False),  # GUI module without opening a window
+}
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def wait_listening(proc, port):
+    deadline = time.monotonic() + LISTEN_TIMEOUT
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f'exited with code {proc.returncode} before listening')
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=POLL_INTERVAL):
+                return
+        except OSError:
+            time.sleep(POLL_INTERVAL)
+    raise TimeoutError(f'not listening on port {port} after {LISTEN_TIMEOUT} s')
+
+
+def stop(proc):
+    proc.terminate()
+    try:
+        proc.wait(timeout=5)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        proc.wait()
+
+
+def start_once(mode, python_args=(), stderr=subprocess.DEVNULL):
+    """Run `mode` once; returns seconds from spawning the interpreter until it is usable."""
+    args, serves = MODES[mode]
+    port = free_port()
+    cmd = [sys.executable, *python_args, *(a.format(port=port) for a in args)]
+    start = time.perf_counter()
+    proc = subprocess.Popen(cmd, cwd=HERE, stdout=subprocess.DEVNULL, stderr=stderr)
+    try:
+        if serves:
+            wait_listening(proc, port)
+        else:
+            proc.wait()
+        return time.perf_counter() - start
+    finally:
+        if proc.poll() is None:
+            stop(proc)
+
+
+def imported_modules(mode):
+    """Top-level names of the modules `mode` imports, from one run under -X importtime."""
+    with tempfile.TemporaryFile(mode='w+') as log:  # a pipe could fill up and stall a server before it listens
+        start_once(mode, ['-X', 'importtime'], stderr=log)
+        log.seek(0)
+        names = set()
+        for line in log:
+            if line.startswith('import time:') and '|' in line:
+                name = line.rsplit('|', 1)[1].strip()
+                if name != 'package':
+                    names.add(name.split('.')[0])
+    return names
+
+
+def run_suite(args):
+    results = []
+    for mode in args.modes:
+        times = [start_once(mode) for _ in range(args.repeat)]
+        modules = imported_modules(mode)
+        results.append({
+            'mode': mode,
+            'median_ms': statistics.median(times) * 1000,
+            'min_ms': min(times) * 1000,
+            'max_ms': max(times) * 1000,
+            'modules': len(modules),
+            'heavy': [name for name in HEAVY_MODULES if name in modules],
+        })
+    return results
+
+
+def print_table(results):
+    print(f"{'mode':<12} {'median ms':>10} {'min ms':>8} {'max ms':>8} {'modules':>8}  heavy imports")
+    for r in results:
+        print(f"{r['mode']:<12} {r['median_ms']:>10.0f} {r['min_ms']:>8.0f} {r['max_ms']:>8.0f} {r['modules']:>8}  "
+              f"{', '.join(r['heavy']) or '-'}")
+
+
+def main():
+    p = argparse.ArgumentParser(description='Measure cold-start time of the server, client and GUI entry points')
+    p.add_argument('--modes', nargs='+', choices=list(MODES), default=list(MODES))
+    p.add_argument('--repeat', type=int, default=DEFAULT_REPEAT, help='Timed starts per mode')
+    p.add_argument('--output', default=None, help='Write results as JSON to this file')
+    args = p.parse_args()
+
+    results = run_suite(args)
+    print_table(results)
+    if args.output:
+        report_doc = {
+            'benchmark': 'startup',
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'config': vars(args),
+            'results': results,
+        }
+        with open(args.output, 'w') as f:
+            json.dump(report_doc, f, indent=2)
+        print(f'Results written to {args.output}')
+
+
+if __name__ == '__main__':
+    main()
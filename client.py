@@ -1,253 +1,1943 @@
 import argparse
 import asyncio
 import json
+import math
+import random
 import socket
+import struct
 import threading
 import queue
-import aiohttp
 import time
+from collections import deque
+from urllib.parse import urlparse
 import numpy as np
-import sounddevice as sd
+
+from audio_backend import BACKENDS, create_backend
+from resample import Resampler, SampleFifo
 
 # Audio settings
 DEFAULT_SAMPLE_RATE = 48000
 CHANNELS = 1
 DTYPE = 'int16'
-FRAME_SIZE = 1024  # samples per packet
+DEFAULT_FRAME_MS = 20  # frame duration per packet
+MIN_FRAME_MS = 2.5
+MAX_FRAME_MS = 60
+LOW_LATENCY_FRAME_MS = 5  # --low-latency: short frames, small packets, low-latency device buffers
+LOW_LATENCY_MAX_PACKET_MS = 20
+
+# Codec settings
+CODEC_PREFERENCE = ('opus', 'pcm')  # canonical order, so both sides pick the same codec
+DEFAULT_BITRATE = 24000  # bit/s, Opus only
+DEFAULT_COMPLEXITY = 5  # 0..10, Opus only
+OPUS_SAMPLE_RATES = (8000, 12000, 16000, 24000, 48000)
+MEDIA_SAMPLE_RATES = (8000, 12000, 16000, 22050, 24000, 32000, 44100, 48000)  # rates a peer may send at
+OPUS_FRAME_MS = (2.5, 5, 10, 20, 40, 60)
+
+# Every UDP packet starts with a fixed header: version, payload type, sequence, sample timestamp, SSRC
+MEDIA_HEADER = struct.Struct('!BBHII')
+MEDIA_VERSION = 1
+MAX_PACKET_SIZE = 8192  # fits 60 ms of 48 kHz PCM plus header
+
+# Payload types; control packets share the media socket and have an empty payload
+PT_PCM = 0
+PT_OPUS = 1
+PT_CN = 13  # comfort noise during DTX: one byte, noise level in -dBov (RFC 3389)
+PT_PUNCH = 16
+PT_KEEPALIVE = 17
+PT_PING = 18  # timestamp field carries the sender's millisecond clock; also keeps the NAT mapping open
+PT_PONG = 19  # echoes the ping timestamp back so the pinger can measure RTT
+PT_RR = 20  # receiver report; the timestamp field carries the sender's millisecond clock
+PT_RED = 21  # media with redundant copies of earlier payloads (RFC 2198 style)
+PT_FEC = 22  # XOR parity over a group of media packets; the sequence field is the group's first packet
+
+# Receiver report payload: fraction lost (1/256), cumulative packets lost, interarrival jitter (us),
+# timestamp of the last report received from the peer and milliseconds since it arrived (RTT echo)
+RECEIVER_REPORT = struct.Struct('!BIIII')
+
+# PT_RED payload: one block header per redundant payload, oldest first - payload type with the high
+# bit set, how many packets back it was sent, its length - then the primary's payload type byte,
+# then the redundant payloads and the primary payload in the same order. Unlike RFC 2198 the
+# length has 16 bits, so PCM frames fit.
+RED_BLOCK = struct.Struct('!BBH')
+# PT_FEC payload: packets in the group, their payload type, XOR of their lengths; then the XOR of
+# their payloads, each zero-padded to the longest
+FEC_HEADER = struct.Struct('!BBH')
+
+# Relay fallback: datagrams to the server relay are prefixed with our SSRC and the destination SSRC
+RELAY_HEADER = struct.Struct('!II')
+RELAY_KEY = struct.Struct('!Q')  # secret from the server that binding packets (destination 0) carry
+RELAY_TIMEOUT = 5.0  # seconds without direct packets from a peer before its leg goes through the relay
+
+# UDP timers
+KEEPALIVE_INTERVAL = 2.0  # seconds between pings to every leg
+PUNCH_COUNT = 20  # hole-punching packets sent to a new peer
+PUNCH_INTERVAL = 0.05  # seconds between them
+
+# Signaling reconnects; the server keeps our room slot while we resume the session
+RECONNECT_MIN_DELAY = 0.5  # seconds before the first reconnect; doubles on every failure
+RECONNECT_MAX_DELAY = 10.0
+RECONNECT_JITTER = 0.5  # up to this fraction is added at random, so a room does not reconnect in lockstep
+WS_HEARTBEAT = 5.0  # seconds between websocket pings; a dead connection is noticed within two
+
+# Receiver reports and sender rate control
+REPORT_INTERVAL = 1.0  # seconds between receiver reports to every leg
+REPORT_STALE = 3 * REPORT_INTERVAL  # legs without a fresher report are left out of rate control
+MAX_PACKET_MS = 60  # longest packet a sender builds; receivers size their jitter slots for it
+MIN_BITRATE = 8000  # bit/s, lowest Opus bitrate the controller goes down to
+RATE_LOSS_HIGH = 0.10  # reported loss that cuts the bitrate when there is no loss protection to absorb it
+RATE_LOSS_LOW = 0.02  # reported loss below which the link counts as clean
+RATE_DECREASE = 0.75
+RATE_INCREASE = 1.1
+RATE_STABLE_REPORTS = 3  # clean reports in a row before stepping back up
+RATE_QUEUE_DELAY = 0.1  # seconds of RTT above the recent minimum that mean queues are building up
+RATE_RTT_WINDOW = 20.0  # seconds of reports the minimum RTT is taken over, so a new route resets it
+
+# Loss protection: (reported loss, redundant payloads per packet, parity group size) from the weakest
+# level up. A level is left once loss falls below half its threshold; congestion turns protection off.
+FEC_MODES = ('auto', 'red', 'parity', 'off')
+FEC_LEVELS = {
+    'auto': ((0.01, 0, 5), (0.03, 0, 3), (0.05, 1, 0), (0.15, 2, 0)),
+    'red': ((0.01, 1, 0), (0.15, 2, 0)),
+    'parity': ((0.01, 0, 5), (0.03, 0, 3), (0.05, 0, 2)),
+    'off': (),
+}
+FEC_HOLD = 2.0  # seconds the receiver keeps extra jitter depth for recovery after the last protected packet
+
+# Jitter buffer settings (depth in packets)
+JITTER_MIN_DEPTH = 1
+JITTER_MAX_MS = 200  # the target depth never covers more audio than this
+JITTER_SLACK_MS = 40  # latency above target before the buffer starts dropping to cut it
+JITTER_CAPACITY = 64  # ring slots at least; short frames get more, well above the maximum depth
+JITTER_FACTOR = 3.0  # target covers this many jitter estimates
+
+# Returned by JitterBuffer.pop() when the frame due for playout never arrived
+FRAME_LOST = object()
+
+# Microphone blocks waiting for the sender; when full, the newest block is dropped
+SEND_RING_SLOTS = 8  # at least; short frames get enough slots for SEND_RING_MS of audio
+SEND_RING_MS = 160
+
+# Voice activity detection / discontinuous transmission
+VAD_MODES = ('off', 'energy', 'spectral')
+VAD_MARGIN_DB = 9.0  # frame energy above the noise floor that counts as speech
+VAD_MIN_DB = -55.0  # frames quieter than this (dBov) are never speech
+VAD_NOISE_RISE_DB = 2.0  # dB per second the noise floor may rise; it falls immediately
+VAD_HANGOVER_MS = 300  # keep sending this long after the last speech frame
+VAD_SPEECH_BAND = (300, 3400)  # Hz, spectral mode
+VAD_BAND_RATIO = 0.5  # spectral mode: share of energy in the speech band
+DTX_CN_INTERVAL_MS = 400  # comfort-noise updates while silent
+CN_MAX_LEVEL = 127  # -dBov, the quietest level a CN frame can carry
+CN_TABLE_SECONDS = 1  # length of the pregenerated noise the receiver loops over
+
+
+def frame_samples(sample_rate, frame_ms):
+    return int(sample_rate * frame_ms / 1000)
+
+
+def frame_settings(frame_ms=None, max_frame_ms=None, low_latency=False):
+    """Return (frame_ms, max_frame_ms) with the defaults of the chosen mode filled in.
+
+    Raises ValueError for a frame duration outside MIN_FRAME_MS..MAX_FRAME_MS.
+    """
+    if frame_ms is None:
+        frame_ms = LOW_LATENCY_FRAME_MS if low_latency else DEFAULT_FRAME_MS
+    if max_frame_ms is None:
+        max_frame_ms = LOW_LATENCY_MAX_PACKET_MS if low_latency else MAX_PACKET_MS
+    if not MIN_FRAME_MS <= frame_ms <= MAX_FRAME_MS:
+        raise ValueError(f'frame duration must be {MIN_FRAME_MS:g}..{MAX_FRAME_MS:g} ms, got {frame_ms:g}')
+    return frame_ms, max(frame_ms, max_frame_ms)
+
+
+def latency_budget(leg, capture_ms, playback_ms):
+    """Mouth-to-ear latency estimate of the audio a leg receives, in ms per stage.
+
+    `leg` is a LegStats snapshot; the peer's capture is assumed to take as long as ours
+    (`capture_ms`). The network share is half the measured RTT, 0 until there is one.
+    """
+    budget = {
+        'capture_ms': capture_ms,
+        'packetization_ms': leg['packet_ms'],
+        'network_ms': leg['rtt_ms'] / 2 if leg['rtt_ms'] is not None else 0.0,
+        'jitter_buffer_ms': leg['playback_latency_ms'],
+        'playback_ms': playback_ms,
+    }
+    budget['total_ms'] = sum(budget.values())
+    return budget
+
+
+def format_latency_budget(budget):
+    return (f"захват {budget['capture_ms']:.1f} + пакет {budget['packetization_ms']:.1f} + "
+            f"сеть {budget['network_ms']:.1f} + буфер {budget['jitter_buffer_ms']:.1f} + "
+            f"воспроизведение {budget['playback_ms']:.1f} = {budget['total_ms']:.1f} мс")
+
+
+class PcmCodec:
+    """Raw 16-bit PCM, used when Opus is unavailable or not supported by the peer."""
+    name = 'pcm'
+    payload_type = PT_PCM
+
+    def __init__(self, sample_rate, frame_size):
+        self.sample_rate = sample_rate
+        self.frame_size = frame_size
+        self._last = np.zeros(frame_size, dtype=DTYPE)  # copy of the last frame, for concealment
+        self._have_last = False
+
+    def set_bitrate(self, bitrate):
+        pass
+
+    def encode(self, pcm):
+        # Raw view of the samples; write_packet copies it straight into the packet buffer
+        return memoryview(np.ascontiguousarray(pcm)).cast('B')
 
+    def decode(self, payload):
+        if len(payload) % 2 != 0:
+            return None
+        # A view of the jitter buffer slot, valid until the slot is reused; packets may carry several frames
+        pcm = np.frombuffer(payload, dtype=DTYPE)
+        if pcm.size >= self.frame_size:
+            np.copyto(self._last, pcm[-self.frame_size:])
+            self._have_last = True
+        return pcm
 
-def udp_sender_loop(sock: socket.socket, target, send_q: queue.Queue):
-    packet_count = 0
-    while True:
-        data = send_q.get()
-        if data is None:
-            break
+    def conceal(self):
+        # Repeat the last frame at half the level; repeated losses fade out to silence
+        if not self._have_last:
+            return None
+        np.right_shift(self._last, 1, out=self._last)
+        return self._last
+
+
+class OpusCodec:
+    """Opus encoder/decoder pair; opuslib is imported lazily so the PCM fallback works without libopus."""
+    name = 'opus'
+    payload_type = PT_OPUS
+
+    def __init__(self, sample_rate, frame_size, bitrate=DEFAULT_BITRATE, complexity=DEFAULT_COMPLEXITY):
+        import opuslib
+        self.sample_rate = sample_rate
+        self.frame_size = frame_size
+        self.max_frame_size = max(frame_size, frame_samples(sample_rate, MAX_PACKET_MS))
+        self.encoder = opuslib.Encoder(sample_rate, CHANNELS, opuslib.APPLICATION_VOIP)
+        self.encoder.bitrate = self.bitrate = bitrate
+        self.encoder.complexity = complexity
+        self.decoder = opuslib.Decoder(sample_rate, CHANNELS)
+
+    def set_bitrate(self, bitrate):
+        if bitrate != self.bitrate:
+            self.encoder.bitrate = self.bitrate = bitrate
+
+    def encode(self, pcm):
+        # The sender may pack several frames into one Opus packet
+        return self.encoder.encode(pcm.tobytes(), len(pcm))
+
+    def decode(self, payload):
+        try:
+            data = self.decoder.decode(bytes(payload), self.max_frame_size)
+        except Exception:
+            return None
+        return np.frombuffer(data, dtype=DTYPE)
+
+    def conceal(self):
+        # An empty packet makes libopus run its packet loss concealment
         try:
-            sock.sendto(data, target)
-            packet_count += 1
-            if packet_count % 100 == 0:
-                print(f"Отправлено {packet_count} аудио пакетов к {target}")
+            data = self.decoder.decode(b'', self.frame_size)
+        except Exception:
+            return None
+        return np.frombuffer(data, dtype=DTYPE)
+
+
+def available_codecs(sample_rate, frame_ms):
+    """Codecs this client can run at the given rate/frame duration, in CODEC_PREFERENCE order."""
+    codecs = []
+    if sample_rate in OPUS_SAMPLE_RATES and frame_ms in OPUS_FRAME_MS:
+        try:
+            import opuslib  # noqa: F401
+            codecs.append('opus')
         except Exception as e:
-            print(f"Ошибка отправки: {e}")
+            print(f"Opus недоступен ({e}), используется PCM")
+    codecs.append('pcm')
+    return codecs
+
+
+def packet_sizes(frame_ms, max_packet_ms=MAX_PACKET_MS):
+    """Frames per packet a sender may use: a single frame, or any count whose duration Opus can encode."""
+    sizes = [1]
+    k = 2
+    while k * frame_ms <= min(max_packet_ms, MAX_PACKET_MS):
+        if k * frame_ms in OPUS_FRAME_MS:
+            sizes.append(k)
+        k += 1
+    return sizes
+
+
+def peer_sample_rate(info, default):
+    """Media rate a peer announced at registration; peers that did not announce one send at `default`."""
+    rate = info.get('sample_rate')
+    return rate if rate in MEDIA_SAMPLE_RATES else default
+
+
+def negotiate_codec(local_codecs, remote_codecs):
+    """Pick the first codec of CODEC_PREFERENCE both sides support. Peers without a codec list only speak PCM."""
+    remote_codecs = remote_codecs or ['pcm']
+    for name in CODEC_PREFERENCE:
+        if name in local_codecs and name in remote_codecs:
+            return name
+    return 'pcm'
+
+
+def create_codec(name, sample_rate, frame_size, bitrate=DEFAULT_BITRATE, complexity=DEFAULT_COMPLEXITY):
+    if name == 'opus':
+        return OpusCodec(sample_rate, frame_size, bitrate, complexity)
+    return PcmCodec(sample_rate, frame_size)
+
+
+def new_ssrc():
+    """Random non-zero stream id announced at registration and stamped on every packet."""
+    return random.randint(1, 0xFFFFFFFF)
+
+
+def write_packet(buf, payload_type, seq, timestamp, ssrc, payload=b'', offset=0):
+    """Serialize a packet into the preallocated bytearray `buf` at `offset` and return its length."""
+    MEDIA_HEADER.pack_into(buf, offset, MEDIA_VERSION, payload_type, seq, timestamp, ssrc)
+    start = offset + MEDIA_HEADER.size
+    buf[start:start + len(payload)] = payload
+    return MEDIA_HEADER.size + len(payload)
+
+
+def parse_packet(data):
+    """Return (payload_type, seq, timestamp, ssrc, payload) without copying, or None for foreign packets."""
+    if len(data) < MEDIA_HEADER.size:
+        return None
+    version, payload_type, seq, timestamp, ssrc = MEDIA_HEADER.unpack_from(data)
+    if version != MEDIA_VERSION:
+        return None
+    return payload_type, seq, timestamp, ssrc, memoryview(data)[MEDIA_HEADER.size:]
+
+
+def seq_diff(a, b):
+    """Signed distance a - b between two 16-bit sequence numbers."""
+    return ((a - b + 0x8000) & 0xFFFF) - 0x8000
+
+
+class JitterBuffer:
+    """Reorders media frames by sequence number and releases them at a depth adapted to network jitter.
+
+    put() is called on the event loop (MediaTransport.datagram_received), pop() once per output
+    block from the audio callback thread; the lock covers the two.
+    Frames are kept encoded, so loss concealment runs on the same decoder as normal playout.
+    Payloads are copied into preallocated ring slots of `slot_size` bytes; pop() returns a
+    memoryview of the slot, which stays valid until `capacity` newer frames have arrived.
+
+    Played payloads stay in their slots until overwritten, so the receive path can rebuild a
+    missing packet from a redundant copy (recover()) or from XOR parity over a group of packets
+    (recover_parity()) as long as it has not been due for playout yet.
+    """
+
+    def __init__(self, sample_rate, frame_size, min_depth=JITTER_MIN_DEPTH, max_depth=None, capacity=None,
+                 slot_size=None):
+        self.sample_rate = sample_rate
+        self.frame_size = frame_size
+        self.frame_duration = frame_size / sample_rate
+        self.packet_duration = self.frame_duration  # audio per packet, measured from consecutive packets
+        self.min_depth = min_depth
+        # Depth limits are in packets; by default they cover JITTER_MAX_MS of the shortest packets
+        self.max_depth = max_depth or max(min_depth + 1, math.ceil(JITTER_MAX_MS / 1000 / self.frame_duration))
+        self.capacity = capacity or max(JITTER_CAPACITY, 4 * self.max_depth)
+        capacity = self.capacity
+        self.target_depth = min(self.max_depth, min_depth + 1)
+        self.slack = self._packets(JITTER_SLACK_MS)
+        # Encoded payloads never exceed the raw PCM they carry (opuslib caps its output at the input size);
+        # receivers of multi-frame packets pass a slot_size that fits the longest packet
+        self.slot_size = slot_size or frame_size * CHANNELS * 2
+        self.slots = [memoryview(bytearray(self.slot_size)) for _ in range(capacity)]
+        self.arrays = [np.frombuffer(slot, dtype=np.uint8) for slot in self.slots]  # for parity XOR
+        self.sizes = [-1] * capacity  # payload length per slot, -1 when empty
+        self.types = [0] * capacity  # payload type per slot
+        self.seqs = [-1] * capacity  # sequence number whose payload is in the slot, kept after playout
+        self.lengths = [0] * capacity  # its length
+        self.last_type = None  # payload type of the frame last returned by pop()
+        self.lock = threading.Lock()
+        self.count = 0
+        self.next_seq = None  # next sequence number due for playout
+        self.max_seq = None  # highest sequence number received
+        self._max_ts = None
+        self._max_type = None
+        self.playing = False
+        self.jitter = 0.0  # seconds, RFC 3550 interarrival jitter estimate
+        self._last_arrival = None
+        self._last_ts = None
+        self.received = 0
+        self.late = 0
+        self.lost = 0
+        self.reordered = 0
+        self.dropped = 0
+        self.duplicates = 0
+        self.underruns = 0
+        self.cn_fill = 0  # pops with nothing to play because the sender is in DTX, not counted as underruns
+        self.oversized = 0
+        self.recovered = 0
+        self.fec_depth = 0  # packets the sender's loss protection needs to arrive before a lost one can be rebuilt
+        self._fec_seen = None
+
+    def put(self, seq, timestamp, payload, arrival=None, payload_type=None):
+        if arrival is None:
+            arrival = time.monotonic()
+        with self.lock:
+            self.received += 1
+
+            if self.next_seq is None:
+                self._reset(seq)
+            else:
+                ahead = seq_diff(seq, self.next_seq)
+                if ahead >= self.capacity or ahead < -self.capacity:
+                    # Sender restarted or a long outage: resynchronise on this frame
+                    self._reset(seq)
+                elif ahead < 0:
+                    self.late += 1
+                    return
+
+            idx = seq % self.capacity
+            if self.sizes[idx] >= 0:
+                self.duplicates += 1
+                return
+            size = len(payload)
+            if size > self.slot_size:
+                self.oversized += 1
+                return
+            # Late and duplicate packets would skew the jitter estimate
+            self._update_jitter(timestamp, arrival)
+            ahead = seq_diff(seq, self.max_seq)
+            if ahead > 0:
+                if ahead == 1 and self._max_ts is not None and PT_CN not in (payload_type, self._max_type):
+                    span = ((timestamp - self._max_ts) & 0xFFFFFFFF) / self.sample_rate
+                    if 0 < span <= MAX_PACKET_MS / 1000:
+                        self.packet_duration = span
+                self._max_ts = timestamp
+                self._max_type = payload_type
+            elif seq != self.max_seq:
+                self.reordered += 1
+            self._store(idx, seq, payload, payload_type)
+
+    def recover(self, seq, payload, payload_type):
+        """Store a redundant copy of an earlier packet if it is still missing and not yet due for playout."""
+        with self.lock:
+            if not self._can_recover(seq):
+                return False
+            idx = seq % self.capacity
+            if self.sizes[idx] >= 0 or len(payload) > self.slot_size:
+                return False
+            self._store(idx, seq, payload, payload_type)
+            self.recovered += 1
+            return True
+
+    def recover_parity(self, base_seq, count, payload_type, length_xor, parity):
+        """Rebuild the one missing packet of the group base_seq..base_seq+count-1 from its XOR parity."""
+        with self.lock:
+            missing = None
+            for i in range(count):
+                seq = (base_seq + i) & 0xFFFF
+                if self.seqs[seq % self.capacity] != seq:
+                    if missing is not None:
+                        return False  # XOR parity repairs a single loss per group
+                    missing = seq
+            if missing is None or not self._can_recover(missing):
+                return False
+            length = length_xor
+            for i in range(count):
+                seq = (base_seq + i) & 0xFFFF
+                if seq != missing:
+                    length ^= self.lengths[seq % self.capacity]
+            if length > len(parity) or length > self.slot_size:
+                return False
+            idx = missing % self.capacity
+            out = self.arrays[idx][:length]
+            out[:] = np.frombuffer(parity, dtype=np.uint8, count=length)
+            for i in range(count):
+                seq = (base_seq + i) & 0xFFFF
+                if seq != missing:
+                    other = seq % self.capacity
+                    n = min(length, self.lengths[other])
+                    np.bitwise_xor(out[:n], self.arrays[other][:n], out=out[:n])
+            self._store(idx, missing, None, payload_type, length)
+            self.recovered += 1
+            return True
+
+    def note_protection(self, depth, arrival=None):
+        """The sender protects its packets; keep `depth` extra packets buffered so losses can be rebuilt."""
+        with self.lock:
+            self.fec_depth = min(depth, self.max_depth - self.min_depth)
+            self._fec_seen = time.monotonic() if arrival is None else arrival
+
+    def _can_recover(self, seq):
+        if self.next_seq is None:
+            return False
+        return 0 <= seq_diff(seq, self.next_seq) < self.capacity
+
+    def _store(self, idx, seq, payload, payload_type, size=None):
+        if payload is not None:
+            size = len(payload)
+            self.slots[idx][:size] = payload
+        if seq_diff(seq, self.max_seq) > 0:
+            self.max_seq = seq
+        self.sizes[idx] = size
+        self.lengths[idx] = size
+        self.seqs[idx] = seq
+        self.types[idx] = payload_type
+        self.count += 1
+
+    def pop(self):
+        """Return the next payload, FRAME_LOST if it has to be concealed, or None while (re)buffering."""
+        with self.lock:
+            if self.count == 0:
+                # After a comfort-noise frame the buffer runs empty on purpose until speech resumes
+                if self.last_type == PT_CN:
+                    self.cn_fill += 1
+                elif self.playing:
+                    self.underruns += 1
+                self.playing = False
+                return None
+            depth = self._depth()
+            if not self.playing:
+                if depth < self.target_depth:
+                    if self.last_type == PT_CN:
+                        self.cn_fill += 1
+                    return None
+                self.playing = True
+            if depth > self.target_depth + self.slack:
+                # Too much latency has built up: skip one packet per read until back near target
+                self._take()
+                self.dropped += 1
+            payload = self._take()
+            if payload is None:
+                self.lost += 1
+                return FRAME_LOST
+            return payload
+
+    @property
+    def depth(self):
+        with self.lock:
+            return self._depth() if self.count else 0
+
+    @property
+    def latency_ms(self):
+        return self.depth * self.packet_duration * 1000
+
+    def stats(self):
+        with self.lock:
+            return {
+                'depth': self._depth() if self.count else 0,
+                'target_depth': self.target_depth,
+                'latency_ms': (self._depth() if self.count else 0) * self.packet_duration * 1000,
+                'packet_ms': self.packet_duration * 1000,
+                'jitter_ms': self.jitter * 1000,
+                'received': self.received,
+                'lost': self.lost,
+                'late': self.late,
+                'reordered': self.reordered,
+                'dropped': self.dropped,
+                'duplicates': self.duplicates,
+                'underruns': self.underruns,
+                'cn_fill': self.cn_fill,
+                'oversized': self.oversized,
+                'recovered': self.recovered,
+            }
+
+    def _depth(self):
+        return seq_diff(self.max_seq, self.next_seq) + 1
+
+    def _take(self):
+        idx = self.next_seq % self.capacity
+        size = self.sizes[idx]
+        payload = None
+        if size >= 0:
+            payload = self.slots[idx][:size]
+            self.last_type = self.types[idx]
+            self.sizes[idx] = -1
+            self.count -= 1
+        self.next_seq = (self.next_seq + 1) & 0xFFFF
+        return payload
+
+    def _reset(self, seq):
+        for i in range(self.capacity):
+            self.sizes[i] = -1
+            self.seqs[i] = -1
+        self.count = 0
+        self.next_seq = seq
+        self.max_seq = seq
+        self._max_ts = None
+        self.playing = False
+
+    def _packets(self, ms):
+        return max(1, round(ms / 1000 / self.packet_duration))
+
+    def _update_jitter(self, timestamp, arrival):
+        if self._last_arrival is not None:
+            dts = ((timestamp - self._last_ts + 0x80000000) & 0xFFFFFFFF) - 0x80000000
+            d = abs((arrival - self._last_arrival) - dts / self.sample_rate)
+            self.jitter += (d - self.jitter) / 16
+            target = math.ceil(JITTER_FACTOR * self.jitter / self.packet_duration) + 1
+            if self.fec_depth and arrival - self._fec_seen < FEC_HOLD:
+                target += self.fec_depth
+            # Longer packets need fewer of them for the same latency
+            limit = min(self.max_depth, max(self.min_depth + 1, self._packets(JITTER_MAX_MS)))
+            self.target_depth = max(self.min_depth, min(limit, target))
+            self.slack = self._packets(JITTER_SLACK_MS)
+        self._last_arrival = arrival
+        self._last_ts = timestamp
+
+
+def clock_ms():
+    return int(time.monotonic() * 1000) & 0xFFFFFFFF
+
+
+class LegStats:
+    """Transport counters of one leg.
+
+    Fields are only written on the client's event loop, so updates are plain attribute increments
+    without a lock; readers on other threads may see a value one packet old.
+    """
+
+    def __init__(self):
+        self.packets_sent = 0
+        self.bytes_sent = 0
+        self.packets_received = 0
+        self.bytes_received = 0
+        self.rtt = None  # seconds, last ping or receiver report round trip
+        # Receiver reports: what we last told the peer, and what the peer last told us
+        self.reported_expected = 0
+        self.reported_lost = 0
+        self.peer_report_ts = None  # header timestamp of the peer's last report, echoed back for RTT
+        self.peer_report_at = 0  # our clock_ms() when it arrived
+        self.remote_loss = 0.0
+        self.remote_jitter_ms = 0.0
+        self.remote_report_at = None  # time.monotonic() of the peer's last report
+
+    def snapshot(self, leg):
+        jitter = leg.jitter.stats()
+        expected = jitter['received'] - jitter['late'] - jitter['duplicates'] + jitter['lost'] + jitter['recovered']
+        return {
+            'codec': leg.codec_name,
+            'relayed': leg.relayed,
+            'packets_sent': self.packets_sent,
+            'bytes_sent': self.bytes_sent,
+            'packets_received': self.packets_received,
+            'bytes_received': self.bytes_received,
+            'packets_lost': jitter['lost'],
+            'loss_fraction': jitter['lost'] / expected if expected > 0 else 0.0,
+            'late': jitter['late'],
+            'reordered': jitter['reordered'],
+            'duplicates': jitter['duplicates'],
+            'recovered': jitter['recovered'],
+            'jitter_ms': jitter['jitter_ms'],
+            'rtt_ms': self.rtt * 1000 if self.rtt is not None else None,
+            'remote_loss_fraction': self.remote_loss,
+            'remote_jitter_ms': self.remote_jitter_ms,
+            'packet_ms': jitter['packet_ms'],
+            'playback_depth': jitter['depth'],
+            'playback_target_depth': jitter['target_depth'],
+            'playback_latency_ms': jitter['latency_ms'],
+            'playback_dropped': jitter['dropped'],
+            'playback_underruns': jitter['underruns'],
+            'playback_cn_fill': jitter['cn_fill'],
+        }
+
+
+class CallStats:
+    """Media statistics of a call, read on demand with snapshot().
+
+    Pass one to start_peer() to poll it from another thread; run_client() attaches the mesh and the
+    send ring when the call starts.
+    """
+
+    def __init__(self):
+        self.mesh = None
+        self.send_ring = None
+        self.media = None
+        self.output_underruns = 0  # output callback ran late and the device played silence
+        self.input_overflows = 0  # microphone samples lost before the input callback saw them
+        self.capture_ms = 0.0  # one input block plus the input device latency
+        self.playback_ms = 0.0  # one output block plus the output device latency
+
+    def snapshot(self):
+        mesh = self.mesh
+        legs = {leg.id: leg.stats.snapshot(leg) for leg in mesh.legs} if mesh is not None else {}
+        return {
+            'send_queue_depth': self.send_ring.depth if self.send_ring is not None else 0,
+            'send_overruns': self.send_ring.overruns if self.send_ring is not None else 0,
+            'output_underruns': self.output_underruns,
+            'input_overflows': self.input_overflows,
+            'frames_suppressed': self.media.frames_suppressed if self.media is not None else 0,
+            'talking': self.media.silent_frames == 0 if self.media is not None else False,
+            'bitrate': self.media.rate.bitrate if self.media is not None else None,
+            'packet_ms': self.media.rate.frames_per_packet * self.media.frame_ms if self.media is not None else None,
+            'redundancy': self.media.rate.redundancy if self.media is not None else 0,
+            'parity_group': self.media.rate.parity_group if self.media is not None else 0,
+            'capture_ms': self.capture_ms,
+            'playback_ms': self.playback_ms,
+            'legs': legs,
+            'latency': {peer_id: latency_budget(leg, self.capture_ms, self.playback_ms)
+                        for peer_id, leg in legs.items()},
+        }
+
+
+def level_dbov(pcm):
+    """Frame energy in dB relative to int16 full scale."""
+    x = pcm.astype(np.float32)
+    power = float(np.dot(x, x)) / max(1, x.size)
+    return 10 * math.log10(power / (32768.0 * 32768.0) + 1e-12)
+
+
+class VoiceActivityDetector:
+    """Energy-based VAD with an adaptive noise floor and hangover.
+
+    A frame is speech when it is VAD_MARGIN_DB above the tracked noise floor and above VAD_MIN_DB;
+    with `spectral`, most of its energy must also fall in the speech band. After the last speech
+    frame, VAD_HANGOVER_MS more frames are reported as speech so word endings are not clipped.
+    """
+
+    def __init__(self, sample_rate, frame_size, spectral=False, hangover_ms=VAD_HANGOVER_MS):
+        self.sample_rate = sample_rate
+        self.frame_size = frame_size
+        self.spectral = spectral
+        frame_duration = frame_size / sample_rate
+        self.hangover = max(1, round(hangover_ms / 1000 / frame_duration))
+        self.noise_rise = VAD_NOISE_RISE_DB * frame_duration
+        self.noise_db = VAD_MIN_DB
+        self.level_db = -120.0
+        self.remaining = 0
+        freqs = np.fft.rfftfreq(frame_size, 1 / sample_rate)
+        self.band = (freqs >= VAD_SPEECH_BAND[0]) & (freqs <= VAD_SPEECH_BAND[1])
+
+    def is_speech(self, pcm):
+        db = self.level_db = level_dbov(pcm)
+        if db < self.noise_db:
+            self.noise_db = db
+        else:
+            self.noise_db = min(db, self.noise_db + self.noise_rise)
+        active = db > VAD_MIN_DB and db > self.noise_db + VAD_MARGIN_DB
+        if active and self.spectral and pcm.size == self.frame_size:
+            power = np.abs(np.fft.rfft(pcm.astype(np.float32))) ** 2
+            total = float(power.sum())
+            active = total > 0 and float(power[self.band].sum()) / total >= VAD_BAND_RATIO
+        if active:
+            self.remaining = self.hangover
+            return True
+        if self.remaining > 0:
+            self.remaining -= 1
+            return True
+        return False
+
+    def noise_level(self):
+        """Noise floor as an RFC 3389 level byte (-dBov, 0..127)."""
+        return max(0, min(CN_MAX_LEVEL, round(-self.noise_db)))
+
+
+class ComfortNoise:
+    """Generates white noise at the level announced by the sender's CN frames, without allocating."""
+
+    def __init__(self, sample_rate, frame_size):
+        rng = np.random.default_rng()
+        self.table = rng.standard_normal(max(frame_size, sample_rate * CN_TABLE_SECONDS)).astype(np.float32)
+        self.pos = 0
+        self.scratch = np.zeros(frame_size, dtype=np.float32)
+        self.out = np.zeros(frame_size, dtype=DTYPE)
+        self.amplitude = 0.0
+
+    def set_level(self, level):
+        self.amplitude = 32768.0 * 10 ** (-min(level, CN_MAX_LEVEL) / 20)
+
+    def generate(self):
+        n = self.out.size
+        if self.pos + n > self.table.size:
+            self.pos = 0
+        np.multiply(self.table[self.pos:self.pos + n], self.amplitude, out=self.scratch)
+        np.copyto(self.out, self.scratch, casting='unsafe')
+        self.pos += n
+        return self.out
+
+
+class SendRing:
+    """Bounded single-producer/single-consumer ring of microphone blocks, without locks.
+
+    The input callback copies each block into a preallocated slot with put() and never blocks; if
+    the consumer has fallen `slots` blocks behind, the block is dropped and counted instead. put()
+    calls `notify` (e.g. loop.call_soon_threadsafe) only when no wake-up is pending already; the
+    consumer clears `wake_pending`, then drains with peek()/release(), encoding straight from the
+    slot view.
+    """
+
+    def __init__(self, frame_size, slots=SEND_RING_SLOTS, notify=None):
+        self.frame_size = frame_size
+        self.buffers = np.zeros((slots, frame_size), dtype=DTYPE)
+        self.slots = slots
+        self.written = 0  # advanced only by the producer
+        self.read = 0  # advanced only by the consumer
+        self.notify = notify
+        self.wake_pending = False
+        self.overruns = 0
+
+    @property
+    def depth(self):
+        return self.written - self.read
+
+    def put(self, block):
+        if self.written - self.read >= self.slots:
+            self.overruns += 1
+            return
+        slot = self.buffers[self.written % self.slots]
+        n = min(block.shape[0], self.frame_size)
+        slot[:n] = block[:n]
+        slot[n:] = 0
+        self.written += 1
+        if not self.wake_pending and self.notify is not None:
+            self.wake_pending = True
+            self.notify()
+
+    def peek(self):
+        """Return a view of the oldest block's slot, or None when the ring is empty."""
+        if self.read == self.written:
+            return None
+        return self.buffers[self.read % self.slots]
+
+    def release(self):
+        """Hand the slot returned by peek() back to the producer."""
+        self.read += 1
+
+
+class RateController:
+    """Adapts the sender's bitrate, packet duration and loss protection to the peers' receiver reports.
+
+    update() runs once per report interval with the worst loss fraction and RTT among the legs.
+    An RTT RATE_QUEUE_DELAY above the lowest one of the last RATE_RTT_WINDOW seconds (queues
+    building up on the path) cuts the bitrate and moves to longer packets, which send fewer
+    headers per second. Loss alone is met with protection first, since random loss is not
+    congestion; it only cuts the bitrate above RATE_LOSS_HIGH when `fec` offers no protection.
+    After RATE_STABLE_REPORTS clean reports the bitrate grows back to its maximum, then packets
+    get shorter again. Protection follows the FEC_LEVELS of `fec`: XOR parity for light loss,
+    redundant payloads for heavier loss, and none on a congested path where the extra bytes
+    would only add to the queue. Without `enabled` the bitrate and packet size stay fixed and
+    only the protection follows the reports.
+    """
+
+    def __init__(self, bitrate, min_bitrate=MIN_BITRATE, sizes=(1,), max_redundancy=2, enabled=True, fec='auto'):
+        self.max_bitrate = bitrate
+        self.min_bitrate = min(min_bitrate, bitrate)
+        self.bitrate = bitrate
+        self.sizes = sizes  # allowed frames per packet, ascending
+        self.size_index = 0
+        self.max_redundancy = max_redundancy
+        self.levels = []
+        for loss, redundancy, group in FEC_LEVELS[fec]:
+            redundancy = min(redundancy, max_redundancy)
+            if redundancy or group:
+                self.levels.append((loss, redundancy, group))
+        self.level = -1  # index into levels, -1 = unprotected
+        self.redundancy = 0  # earlier payloads carried by each packet
+        self.parity_group = 0  # packets per XOR parity packet, 0 = off
+        self.enabled = enabled
+        self.min_rtt = None
+        self.rtt_window = deque()  # (time, rtt) with increasing RTTs; the first one is the minimum
+        self.stable = 0
+        self.congested = False
+
+    @property
+    def frames_per_packet(self):
+        return self.sizes[self.size_index]
+
+    def update(self, loss, rtt, now=None):
+        if not self.enabled:
+            self._protect(loss)
+            return
+        self.congested = False
+        if rtt is not None:
+            self.min_rtt = self._windowed_min(rtt, time.monotonic() if now is None else now)
+            self.congested = rtt - self.min_rtt > RATE_QUEUE_DELAY
+        if self.congested or (loss >= RATE_LOSS_HIGH and not self.levels):
+            self.stable = 0
+            self.bitrate = max(self.min_bitrate, int(self.bitrate * RATE_DECREASE))
+            self.size_index = min(len(self.sizes) - 1, self.size_index + 1)
+        elif loss < RATE_LOSS_LOW or self.levels:
+            self.stable += 1
+            if self.stable >= RATE_STABLE_REPORTS:
+                self.stable = 0
+                if self.bitrate < self.max_bitrate:
+                    self.bitrate = min(self.max_bitrate, int(self.bitrate * RATE_INCREASE))
+                elif self.size_index > 0:
+                    self.size_index -= 1
+        else:
+            self.stable = 0
+        self._protect(loss)
+
+    def shorten(self):
+        """Step back to shorter packets, e.g. when redundant copies no longer fit in MAX_PACKET_SIZE."""
+        if self.size_index > 0:
+            self.size_index -= 1
+            self.stable = 0
 
+    def _windowed_min(self, rtt, now):
+        window = self.rtt_window
+        while window and window[-1][1] >= rtt:
+            window.pop()
+        window.append((now, rtt))
+        while now - window[0][0] > RATE_RTT_WINDOW:
+            window.popleft()
+        return window[0][1]
 
-def audio_input_callback(indata, frames, time, status, send_q: queue.Queue, mic_rms_cb=None):
-    # indata - numpy array int16
-    if mic_rms_cb is not None:
-        # Вычисляем RMS (среднеквадратичное) и нормализуем
-        rms = np.sqrt(np.mean(indata.astype(np.float32)**2))
-        max_val = 32768.0  # максимальное значение int16
-        level = min(100, int((rms / max_val) * 100))
-        mic_rms_cb(level)
-    send_q.put(indata.tobytes())
+    def _protect(self, loss):
+        target = -1
+        for i, level in enumerate(self.levels):
+            if loss >= level[0]:
+                target = i
+        if self.congested:
+            self.level = -1
+        elif target > self.level:
+            self.level = target
+        elif target < self.level and loss < self.levels[self.level][0] / 2:
+            self.level -= 1
+        if self.level < 0:
+            self.redundancy = self.parity_group = 0
+        else:
+            _, self.redundancy, self.parity_group = self.levels[self.level]
+
+
+class PacketEncoder:
+    """Encoder of one codec with its packet buffer and loss protection state.
+
+    Keeps the last `history` encoded payloads for redundant packets and the running XOR of the
+    current parity group, all in preallocated buffers.
+    """
+
+    def __init__(self, codec, history=0):
+        self.codec = codec
+        self.packet = bytearray(MAX_PACKET_SIZE)
+        self.view = memoryview(self.packet)
+        self.history = [bytearray(MAX_PACKET_SIZE) for _ in range(history)]  # newest first
+        self.history_sizes = [0] * history
+        self.history_seqs = [0] * history
+        self.parity = np.zeros(MAX_PACKET_SIZE, dtype=np.uint8)
+        self.parity_packet = bytearray(RELAY_HEADER.size + MEDIA_HEADER.size + FEC_HEADER.size + MAX_PACKET_SIZE)
+        self.parity_view = memoryview(self.parity_packet)
+        self.parity_count = 0
+        self.parity_base = 0
+        self.parity_length = 0  # longest payload in the group
+        self.parity_length_xor = 0
+        self.capped = False  # the last packet carried fewer earlier payloads than asked, to fit MAX_PACKET_SIZE
+
+    def write(self, seq, timestamp, ssrc, payload, redundancy=0):
+        """Write the packet for `payload` at RELAY_HEADER.size into `packet` and return its length.
+
+        With `redundancy`, up to that many earlier payloads ride along in a PT_RED packet, as
+        many as fit in MAX_PACKET_SIZE; `capped` tells whether the size limit lowered the depth.
+        """
+        pt = self.codec.payload_type
+        prefix = RELAY_HEADER.size
+        n = len(payload)
+        blocks = 0
+        size = MEDIA_HEADER.size + 1 + n
+        self.capped = False
+        for i in range(min(redundancy, len(self.history))):
+            back = seq_diff(seq, self.history_seqs[i])
+            extra = RED_BLOCK.size + self.history_sizes[i]
+            if not self.history_sizes[i] or not 0 < back <= 255:
+                break
+            if size + extra > MAX_PACKET_SIZE:
+                self.capped = True
+                break
+            blocks += 1
+            size += extra
+        if not blocks:
+            size = write_packet(self.packet, pt, seq, timestamp, ssrc, payload, prefix)
+        else:
+            MEDIA_HEADER.pack_into(self.packet, prefix, MEDIA_VERSION, PT_RED, seq, timestamp, ssrc)
+            pos = prefix + MEDIA_HEADER.size
+            for i in reversed(range(blocks)):
+                RED_BLOCK.pack_into(self.packet, pos, 0x80 | pt, seq_diff(seq, self.history_seqs[i]),
+                                    self.history_sizes[i])
+                pos += RED_BLOCK.size
+            self.packet[pos] = pt
+            pos += 1
+            for i in reversed(range(blocks)):
+                old = self.history_sizes[i]
+                self.view[pos:pos + old] = memoryview(self.history[i])[:old]
+                pos += old
+            self.view[pos:pos + n] = payload
+        self._remember(seq, payload)
+        return size
+
+    def _remember(self, seq, payload):
+        if not self.history:
+            return
+        buf = self.history.pop()
+        self.history_sizes.pop()
+        self.history_seqs.pop()
+        n = len(payload)
+        buf[:n] = payload
+        self.history.insert(0, buf)
+        self.history_sizes.insert(0, n)
+        self.history_seqs.insert(0, seq)
+
+    def add_parity(self, seq, payload):
+        """Fold a sent payload into the current parity group."""
+        n = len(payload)
+        if not self.parity_count:
+            self.parity_base = seq
+        np.bitwise_xor(self.parity[:n], np.frombuffer(payload, dtype=np.uint8), out=self.parity[:n])
+        self.parity_length = max(self.parity_length, n)
+        self.parity_length_xor ^= n
+        self.parity_count += 1
+
+    def write_parity(self, timestamp, ssrc):
+        """Write the parity packet of the current group at RELAY_HEADER.size, start a new group, return its length."""
+        prefix = RELAY_HEADER.size
+        n = self.parity_length
+        MEDIA_HEADER.pack_into(self.parity_packet, prefix, MEDIA_VERSION, PT_FEC, self.parity_base, timestamp, ssrc)
+        FEC_HEADER.pack_into(self.parity_packet, prefix + MEDIA_HEADER.size, self.parity_count,
+                             self.codec.payload_type, self.parity_length_xor)
+        start = prefix + MEDIA_HEADER.size + FEC_HEADER.size
+        self.parity_view[start:start + n] = self.parity[:n]
+        self.parity[:n] = 0
+        self.parity_count = self.parity_length = self.parity_length_xor = 0
+        return MEDIA_HEADER.size + FEC_HEADER.size + n
+
+
+class PeerLeg:
+    """Media leg to one remote peer: its address, negotiated codec and its own receive buffer.
+
+    Received media is decoded at the rate the peer sends at (`sample_rate`) and converted to the
+    output device's `output_rate` by the leg's playback buffer.
+    """
+
+    def __init__(self, info, codec_name, sample_rate, frame_size, bitrate, complexity, output_rate=None,
+                 output_frame_size=None):
+        self.id = info['id']
+        self.target = (info['ip'], int(info['udp_port']))
+        self.ssrc = info.get('ssrc')
+        self.codec_name = codec_name
+        self.sample_rate = sample_rate
+        self.rx_codec = create_codec(codec_name, sample_rate, frame_size, bitrate, complexity)
+        slot_size = max(frame_size, frame_samples(sample_rate, MAX_PACKET_MS)) * CHANNELS * 2
+        self.jitter = JitterBuffer(sample_rate, frame_size, slot_size=slot_size)
+        self.playback = PlaybackBuffer(self.jitter, self.rx_codec, self.id, output_rate, output_frame_size)
+        self.stats = LegStats()
+        self.created = time.monotonic()
+        self.last_direct = None  # last packet received straight from the peer
+        self.peer_relayed = False  # the peer reaches us through the relay: it cannot hear us directly, and the relay knows it
+        self.relayed = False
+
+    def needs_relay(self, now):
+        if self.relayed or self.ssrc is None:
+            return False
+        last = self.last_direct if self.last_direct is not None else self.created
+        return self.peer_relayed or now - last > RELAY_TIMEOUT
+
+
+class PeerMesh:
+    """Legs to every peer of the room.
+
+    Legs are added and removed only on the asyncio loop, which also runs the UDP transport. The
+    audio callbacks read the immutable snapshot `legs` (and `by_ssrc`/`by_addr`), which is swapped
+    in as a whole on every change, so they never need a lock.
+
+    `sample_rate`/`frame_size` are our media rate and frame; every leg plays out at `output_rate`
+    in blocks of `output_frame_size` (by default the same).
+    """
+
+    def __init__(self, own_id, local_codecs, sample_rate, frame_size, bitrate, complexity, output_rate=None,
+                 output_frame_size=None):
+        self.own_id = own_id
+        self.local_codecs = local_codecs
+        self.sample_rate = sample_rate
+        self.frame_size = frame_size
+        self.output_rate = output_rate or sample_rate
+        self.output_frame_size = output_frame_size or frame_size
+        self.bitrate = bitrate
+        self.complexity = complexity
+        self._legs = {}  # peer id -> PeerLeg
+        self.legs = ()
+        self.by_ssrc = {}
+        self.by_addr = {}
+        self.relay_addr = None  # set when the server offers a UDP relay
+        self.relay_key = 0
+
+    def update(self, peers):
+        """Sync legs with a full peer list; returns (added, removed) legs."""
+        wanted = {p['id']: p for p in peers if p.get('id') != self.own_id}
+        removed = [self._legs.pop(pid) for pid in list(self._legs)
+                   if pid not in wanted or not self._same_endpoint(self._legs[pid], wanted[pid])]
+        added = [self._new_leg(info) for pid, info in wanted.items() if pid not in self._legs]
+        if added or removed:
+            self._publish()
+        return added, removed
+
+    def add(self, info):
+        """Add a leg for a peer that joined; returns (added, removed) like update()."""
+        if info.get('id') == self.own_id:
+            return [], []
+        removed = []
+        old = self._legs.get(info['id'])
+        if old is not None:
+            if self._same_endpoint(old, info):
+                return [], []
+            removed.append(self._legs.pop(info['id']))
+        added = [self._new_leg(info)]
+        self._publish()
+        return added, removed
+
+    def remove(self, peer_id):
+        leg = self._legs.pop(peer_id, None)
+        if leg is None:
+            return [], []
+        self._publish()
+        return [], [leg]
+
+    def _new_leg(self, info):
+        codec_name = negotiate_codec(self.local_codecs, info.get('codecs'))
+        rate = peer_sample_rate(info, self.sample_rate)
+        if rate not in OPUS_SAMPLE_RATES:
+            codec_name = 'pcm'
+        frame_size = frame_samples(rate, self.frame_size * 1000 / self.sample_rate)
+        leg = PeerLeg(info, codec_name, rate, frame_size, self.bitrate, self.complexity, self.output_rate,
+                      self.output_frame_size)
+        self._legs[leg.id] = leg
+        return leg
+
+    def clear(self):
+        self._legs.clear()
+        self._publish()
+
+    def check_relay(self, now):
+        """Move legs whose hole-punching failed onto the server relay; returns the legs switched."""
+        if self.relay_addr is None:
+            return []
+        switched = [leg for leg in self.legs if leg.needs_relay(now)]
+        for leg in switched:
+            leg.relayed = True
+        return switched
+
+    @staticmethod
+    def _same_endpoint(leg, info):
+        return leg.target == (info['ip'], int(info['udp_port'])) and leg.ssrc == info.get('ssrc')
+
+    def _publish(self):
+        legs = tuple(self._legs.values())
+        self.by_ssrc = {leg.ssrc: leg for leg in legs if leg.ssrc is not None}
+        self.by_addr = {leg.target: leg for leg in legs}
+        self.legs = legs
+
+
+class LevelMeter:
+    """Peak and RMS level of an audio stream, written by its audio thread and polled by a UI.
+
+    update() runs in the audio callback: it adds one block's energy to running totals and
+    publishes them with a single tuple assignment, so there are no locks and no calls into the
+    UI. read() is called by the UI at its own frame rate and returns the peak and RMS (fractions
+    of full scale) of everything written since the previous read(); each read starts a new
+    window, which the writer notices by the changed epoch. Only one thread may call update() and
+    one read().
+    """
+
+    def __init__(self, block_size=1024):
+        self.buf = np.zeros(block_size, dtype=np.float32)
+        self.epoch = 0  # advanced only by the reader
+        self.published = (0, 0.0, 0.0, 0)  # epoch, peak, total energy, total samples
+        self._epoch = 0
+        self._peak = 0.0
+        self._energy = 0.0
+        self._samples = 0
+        self._read_energy = 0.0
+        self._read_samples = 0
+
+    def update(self, pcm):
+        n = pcm.size
+        if n > self.buf.size:
+            self.buf = np.zeros(n, dtype=np.float32)
+        x = self.buf[:n]
+        np.copyto(x, pcm, casting='unsafe')
+        peak = max(float(x.max()), -float(x.min())) / 32768.0 if n else 0.0
+        epoch = self.epoch
+        if epoch != self._epoch:
+            self._epoch = epoch
+            self._peak = peak
+        elif peak > self._peak:
+            self._peak = peak
+        self._energy += float(np.dot(x, x))
+        self._samples += n
+        self.published = (epoch, self._peak, self._energy, self._samples)
+
+    def read(self):
+        """Return (peak, rms) since the previous read, both 0..1."""
+        epoch, peak, energy, samples = self.published
+        if epoch != self.epoch:
+            peak = 0.0  # nothing written in this window yet
+        self.epoch += 1
+        count = samples - self._read_samples
+        rms = math.sqrt((energy - self._read_energy) / count) / 32768.0 if count > 0 else 0.0
+        self._read_energy = energy
+        self._read_samples = samples
+        return min(1.0, peak), min(1.0, rms)
+
+
+class Mixer:
+    """Sums the decoded streams of all active legs into the output block.
+
+    Accumulates in int32 and saturates to int16 with whole-array NumPy operations; a single active
+    leg is copied straight from its decoded frame into the output block.
+    """
+
+    def __init__(self, mesh: PeerMesh, frame_size, meter=None):
+        self.mesh = mesh
+        self.acc = np.zeros(frame_size, dtype=np.int32)
+        self.meter = meter
+
+    def write(self, outdata):
+        frames = outdata.shape[0]
+        if self.acc.size != frames:
+            self.acc = np.zeros(frames, dtype=np.int32)
+        acc = self.acc
+        first = None  # with a single active leg its frame is copied straight into outdata
+        active = 0
+        for leg in self.mesh.legs:
+            pcm = leg.playback.read()
+            if pcm is None:
+                continue
+            n = min(pcm.size, frames)
+            if active == 0:
+                first = pcm[:n]
+            else:
+                if active == 1:
+                    acc.fill(0)
+                    acc[:first.size] = first
+                acc[:n] += pcm[:n]
+            active += 1
+
+        if not active:
+            outdata.fill(0)
+            if self.meter is not None:
+                self.meter.update(outdata[:, 0])
+            return
+
+        if active == 1:
+            outdata[:first.size, 0] = first
+            outdata[first.size:] = 0
+        else:
+            np.clip(acc, -32768, 32767, out=acc)
+            outdata[:, 0] = acc
+
+        if self.meter is not None:
+            self.meter.update(outdata[:, 0])
+
+
+def audio_input_callback(indata, frames, time, status, send_ring: SendRing, mic_meter=None):
+    # indata - numpy array int16, (frames, channels); only valid during the callback
+    if mic_meter is not None:
+        mic_meter.update(indata[:, 0])
+    send_ring.put(indata[:, 0])
 
 
 class PlaybackBuffer:
-    def __init__(self, speaker_rms_cb=None):
-        self.q = queue.Queue()
-        self.speaker_rms_cb = speaker_rms_cb
+    """Decodes one leg's packets from its jitter buffer, concealing the ones that were lost.
+
+    Decoded audio is converted from the leg's rate to `output_rate` when they differ and queued in
+    a FIFO, which read() serves in blocks of `output_frame_size`, whatever the peer's packet
+    duration. A lost packet is concealed for as many frames as the last one carried. After a
+    comfort-noise frame the sender is in DTX: until the next media frame, gaps are filled with
+    comfort noise instead of silence or concealment.
+    """
+
+    def __init__(self, jitter: JitterBuffer, codec, peer_id=None, output_rate=None, output_frame_size=None):
+        self.jitter = jitter
+        self.codec = codec
+        self.peer_id = peer_id
+        self.frame_size = jitter.frame_size
         self.received = False
+        self.comfort_noise = ComfortNoise(jitter.sample_rate, jitter.frame_size)
+        self.in_dtx = False
+        self.packet_frames = 1  # frames in the last decoded packet
+        self.conceal_left = 0
+        output_rate = output_rate or jitter.sample_rate
+        self.resampler = Resampler(jitter.sample_rate, output_rate) if output_rate != jitter.sample_rate else None
+        self.out = np.zeros(output_frame_size or jitter.frame_size, dtype=DTYPE)
+        # Room for a block still to be served plus the longest packet, after rate conversion
+        longest = frame_samples(output_rate, max(MAX_PACKET_MS, 1000 * jitter.frame_duration))
+        self.fifo = SampleFifo(self.out.size + longest + 16)
 
-    def write(self, outdata):
-        try:
-            data = self.q.get_nowait()
-            # Проверяем, что данные кратны размеру int16
-            if len(data) % 2 != 0:
-                # Если не кратно – пропускаем (возможно, испорченный пакет)
-                outdata.fill(0)
+    def read(self):
+        fifo = self.fifo
+        while fifo.count < self.out.size:
+            pcm = self._next()
+            if pcm is None:
+                break
+            fifo.push(self.resampler.process(pcm) if self.resampler is not None else pcm)
+        if not fifo.count:
+            return None
+        return fifo.pop(self.out)
+
+    def _next(self):
+        if self.conceal_left:
+            self.conceal_left -= 1
+            return self.codec.conceal()
+        payload = self.jitter.pop()
+        if payload is None or (payload is FRAME_LOST and self.in_dtx):
+            return self.comfort_noise.generate() if self.in_dtx else None
+        if payload is FRAME_LOST:
+            self.conceal_left = self.packet_frames - 1
+            return self.codec.conceal()
+        if self.jitter.last_type == PT_CN:
+            if len(payload):
+                self.comfort_noise.set_level(payload[0])
+            self.in_dtx = True
+            return self.comfort_noise.generate()
+        self.in_dtx = False
+        pcm = self.codec.decode(payload)
+        if pcm is None:
+            return None
+        if not self.received:
+            print(f"Первый аудио пакет от {self.peer_id} **получен**!")
+            self.received = True
+        self.packet_frames = max(1, pcm.size // self.frame_size)
+        return pcm
+
+
+class MediaTransport(asyncio.DatagramProtocol):
+    """The client's UDP socket on its asyncio loop: media, pings, receiver reports and hole-punching.
+
+    Microphone blocks arrive through the SendRing; the input callback wakes send_pending() with
+    call_soon_threadsafe. Blocks are collected into packets of `rate.frames_per_packet` frames.
+    Received frames go straight into the legs' jitter buffers. report_loop() tells every peer what
+    arrives from it and feeds the peers' reports to the RateController.
+    """
+
+    def __init__(self, mesh: PeerMesh, send_ring: SendRing, ssrc, bitrate, complexity, vad='energy', rate=None,
+                 input_rate=None):
+        self.mesh = mesh
+        self.send_ring = send_ring
+        # Microphone blocks at another rate are converted to our media rate and regrouped into frames
+        self.resampler = None
+        if input_rate and input_rate != mesh.sample_rate:
+            self.resampler = Resampler(input_rate, mesh.sample_rate)
+            self.input_fifo = SampleFifo(mesh.frame_size * 2 + send_ring.frame_size * mesh.sample_rate // input_rate)
+            self.frame = np.zeros(mesh.frame_size, dtype=DTYPE)
+        self.ssrc = ssrc
+        self.bitrate = bitrate
+        self.complexity = complexity
+        self.rate = rate or RateController(bitrate, enabled=False, fec='off')
+        self.vad = None
+        if vad != 'off':
+            self.vad = VoiceActivityDetector(mesh.sample_rate, mesh.frame_size, spectral=vad == 'spectral')
+        self.frame_ms = mesh.frame_size * 1000 / mesh.sample_rate
+        self.cn_interval = max(1, round(DTX_CN_INTERVAL_MS / self.frame_ms))  # frames between CN updates
+        self.silent_frames = 0  # consecutive frames suppressed by DTX
+        self.frames_suppressed = 0
+        self.cn_packet = bytearray(RELAY_HEADER.size + MEDIA_HEADER.size + 1)
+        # Frames collected for the next packet
+        self.packet_pcm = np.zeros(mesh.frame_size * max(self.rate.sizes), dtype=DTYPE)
+        self.packet_frames = 0
+        self.packet_timestamp = 0
+        self.transport = None
+        self.seq = random.getrandbits(16)
+        self.timestamp = random.getrandbits(32)
+        self.encoders = {}  # codec name -> PacketEncoder; each packet is encoded once per codec in use
+        self.ping = bytearray(RELAY_HEADER.size + MEDIA_HEADER.size)
+        self.pong = bytearray(RELAY_HEADER.size + MEDIA_HEADER.size)
+        self.report = bytearray(RELAY_HEADER.size + MEDIA_HEADER.size + RECEIVER_REPORT.size)
+        self.relay_bind = bytearray(RELAY_HEADER.size + RELAY_KEY.size)
+        RELAY_HEADER.pack_into(self.relay_bind, 0, ssrc, 0)
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def error_received(self, exc):
+        pass  # ICMP errors from peers whose NAT mapping is not open yet
+
+    def datagram_received(self, data, addr):
+        packet = parse_packet(data)
+        if packet is None:
+            return
+        payload_type, seq, timestamp, ssrc, payload = packet
+        mesh = self.mesh
+        leg = mesh.by_ssrc.get(ssrc)
+        if leg is None:
+            # Peers that did not announce an SSRC are matched by address
+            leg = mesh.by_addr.get(addr)
+            if leg is None or leg.ssrc is not None:
                 return
-            arr = np.frombuffer(data, dtype=DTYPE).reshape(-1, CHANNELS)
-
-            if not self.received:
-                print("Первый аудио пакет **получен**!")  # было "отправлен"
-                self.received = True
-
-            # Вычисляем RMS для полученного аудио
-            if self.speaker_rms_cb is not None:
-                rms = np.sqrt(np.mean(arr.astype(np.float32)**2))
-                max_val = 32768.0
-                level = min(100, int((rms / max_val) * 100))
-                self.speaker_rms_cb(level)
-
-            if arr.size < outdata.size:
-                outdata[:arr.size] = arr
-                outdata[arr.size:] = 0
+        if addr == mesh.relay_addr:
+            leg.peer_relayed = True
+        else:
+            leg.last_direct = time.monotonic()
+        if payload_type == PT_PING:
+            prefix = RELAY_HEADER.size
+            write_packet(self.pong, PT_PONG, 0, timestamp, self.ssrc, offset=prefix)
+            if addr == mesh.relay_addr:
+                RELAY_HEADER.pack_into(self.pong, 0, self.ssrc, leg.ssrc)
+                self.transport.sendto(self.pong, addr)
             else:
-                outdata[:] = arr[:outdata.size]
-        except queue.Empty:
-            if self.speaker_rms_cb is not None:
-                self.speaker_rms_cb(0) # нет данных - уровень 0
-            outdata.fill(0)
+                self.transport.sendto(memoryview(self.pong)[prefix:], addr)
+            return
+        if payload_type == PT_PONG:
+            leg.stats.rtt = ((clock_ms() - timestamp) & 0xFFFFFFFF) / 1000
+            return
+        if payload_type == PT_RR:
+            self._receive_report(leg, timestamp, payload)
+            return
+        if payload_type == PT_RED:
+            self._receive_redundant(leg, seq, timestamp, payload, len(data))
+            return
+        if payload_type == PT_FEC:
+            if len(payload) >= FEC_HEADER.size:
+                count, block_type, length_xor = FEC_HEADER.unpack_from(payload)
+                if block_type == leg.rx_codec.payload_type:
+                    leg.jitter.note_protection(count)
+                    leg.jitter.recover_parity(seq, count, block_type, length_xor, payload[FEC_HEADER.size:])
+            return
+        # Игнорируем служебные пакеты (PUNCH, KEEPALIVE)
+        if payload_type != leg.rx_codec.payload_type and payload_type != PT_CN:
+            return
+        leg.stats.packets_received += 1
+        leg.stats.bytes_received += len(data)
+        leg.jitter.put(seq, timestamp, payload, payload_type=payload_type)
 
+    def _receive_redundant(self, leg, seq, timestamp, payload, size):
+        """Split a PT_RED packet: the primary payload is played, the older ones fill holes if still missing."""
+        blocks = []
+        pos = 0
+        while pos < len(payload) and payload[pos] & 0x80:
+            if pos + RED_BLOCK.size > len(payload):
+                return
+            block_type, back, length = RED_BLOCK.unpack_from(payload, pos)
+            blocks.append((block_type & 0x7F, back, length))
+            pos += RED_BLOCK.size
+        if pos >= len(payload):
+            return
+        primary_type = payload[pos]
+        pos += 1
+        if primary_type != leg.rx_codec.payload_type:
+            return
+        redundant = []
+        for block_type, back, length in blocks:
+            if pos + length > len(payload):
+                return
+            redundant.append((block_type, back, payload[pos:pos + length]))
+            pos += length
+        leg.stats.packets_received += 1
+        leg.stats.bytes_received += size
+        leg.jitter.put(seq, timestamp, payload[pos:], payload_type=primary_type)
+        leg.jitter.note_protection(len(blocks))
+        for block_type, back, block in redundant:
+            if block_type == primary_type:
+                leg.jitter.recover((seq - back) & 0xFFFF, block, block_type)
 
-def get_device_sample_rate(device_id, is_input=True):
-    try:
-        device_info = sd.query_devices(device_id)
-        if 'default_samplerate' in device_info:
-            return int(device_info['default_samplerate'])
-        return DEFAULT_SAMPLE_RATE
-    except Exception:
-        return DEFAULT_SAMPLE_RATE
-
-def udp_keepalive_loop(sock, target, stop_event):
-    while not stop_event.is_set():
-        try:
-            sock.sendto(b'KEEPALIVE', target)
-        except:
-            pass
-        for _ in range(20):  # ждём 2 секунды с проверкой остановки
-            if stop_event.is_set():
+    def send_pending(self):
+        """Packetize, encode and send every block waiting in the send ring."""
+        ring = self.send_ring
+        ring.wake_pending = False
+        while True:
+            block = ring.peek()
+            if block is None:
                 break
-            time.sleep(0.1)
+            if self.resampler is None:
+                self._send_block(block)
+                ring.release()
+                continue
+            self.input_fifo.push(self.resampler.process(block))
+            ring.release()
+            while self.input_fifo.count >= self.frame.size:
+                self._send_block(self.input_fifo.pop(self.frame))
+
+    def _send_block(self, pcm):
+        if self.transport is not None and not self.transport.is_closing():
+            self._send_dtx(pcm)
+        # The timestamp keeps running through DTX pauses
+        self.timestamp = (self.timestamp + len(pcm)) & 0xFFFFFFFF
+
+    def _send_dtx(self, pcm):
+        """Add the block to the next packet, or during silence send a comfort-noise update every cn_interval frames."""
+        if self.vad is None or self.vad.is_speech(pcm):
+            self.silent_frames = 0
+            fs = self.mesh.frame_size
+            if self.packet_frames == 0:
+                self.packet_timestamp = self.timestamp
+            self.packet_pcm[self.packet_frames * fs:(self.packet_frames + 1) * fs] = pcm
+            self.packet_frames += 1
+            if self.packet_frames >= self.rate.frames_per_packet:
+                self._flush()
+            return
+        self._flush()
+        self._send_parity(0)
+        self.silent_frames += 1
+        self.frames_suppressed += 1
+        if (self.silent_frames - 1) % self.cn_interval:
+            return
+        prefix = RELAY_HEADER.size
+        write_packet(self.cn_packet, PT_CN, self.seq, self.timestamp, self.ssrc,
+                     bytes((self.vad.noise_level(),)), prefix)
+        self._send_packet(self.cn_packet, MEDIA_HEADER.size + 1)
+        self.seq = (self.seq + 1) & 0xFFFF
+
+    def _flush(self):
+        """Send the frames collected so far, split into packet sizes every codec can encode."""
+        fs = self.mesh.frame_size
+        start = 0
+        while self.packet_frames:
+            k = max(n for n in self.rate.sizes if n <= self.packet_frames)
+            self._send_frame(self.packet_pcm[start * fs:(start + k) * fs],
+                             (self.packet_timestamp + start * fs) & 0xFFFFFFFF)
+            # Sequence numbers count packets
+            self.seq = (self.seq + 1) & 0xFFFF
+            start += k
+            self.packet_frames -= k
+
+    def _send_to(self, leg, packet, size):
+        """Send a packet written at RELAY_HEADER.size into `packet` to one leg, through the relay if needed."""
+        prefix = RELAY_HEADER.size
+        view = memoryview(packet)
+        relay_addr = self.mesh.relay_addr
+        if leg.relayed and relay_addr is not None:
+            RELAY_HEADER.pack_into(packet, 0, self.ssrc, leg.ssrc)
+            self.transport.sendto(view[:prefix + size], relay_addr)
+            if leg.peer_relayed:
+                return
+            # The relay drops packets for a peer it has no binding for; until something from the
+            # peer arrives through the relay, the direct path may still be the one that works
+        self.transport.sendto(view[prefix:prefix + size], leg.target)
+
+    def _send_packet(self, packet, size):
+        """Send a packet written at RELAY_HEADER.size into `packet` to every leg."""
+        for leg in self.mesh.legs:
+            self._send_to(leg, packet, size)
+            leg.stats.packets_sent += 1
+            leg.stats.bytes_sent += size
+
+    def _send_frame(self, pcm, timestamp):
+        mesh = self.mesh
+        rate = self.rate
+        sizes = {}
+        for leg in mesh.legs:
+            try:
+                encoder = self.encoders.get(leg.codec_name)
+                if encoder is None:
+                    codec = create_codec(leg.codec_name, mesh.sample_rate, mesh.frame_size,
+                                         self.bitrate, self.complexity)
+                    history = max((level[1] for level in rate.levels), default=0)
+                    encoder = self.encoders[leg.codec_name] = PacketEncoder(codec, history)
+                size = sizes.get(leg.codec_name)
+                if size is None:
+                    codec = encoder.codec
+                    codec.set_bitrate(rate.bitrate)
+                    payload = codec.encode(pcm)
+                    size = sizes[leg.codec_name] = encoder.write(self.seq, timestamp, self.ssrc, payload,
+                                                                 rate.redundancy)
+                    if encoder.capped:
+                        rate.shorten()
+                    if rate.parity_group:
+                        encoder.add_parity(self.seq, payload)
+                self._send_to(leg, encoder.packet, size)
+                leg.stats.packets_sent += 1
+                leg.stats.bytes_sent += size
+            except Exception as e:
+                print(f"Ошибка отправки: {e}")
+        self._send_parity(rate.parity_group)
+
+    def _send_parity(self, group):
+        """Send the parity packet of every encoder whose group has `group` packets; 0 closes open groups."""
+        for name, encoder in self.encoders.items():
+            if not encoder.parity_count or encoder.parity_count < group:
+                continue
+            size = encoder.write_parity(self.timestamp, self.ssrc)
+            for leg in self.mesh.legs:
+                if leg.codec_name == name:
+                    self._send_to(leg, encoder.parity_packet, size)
+                    leg.stats.packets_sent += 1
+                    leg.stats.bytes_sent += size
+
+    def send_reports(self):
+        """Send every leg a receiver report on what arrived from it since the last one."""
+        prefix = RELAY_HEADER.size
+        now = clock_ms()
+        for leg in self.mesh.legs:
+            st = leg.stats
+            jitter = leg.jitter.stats()
+            # Report the loss before recovery, which is what the peer's protection has to cover
+            lost = jitter['lost'] + jitter['recovered']
+            expected = jitter['received'] - jitter['late'] - jitter['duplicates'] + lost
+            interval_expected = expected - st.reported_expected
+            interval_lost = lost - st.reported_lost
+            st.reported_expected = expected
+            st.reported_lost = lost
+            fraction = 0
+            if interval_expected > 0:
+                fraction = max(0, min(255, interval_lost * 256 // interval_expected))
+            echo_ts = echo_delay = 0
+            if st.peer_report_ts is not None:
+                echo_ts = st.peer_report_ts
+                echo_delay = (now - st.peer_report_at) & 0xFFFFFFFF
+            payload = RECEIVER_REPORT.pack(fraction, jitter['lost'] & 0xFFFFFFFF,
+                                           min(0xFFFFFFFF, int(jitter['jitter_ms'] * 1000)), echo_ts, echo_delay)
+            size = write_packet(self.report, PT_RR, 0, now, self.ssrc, payload, prefix)
+            self._send_to(leg, self.report, size)
 
-async def run_client(args, stop_event, chat_recv_cb=None, chat_send_q=None, mic_rms_cb=None, speaker_rms_cb=None):
-    input_sample_rate = get_device_sample_rate(args.input_device, is_input=True)
-    output_sample_rate = get_device_sample_rate(args.output_device, is_input=False)
-    sample_rate = min(input_sample_rate, output_sample_rate)
+    def _receive_report(self, leg, timestamp, payload):
+        if len(payload) < RECEIVER_REPORT.size:
+            return
+        fraction, _lost, jitter_us, echo_ts, echo_delay = RECEIVER_REPORT.unpack_from(payload)
+        st = leg.stats
+        now = clock_ms()
+        st.remote_loss = fraction / 256
+        st.remote_jitter_ms = jitter_us / 1000
+        st.remote_report_at = time.monotonic()
+        st.peer_report_ts = timestamp
+        st.peer_report_at = now
+        if echo_ts:
+            st.rtt = ((now - echo_ts - echo_delay) & 0xFFFFFFFF) / 1000
+
+    def update_rate(self):
+        """Feed the worst leg's latest report to the rate controller."""
+        now = time.monotonic()
+        loss = 0.0
+        rtt = None
+        fresh = False
+        for leg in self.mesh.legs:
+            st = leg.stats
+            if st.remote_report_at is None or now - st.remote_report_at > REPORT_STALE:
+                continue
+            fresh = True
+            loss = max(loss, st.remote_loss)
+            if st.rtt is not None:
+                rtt = st.rtt if rtt is None else max(rtt, st.rtt)
+        if fresh:
+            self.rate.update(loss, rtt)
+
+    async def report_loop(self):
+        while True:
+            await asyncio.sleep(REPORT_INTERVAL)
+            if self.transport.is_closing():
+                return
+            self.send_reports()
+            self.update_rate()
+
+    def send_keepalive(self):
+        """Refresh the relay binding and ping every leg; the pings keep NAT mappings open and measure RTT."""
+        prefix = RELAY_HEADER.size
+        write_packet(self.ping, PT_PING, 0, clock_ms(), self.ssrc, offset=prefix)
+        direct = memoryview(self.ping)[prefix:]
+        relay_addr = self.mesh.relay_addr
+        if relay_addr is not None:
+            # Stay bound even with no relayed leg of our own: a peer that cannot hear us
+            # directly switches to the relay and needs to reach us through it
+            self.send_relay_bind()
+        for leg in self.mesh.legs:
+            # Keep probing the direct path even for relayed legs
+            self.transport.sendto(direct, leg.target)
+            if leg.relayed and relay_addr is not None:
+                RELAY_HEADER.pack_into(self.ping, 0, self.ssrc, leg.ssrc)
+                self.transport.sendto(self.ping, relay_addr)
+
+    def send_relay_bind(self):
+        """Tell the relay which address our relayed packets come from."""
+        RELAY_KEY.pack_into(self.relay_bind, RELAY_HEADER.size, self.mesh.relay_key)
+        self.transport.sendto(self.relay_bind, self.mesh.relay_addr)
+
+    async def keepalive_loop(self):
+        while not self.transport.is_closing():
+            self.send_keepalive()
+            await asyncio.sleep(KEEPALIVE_INTERVAL)
+
+    async def hole_punch(self, target):
+        punch = bytearray(MEDIA_HEADER.size)
+        write_packet(punch, PT_PUNCH, 0, 0, self.ssrc)
+        for _ in range(PUNCH_COUNT):
+            if self.transport.is_closing():
+                return
+            self.transport.sendto(punch, target)
+            await asyncio.sleep(PUNCH_INTERVAL)
+
+
+async def run_client(args, stop_event, chat_recv_cb=None, chat_send_q=None, mic_meter=None, speaker_meter=None,
+                     stats=None, stats_cb=None, stats_interval=1.0):
+    import aiohttp  # only a running call needs the signaling client; keeps `import client` light
+    backend = args.audio_backend or create_backend()
+    input_sample_rate = backend.device_sample_rate(args.input_device, is_input=True)
+    output_sample_rate = backend.device_sample_rate(args.output_device, is_input=False)
+    # Media rate we send at and announce; the devices are converted to and from it when they differ
+    sample_rate = args.sample_rate
+    if not sample_rate:
+        sample_rate = min(input_sample_rate, output_sample_rate)
+        if sample_rate not in OPUS_SAMPLE_RATES:
+            sample_rate = DEFAULT_SAMPLE_RATE
+    frame_size = frame_samples(sample_rate, args.frame_ms)
+    input_frame_size = frame_samples(input_sample_rate, args.frame_ms)
+    output_frame_size = frame_samples(output_sample_rate, args.frame_ms)
 
     print(f"INPUT DEVICE: {args.input_device}, SAMPLE RATE: {input_sample_rate} Hz")
     print(f"OUTPUT DEVICE: {args.output_device}, SAMPLE RATE: {output_sample_rate} Hz")
-    print(f"USING SAMPLE RATE: {sample_rate} Hz")
+    print(f"USING SAMPLE RATE: {sample_rate} Hz, FRAME: {args.frame_ms} ms ({frame_size} samples)")
+
+    local_codecs = available_codecs(sample_rate, args.frame_ms)
+    if args.codec == 'pcm':
+        local_codecs = ['pcm']
 
     sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
     sock.bind((args.bind_ip, args.bind_port))
     local_port = sock.getsockname()[1]
+    ssrc = new_ssrc()
 
     print('Ожидание пиров...')
 
-    peers = []
+    mesh = PeerMesh(args.id, local_codecs, sample_rate, frame_size, args.bitrate, args.complexity,
+                    output_sample_rate, output_frame_size)
+    if stats is None:
+        stats = CallStats()
+    stats.mesh = mesh
+    loop = asyncio.get_running_loop()
+
+    send_ring = SendRing(input_frame_size, max(SEND_RING_SLOTS, math.ceil(SEND_RING_MS / args.frame_ms)))
+    stats.send_ring = send_ring
+    rate = RateController(args.bitrate, args.min_bitrate, packet_sizes(args.frame_ms, args.max_frame_ms),
+                          args.max_redundancy, enabled=args.rate_control, fec=args.fec)
+    media = MediaTransport(mesh, send_ring, ssrc, args.bitrate, args.complexity, args.vad, rate, input_sample_rate)
+    stats.media = media
+    transport, _ = await loop.create_datagram_endpoint(lambda: media, sock=sock)
+
+    def wake_sender():
+        try:
+            loop.call_soon_threadsafe(media.send_pending)
+        except RuntimeError:
+            pass  # loop already closed while the input stream shuts down
+
+    send_ring.notify = wake_sender
+    keepalive_task = asyncio.create_task(media.keepalive_loop())
+    report_task = asyncio.create_task(media.report_loop())
+    punch_tasks = set()
 
     if chat_send_q is None:
         chat_send_q = queue.Queue()
 
-    async with aiohttp.ClientSession() as session:
-        async with session.ws_connect(args.server) as ws:
-            await ws.send_json({
-                'type': 'register',
-                'room': args.room,
-                'id': args.id,
-                'udp_port': local_port
-            })
-
-            async def chat_sender():
-                while True:
-                    text = await asyncio.get_event_loop().run_in_executor(None, chat_send_q.get)
-                    if text is None:
-                        break
-                    await ws.send_json({'type': 'chat', 'text': text})
-
-            chat_sender_task = asyncio.create_task(chat_sender())
-
-            got_peers = False
-
-            async def message_handler():
-                nonlocal got_peers, peers
-                async for msg in ws:
-                    if msg.type != aiohttp.WSMsgType.TEXT:
-                        continue
-                    data = json.loads(msg.data)
-                    if data.get('type') == 'peers' and data.get('peers'):
-                        peers = data['peers']
-                        got_peers = True
-                        print(f"Есть пиры: {peers}")
-                    elif data.get('type') == 'chat':
-                        print(f"[CHAT {data['from']}]: {data['text']}")
-                        if chat_recv_cb:
-                            chat_recv_cb(data['from'], data['text'])
-
-            message_handler_task = asyncio.create_task(message_handler())
-
-            while not got_peers and not stop_event.is_set():
-                await asyncio.sleep(0.1)
+    # Current websocket, resumable session token, and while rejoining after a lost session, the ids
+    # the server has announced since
+    signaling = {'ws': None, 'session': None, 'rejoined': None}
+    registered = asyncio.Event()  # set while the server knows us on the current websocket
 
-            if stop_event.is_set():
-                chat_send_q.put(None)
-                message_handler_task.cancel()
-                await chat_sender_task
-                return
+    async def chat_sender():
+        while True:
+            text = await loop.run_in_executor(None, chat_send_q.get)
+            if text is None:
+                break
+            while True:  # messages typed during a reconnect go out once it succeeds
+                await registered.wait()
+                try:
+                    await signaling['ws'].send_json({'type': 'chat', 'text': text})
+                    break
+                except (ConnectionError, RuntimeError, AttributeError):
+                    await asyncio.sleep(RECONNECT_MIN_DELAY)
 
-            if not peers:
-                print("No peers found")
-                chat_send_q.put(None)
-                message_handler_task.cancel()
-                await chat_sender_task
-                return
+    def on_legs_changed(added, removed):
+        for leg in removed:
+            print(f"Пир отключился: {leg.id} {leg.target}")
+        for leg in added:
+            print(f"Peer discovered: {leg.id} {leg.target}, codec {leg.codec_name} {leg.sample_rate} Hz, "
+                  f"starting hole-punching")
+            task = asyncio.create_task(media.hole_punch(leg.target))
+            punch_tasks.add(task)
+            task.add_done_callback(punch_tasks.discard)
+
+    def start_rejoin(grace):
+        """Our session was lost (e.g. the server restarted) and everyone registers again.
+
+        Peers are kept until they show up again or `grace` seconds pass, instead of tearing down
+        every leg that has not re-registered before us.
+        """
+        signaling['rejoined'] = set()
 
-            peer = peers[0]
-            target = (peer['ip'], int(peer['udp_port']))
-            print(f'Peer discovered: {target}, starting hole-punching')
-
-            send_q = queue.Queue()
-            sender_thread = threading.Thread(target=udp_sender_loop, args=(sock, target, send_q), daemon=True)
-            sender_thread.start()
-
-            keepalive_stop = threading.Event()
-            keepalive_thread = threading.Thread(target=udp_keepalive_loop, args=(sock, target, keepalive_stop), daemon=True)
-            keepalive_thread.start()
-
-            playback = PlaybackBuffer(speaker_rms_cb)
-            out_stream = sd.OutputStream(
-                samplerate=sample_rate,
-                channels=CHANNELS,
-                dtype=DTYPE,
-                blocksize=FRAME_SIZE,
-                device=args.output_device,
-                callback=lambda outdata, frames, time, status: playback.write(outdata)
-            )
-            out_stream.start()
-
-            in_stream = sd.InputStream(
-                samplerate=sample_rate,
-                channels=CHANNELS,
-                dtype=DTYPE,
-                blocksize=FRAME_SIZE,
-                device=args.input_device,
-                callback=lambda indata, frames, time, status:
-                    audio_input_callback(indata.copy(), frames, time, status, send_q, mic_rms_cb)
-            )
-            in_stream.start()
-
-            def udp_recv_loop(s, playback_buf):
-                expected_size = FRAME_SIZE * 2  # 1024 * 2 = 2048 байт для PCM int16
-                while True:
-                    try:
-                        data, addr = s.recvfrom(65536)
-                        # Игнорируем служебные пакеты (PING, KEEPALIVE и т.п.)
-                        if len(data) == expected_size:
-                            playback_buf.q.put(data)
-                    except Exception:
-                        break
-
-            recv_thread = threading.Thread(target=udp_recv_loop, args=(sock, playback), daemon=True)
-            recv_thread.start()
-
-            print("Hole punching: sending initial packets...")
-            for i in range(20):
-                sock.sendto(b'PING', target)
-                time.sleep(0.05)
-
-            print('Streaming audio. Press Ctrl-C to quit.')
+        def prune():
+            rejoined, signaling['rejoined'] = signaling['rejoined'], None
+            if rejoined is not None:
+                for leg in mesh.legs:
+                    if leg.id not in rejoined:
+                        on_legs_changed(*mesh.remove(leg.id))
+        loop.call_later(grace, prune)
 
+    async def handle_message(data):
+        if data.get('type') == 'peers':
+            print(f"Есть пиры: {data.get('peers')}")
+            peers = data.get('peers') or []
+            if signaling['rejoined'] is None:
+                # After a resumed session the list is unchanged, so no leg is torn down
+                on_legs_changed(*mesh.update(peers))
+            else:
+                for info in peers:
+                    signaling['rejoined'].add(info.get('id'))
+                    on_legs_changed(*mesh.add(info))
+        elif data.get('type') == 'peer_joined' and data.get('peer'):
+            if signaling['rejoined'] is not None:
+                signaling['rejoined'].add(data['peer'].get('id'))
+            on_legs_changed(*mesh.add(data['peer']))
+        elif data.get('type') == 'peer_left':
+            on_legs_changed(*mesh.remove(data.get('id')))
+        elif data.get('type') == 'relay':
+            host = urlparse(args.server).hostname
             try:
-                while not stop_event.is_set():
-                    await asyncio.sleep(0.2)
-            except KeyboardInterrupt:
-                pass
+                infos = await loop.getaddrinfo(host, int(data['port']), family=socket.AF_INET,
+                                               type=socket.SOCK_DGRAM)
+                mesh.relay_addr = infos[0][4]
+                mesh.relay_key = int(data.get('key') or 0)
+                print(f"Сервер предлагает UDP-релей: {mesh.relay_addr}")
+                # Bind right away, so peers that fall back to the relay can reach us through it
+                media.send_relay_bind()
+            except OSError as e:
+                print(f"Не удалось найти адрес релея: {e}")
+        elif data.get('type') == 'chat':
+            print(f"[CHAT {data['from']}]: {data['text']}")
+            if chat_recv_cb:
+                chat_recv_cb(data['from'], data['text'])
+
+    async def signaling_loop(session):
+        """Keep a registered websocket to the server, reconnecting with exponential backoff.
+
+        A reconnect presents the session token, so the server hands back our room slot without
+        announcing a leave/join; media keeps flowing over UDP the whole time.
+        """
+        delay = RECONNECT_MIN_DELAY
+        while not stop_event.is_set():
+            try:
+                async with session.ws_connect(args.server, heartbeat=WS_HEARTBEAT) as ws:
+                    signaling['ws'] = ws
+                    register = {
+                        'type': 'register',
+                        'room': args.room,
+                        'id': args.id,
+                        'udp_port': local_port,
+                        'codecs': local_codecs,
+                        'sample_rate': sample_rate,
+                        'ssrc': ssrc
+                    }
+                    if signaling['session'] is not None:
+                        register['session'] = signaling['session']
+                    await ws.send_json(register)
+                    async for msg in ws:
+                        if msg.type != aiohttp.WSMsgType.TEXT:
+                            continue
+                        try:
+                            data = json.loads(msg.data)
+                            if data.get('type') == 'session':
+                                if data.get('resumed'):
+                                    print('Соединение с сервером восстановлено')
+                                elif signaling['session'] is not None:
+                                    print('Сессия на сервере потеряна, регистрируемся заново')
+                                    start_rejoin(data.get('grace') or RECONNECT_MAX_DELAY)
+                                signaling['session'] = data.get('token')
+                            elif data.get('type') == 'error' and not registered.is_set():
+                                print(f"Сервер отклонил регистрацию: {data.get('message')}")
+                                break  # e.g. our old slot is still held; reconnect with backoff until it is free
+                            if data.get('type') == 'peers':
+                                registered.set()
+                                delay = RECONNECT_MIN_DELAY
+                            await handle_message(data)
+                        except Exception as e:
+                            # One bad message must not end signaling for the rest of the call
+                            print(f"Ошибка обработки сообщения сервера: {e!r}")
+            except (aiohttp.ClientError, OSError, asyncio.TimeoutError) as e:
+                print(f"Сервер недоступен: {e}")
+            except Exception as e:
+                print(f"Ошибка соединения с сервером: {e!r}")
             finally:
-                keepalive_stop.set()
-                keepalive_thread.join(timeout=1)
-                message_handler_task.cancel()
-                chat_send_q.put(None)
+                signaling['ws'] = None
+                registered.clear()
+            if stop_event.is_set():
+                break
+            wait = delay * (1 + RECONNECT_JITTER * random.random())
+            print(f"Нет соединения с сервером, переподключение через {wait:.1f} с")
+            await asyncio.sleep(wait)
+            delay = min(RECONNECT_MAX_DELAY, delay * 2)
+
+    async with aiohttp.ClientSession() as session:
+        signaling_task = asyncio.create_task(signaling_loop(session))
+        chat_sender_task = asyncio.create_task(chat_sender())
+
+        mixer = Mixer(mesh, output_frame_size, speaker_meter)
+
+        def output_callback(outdata, frames, time, status):
+            if status.output_underflow:
+                stats.output_underruns += 1
+            mixer.write(outdata)
+
+        def input_callback(indata, frames, time, status):
+            if status.input_overflow:
+                stats.input_overflows += 1
+            audio_input_callback(indata, frames, time, status, send_ring, mic_meter)
+
+        latency = 'low' if args.low_latency else None
+        out_stream = backend.output_stream(output_sample_rate, CHANNELS, DTYPE, output_frame_size,
+                                           args.output_device, output_callback, latency)
+        out_stream.start()
+
+        in_stream = backend.input_stream(input_sample_rate, CHANNELS, DTYPE, input_frame_size, args.input_device,
+                                         input_callback, latency)
+        in_stream.start()
+
+        stats.capture_ms = args.frame_ms + 1000 * (getattr(in_stream, 'latency', 0) or 0)
+        stats.playback_ms = args.frame_ms + 1000 * (getattr(out_stream, 'latency', 0) or 0)
+        # Before any peer is heard: one frame per packet, the jitter buffer at its initial target
+        print('Бюджет задержки без сети: ' + format_latency_budget(latency_budget(
+            {'packet_ms': args.frame_ms, 'rtt_ms': None,
+             'playback_latency_ms': (JITTER_MIN_DEPTH + 1) * args.frame_ms},
+            stats.capture_ms, stats.playback_ms)))
+
+        print('Streaming audio. Press Ctrl-C to quit.')
+
+        try:
+            last_report = last_stats = time.monotonic()
+            while not stop_event.is_set():
+                await asyncio.sleep(0.2)
+                now = time.monotonic()
+                switched = mesh.check_relay(now)
+                for leg in switched:
+                    print(f"Прямое соединение с {leg.id} не установлено, переключаемся на релей")
+                if stats_cb is not None and now - last_stats >= stats_interval:
+                    last_stats = now
+                    stats_cb(stats.snapshot())
+                if now - last_report >= 5:
+                    last_report = now
+                    if mesh.legs:
+                        print(f"Отправка: {rate.bitrate // 1000} кбит/с, "
+                              f"пакет {rate.frames_per_packet * args.frame_ms:g} мс, избыточность {rate.redundancy}, "
+                              f"группа чётности {rate.parity_group or '—'}")
+                    snapshot = stats.snapshot()
+                    for peer_id, st in snapshot['legs'].items():
+                        rtt = f"{st['rtt_ms']:.0f} мс" if st['rtt_ms'] is not None else '—'
+                        print(f"{peer_id}: отправлено {st['packets_sent']}, получено {st['packets_received']}, "
+                              f"потери {st['loss_fraction']:.1%}, джиттер {st['jitter_ms']:.1f} мс, RTT {rtt}, "
+                              f"буфер {st['playback_depth']} кадров ({st['playback_latency_ms']:.0f} мс), "
+                              f"цель {st['playback_target_depth']}, переупорядочено {st['reordered']}, "
+                              f"восстановлено {st['recovered']}, "
+                              f"потери у собеседника {st['remote_loss_fraction']:.1%}")
+                        print(f"{peer_id}: задержка {format_latency_budget(snapshot['latency'][peer_id])}")
+        except KeyboardInterrupt:
+            pass
+        finally:
+            keepalive_task.cancel()
+            report_task.cancel()
+            for task in punch_tasks:
+                task.cancel()
+            ws = signaling['ws']
+            if ws is not None and registered.is_set():
                 try:
-                    await asyncio.gather(chat_sender_task, return_exceptions=True)
-                except:
+                    await ws.send_json({'type': 'leave'})  # free our slot now, not after the grace period
+                except (ConnectionError, RuntimeError):
                     pass
-                send_q.put(None)
-                if in_stream:
-                    in_stream.stop()
-                if out_stream:
-                    out_stream.stop()
-                sock.close()
+            signaling_task.cancel()
+            chat_send_q.put(None)
+            # A chat message may still be waiting for a reconnect that will not come
+            await asyncio.wait([chat_sender_task], timeout=1)
+            chat_sender_task.cancel()
+            await asyncio.gather(signaling_task, chat_sender_task, return_exceptions=True)
+            if in_stream:
+                in_stream.stop()
+                in_stream.close()
+            if out_stream:
+                out_stream.stop()
+                out_stream.close()
+            mesh.clear()
+            transport.close()
 
 
 def parse_args():
@@ -259,11 +1949,43 @@ def parse_args():
     p.add_argument('--bind-port', type=int, default=0, help='Local UDP bind port (0 = auto)')
     p.add_argument('--input-device', type=int, default=None, help='Input audio device index')
     p.add_argument('--output-device', type=int, default=None, help='Output audio device index')
-    return p.parse_args()
+    p.add_argument('--codec', choices=CODEC_PREFERENCE, default='opus', help='Preferred codec (falls back to pcm)')
+    p.add_argument('--bitrate', type=int, default=DEFAULT_BITRATE, help='Opus bitrate, bit/s')
+    p.add_argument('--complexity', type=int, default=DEFAULT_COMPLEXITY, help='Opus complexity 0..10')
+    p.add_argument('--frame-ms', type=float, default=None,
+                   help=f'Frame duration, {MIN_FRAME_MS:g}..{MAX_FRAME_MS:g} ms (default {DEFAULT_FRAME_MS}, '
+                        f'{LOW_LATENCY_FRAME_MS} with --low-latency)')
+    p.add_argument('--low-latency', action='store_true',
+                   help=f'Short frames and packets (up to {LOW_LATENCY_MAX_PACKET_MS} ms), low-latency device buffers')
+    p.add_argument('--sample-rate', type=int, choices=MEDIA_SAMPLE_RATES, default=None,
+                   help='Media rate to send at (default: the devices\' rate if Opus supports it, else 48000)')
+    p.add_argument('--min-bitrate', type=int, default=MIN_BITRATE, help='Lowest Opus bitrate under loss or congestion')
+    p.add_argument('--max-frame-ms', type=float, default=None,
+                   help=f'Longest packet (several frames) under loss or congestion, up to {MAX_PACKET_MS} ms')
+    p.add_argument('--fec', choices=FEC_MODES, default='auto',
+                   help='Loss protection chosen from reported loss: red = redundant payloads, parity = XOR parity')
+    p.add_argument('--max-redundancy', type=int, default=2, help='Earlier payloads carried by each packet at most')
+    p.add_argument('--no-rate-control', dest='rate_control', action='store_false',
+                   help='Keep bitrate and packet size fixed; loss protection still follows --fec')
+    p.add_argument('--vad', choices=VAD_MODES, default='energy',
+                   help='Voice activity detection: silent frames are replaced by comfort-noise updates')
+    p.add_argument('--audio-backend', choices=BACKENDS, default='sounddevice',
+                   help='sounddevice = sound card; null and wav run without audio hardware')
+    p.add_argument('--input-wav', default=None, help='wav backend: 16-bit WAV file played as the microphone')
+    p.add_argument('--output-wav', default=None, help='wav backend: record the mixed output to this file')
+    p.add_argument('--audio-speed', type=float, default=1.0,
+                   help='null/wav backends: 1 = real time, 2 = twice as fast, 0 = as fast as possible')
+    args = p.parse_args()
+    try:
+        args.frame_ms, args.max_frame_ms = frame_settings(args.frame_ms, args.max_frame_ms, args.low_latency)
+    except ValueError as e:
+        p.error(str(e))
+    return args
 
 
 def main():
     args = parse_args()
+    args.audio_backend = create_backend(args.audio_backend, args.input_wav, args.output_wav, args.audio_speed)
     stop_event = threading.Event()
     asyncio.run(run_client(args, stop_event))
 
@@ -279,10 +2001,39 @@ def start_peer(
     stop_event,
     chat_recv_cb=None,
     chat_send_q=None,
-    mic_rms_cb=None,
-    speaker_rms_cb=None
-
+    mic_meter=None,
+    speaker_meter=None,
+    codec='opus',
+    bitrate=DEFAULT_BITRATE,
+    complexity=DEFAULT_COMPLEXITY,
+    frame_ms=None,
+    stats=None,
+    stats_cb=None,
+    stats_interval=1.0,
+    audio_backend=None,
+    vad='energy',
+    rate_control=True,
+    min_bitrate=MIN_BITRATE,
+    max_frame_ms=None,
+    max_redundancy=2,
+    fec='auto',
+    sample_rate=None,
+    low_latency=False
 ):
+    """Run a peer in a background thread.
+
+    `mic_meter` and `speaker_meter` are LevelMeter instances the audio callbacks write the input
+    and output levels to, for a UI to poll. Media statistics can be polled with `stats.snapshot()` on a CallStats passed in here, or pushed
+    to `stats_cb(snapshot)` every `stats_interval` seconds from the client's event loop thread.
+    `audio_backend` is an audio_backend instance; the sound card is used by default. With
+    `rate_control` the bitrate drops to `min_bitrate` and packets grow to `max_frame_ms` following
+    the peers' receiver reports. Loss protection (`fec` mode, up to `max_redundancy` earlier
+    payloads per packet) is chosen from the reported loss either way. `sample_rate` is the media rate to send
+    at; by default the devices' rate if Opus supports it, else 48000. `low_latency` switches the
+    defaults of `frame_ms` and `max_frame_ms` to short frames and asks the sound card for small
+    buffers; `frame_ms` outside MIN_FRAME_MS..MAX_FRAME_MS raises ValueError.
+    """
+    frame_ms, max_frame_ms = frame_settings(frame_ms, max_frame_ms, low_latency)
     class Args:
         pass
     args = Args()
@@ -293,12 +2044,27 @@ def start_peer(
     args.bind_port = int(bind_port)
     args.input_device = input_device
     args.output_device = output_device
+    args.codec = codec
+    args.bitrate = int(bitrate)
+    args.complexity = int(complexity)
+    args.frame_ms = frame_ms
+    args.sample_rate = sample_rate
+    args.audio_backend = audio_backend
+    args.vad = vad
+    args.rate_control = rate_control
+    args.min_bitrate = int(min_bitrate)
+    args.max_frame_ms = max_frame_ms
+    args.max_redundancy = int(max_redundancy)
+    args.fec = fec
+    args.low_latency = low_latency
 
     def run_peer():
         def local_chat_recv(sender, text):
             if chat_recv_cb:
                 chat_recv_cb(sender, text)
-        asyncio.run(run_client(args, stop_event, chat_recv_cb=local_chat_recv, chat_send_q=chat_send_q, mic_rms_cb=mic_rms_cb, speaker_rms_cb=speaker_rms_cb))
+        asyncio.run(run_client(args, stop_event, chat_recv_cb=local_chat_recv, chat_send_q=chat_send_q,
+                               mic_meter=mic_meter, speaker_meter=speaker_meter,
+                               stats=stats, stats_cb=stats_cb, stats_interval=stats_interval))
 
     peer_thread = threading.Thread(target=run_peer, daemon=True)
     peer_thread.start()
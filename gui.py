@@ -1,17 +1,9 @@
 # gui.py - Только клиентский интерфейс
-import os
 import sys
-import json
-import threading
-import subprocess
-import queue
-import argparse
-import tkinter as tk
-import sounddevice as sd
-from tkinter import scrolledtext, messagebox, ttk
-from client import start_peer
 
-# Если скрипт запущен с аргументом --server, запускаем сервер и выходим
+# Если скрипт запущен с аргументом --server, запускаем сервер и выходим.
+# Проверка стоит до остальных импортов: серверу нужен только aiohttp, без tkinter,
+# sounddevice и numpy, поэтому EXE в режиме сервера стартует быстро.
 if '--server' in sys.argv:
     # Импортируем server и запускаем его main с нужными аргументами
     import server
@@ -24,10 +16,78 @@ if '--server' in sys.argv:
     except (ValueError, IndexError):
         pass
     # Подменяем sys.argv для server.main()
-    sys.argv = ['server.py', '--port', str(port)]
+    relay_args = []
+    if '--relay-port' in sys.argv:
+        idx = sys.argv.index('--relay-port')
+        relay_args = sys.argv[idx:idx + 2]
+    sys.argv = ['server.py', '--port', str(port)] + relay_args
     server.main()
     sys.exit(0)
 
+import os
+import json
+import threading
+import queue
+import math
+import time
+import tkinter as tk
+from tkinter import scrolledtext, messagebox, ttk
+# client (numpy, кодеки), server (aiohttp) и sounddevice импортируются при первом использовании
+
+# Индикаторы уровня
+METER_FPS = 30  # сколько раз в секунду GUI опрашивает уровни
+METER_FLOOR_DB = -60.0  # нижний край шкалы, dBFS
+METER_RELEASE_DB = 24.0  # скорость спада полосы, дБ/с
+METER_HOLD = 1.5  # секунд держится отметка пика
+METER_YELLOW_DB = -18.0
+METER_RED_DB = -6.0
+
+
+class LevelBar(tk.Canvas):
+    """Горизонтальный индикатор уровня: полоса RMS и отметка пика с удержанием"""
+
+    def __init__(self, parent, width=120, height=12, **kwargs):
+        super().__init__(parent, width=width, height=height, bg='#202020', highlightthickness=0, **kwargs)
+        self.width = width
+        self.height = height
+        # Цветные зоны шкалы; полоса - это маска, закрывающая их справа
+        zones = ((METER_FLOOR_DB, METER_YELLOW_DB, '#00c000'), (METER_YELLOW_DB, METER_RED_DB, '#e0e000'),
+                 (METER_RED_DB, 0.0, '#e00000'))
+        for low, high, color in zones:
+            self.create_rectangle(self.x(low), 0, self.x(high), height, fill=color, width=0)
+        self.mask = self.create_rectangle(0, 0, width, height, fill='#202020', width=0)
+        self.peak_mark = self.create_line(0, 0, 0, height, fill='#ffffff', width=2, state='hidden')
+        self.level_db = METER_FLOOR_DB
+        self.peak_db = METER_FLOOR_DB
+        self.peak_time = 0.0
+        self.last = None
+
+    def x(self, db):
+        return round(self.width * (max(METER_FLOOR_DB, min(0.0, db)) - METER_FLOOR_DB) / -METER_FLOOR_DB)
+
+    def show(self, peak, rms):
+        """Показывает новые значения (доли полной шкалы): быстрый подъём, плавный спад"""
+        now = time.monotonic()
+        dt = now - self.last if self.last is not None else 0.0
+        self.last = now
+        rms_db = 20 * math.log10(rms) if rms > 0 else METER_FLOOR_DB
+        peak_db = 20 * math.log10(peak) if peak > 0 else METER_FLOOR_DB
+        self.level_db = max(rms_db, self.level_db - METER_RELEASE_DB * dt)
+        if peak_db >= self.peak_db or now - self.peak_time > METER_HOLD:
+            if peak_db >= self.peak_db:
+                self.peak_time = now
+            self.peak_db = max(peak_db, self.peak_db - METER_RELEASE_DB * dt)
+        self.coords(self.mask, self.x(self.level_db), 0, self.width, self.height)
+        x = self.x(self.peak_db)
+        self.coords(self.peak_mark, x, 0, x, self.height)
+        self.itemconfigure(self.peak_mark, state='normal' if self.peak_db > METER_FLOOR_DB else 'hidden')
+
+    def reset(self):
+        self.level_db = self.peak_db = METER_FLOOR_DB
+        self.last = None
+        self.show(0.0, 0.0)
+
+
 class VoiceChatGUI(tk.Tk):
     # Главое окно голосового чата с управлением сервером и клиентом
     def __init__(self):
@@ -38,38 +98,39 @@ class VoiceChatGUI(tk.Tk):
         # Файл конфигурации для сохранения настроек
         self.config_file = 'voice_chat_config.json'
 
-        # Состояние сервера
-        self.server_process = None
-        self.server_log_queue = queue.Queue()
+        # Состояние сервера: он работает в этом же процессе, в своём потоке с event loop;
+        # его логи и метрики приходят структурированными событиями через очередь
+        self.server = None
+        self.server_events = queue.Queue()
         
         # Состояние клиента
         self.peer_thread = None
         self.peer_stop_event = None
         self.chat_send_q = None
+        # Уровни пишут аудиопотоки клиента, GUI опрашивает их METER_FPS раз в секунду
+        self.mic_meter = None
+        self.speaker_meter = None
 
         # Тема (загружаем из конфига при запуске)
+        self.stream_linger = None
         self.dark_mode = self.load_config()
         self.colors = self.get_dark_colors() if self.dark_mode else self.get_light_colors()
         self.configure(bg=self.colors['bg'])
 
-        # Аудио устройства
+        # Аудио устройства: один бэкенд на всё время работы, он кэширует список устройств
+        # и держит потоки звуковой карты открытыми между подключениями
+        self.audio = None
+        self.input_devices = {}
+        self.output_devices = {}
         try:
-            devices = sd.query_devices()
-            self.input_devices = {}
-            for i, d in enumerate(devices):
-                if d.get('max_input_channels', 0) > 0:
-                    rate = d.get('default_samplerate', 'N/A')
-                    self.input_devices[f"{d['name']} ({rate} Гц)"] = i
-
-            self.output_devices = {}
-            for i, d in enumerate(devices):
-                if d.get('max_output_channels', 0) > 0:
-                    rate = d.get('default_samplerate', 'N/A')
-                    self.output_devices[f"{d['name']} ({rate} Гц)"] = i
+            from audio_backend import SoundDeviceBackend
+            if self.stream_linger is None:
+                self.audio = SoundDeviceBackend()
+            else:
+                self.audio = SoundDeviceBackend(linger=float(self.stream_linger))
+            self.load_devices()
         except Exception as e:
             messagebox.showerror("Ошибка аудио", str(e))
-            self.input_devices = {}
-            self.output_devices = {}
 
         # Создание интерфейса
         self.create_widgets()
@@ -79,16 +140,50 @@ class VoiceChatGUI(tk.Tk):
 
         # Запуск обновление логов сервера
         self.after(100, self.update_server_logs)
+        self.after(1000 // METER_FPS, self.update_meters)
 
         # Сохраняем настройки при закрытии окна
         self.protocol("WM_DELETE_WINDOW", self.on_closing)
 
+    def load_devices(self):
+        """Заполняет списки устройств из кэша бэкенда"""
+        self.input_devices = {}
+        self.output_devices = {}
+        for i, d in enumerate(self.audio.devices()):
+            rate = d.get('default_samplerate', 'N/A')
+            if d.get('max_input_channels', 0) > 0:
+                self.input_devices[f"{d['name']} ({rate} Гц)"] = i
+            if d.get('max_output_channels', 0) > 0:
+                self.output_devices[f"{d['name']} ({rate} Гц)"] = i
+
+    def fill_device_menu(self, menu, var, devices):
+        """Перестраивает выпадающий список устройств, сохраняя выбор, если устройство осталось"""
+        items = menu['menu']
+        items.delete(0, 'end')
+        for name in devices or ['Нет устройств']:
+            items.add_command(label=name, command=tk._setit(var, name))
+        if var.get() not in devices:
+            var.set(next(iter(devices), 'Нет устройств'))
+
+    def refresh_devices(self):
+        """Пересканирует устройства (например, после подключения гарнитуры)"""
+        if self.audio is None:
+            return
+        if (self.peer_thread and self.peer_thread.is_alive()) or not self.audio.refresh():
+            messagebox.showinfo("Информация", "Отключитесь, чтобы обновить список устройств")
+            return
+        self.load_devices()
+        self.fill_device_menu(self.input_menu, self.input_var, self.input_devices)
+        self.fill_device_menu(self.output_menu, self.output_var, self.output_devices)
+
     def load_config(self):
         """Загрузка конфигурации из файла"""
         try:
             if os.path.exists(self.config_file):
                 with open(self.config_file, 'r') as f:
                     config = json.load(f)
+                    # Сколько секунд держать звуковую карту открытой после отключения (0 — закрывать сразу)
+                    self.stream_linger = config.get('stream_linger')
                     return config.get('dark_mode', False)
         except Exception as e:
             print(f"Ошибка загрузки конфигурации: {e}")
@@ -100,6 +195,8 @@ class VoiceChatGUI(tk.Tk):
             config = {
                 'dark_mode': self.dark_mode
             }
+            if self.stream_linger is not None:
+                config['stream_linger'] = self.stream_linger
             with open(self.config_file, 'w') as f:
                 json.dump(config, f, indent=2)
         except Exception as e:
@@ -108,12 +205,16 @@ class VoiceChatGUI(tk.Tk):
     def on_closing(self):
         """Обработка закрытия окна"""
         # Останавливаем сервер если запущен
-        if self.server_process:
+        if self.server:
             self.stop_server()
 
         # Отключаем клиента если подключен
         if self.peer_stop_event:
             self.disconnect_client()
+        if self.peer_thread:
+            self.peer_thread.join(timeout=2)
+        if self.audio is not None:
+            self.audio.close()
 
         # Сохраняем конфигурацию
         self.save_config()
@@ -230,6 +331,10 @@ class VoiceChatGUI(tk.Tk):
         
         self.stop_server_btn = tk.Button(server_frame, text="⏹ Остановить сервер", command=self.stop_server, state='disabled', bg=self.colors['button_bg'], fg=self.colors['fg'])
         self.stop_server_btn.grid(row=0, column=3, padx=5, pady=5)
+
+        # Метрики сервера
+        self.server_metrics_var = tk.StringVar(value="Сервер не запущен")
+        tk.Label(server_frame, textvariable=self.server_metrics_var, bg=self.colors['frame_bg'], fg=self.colors['fg']).grid(row=1, column=0, columnspan=4, sticky='w', padx=5, pady=(0, 5))
         
         # Логи сервера
         log_frame = tk.LabelFrame(parent, text="Логи сервера", bg=self.colors['frame_bg'], fg=self.colors['fg'])
@@ -277,31 +382,26 @@ class VoiceChatGUI(tk.Tk):
         # Микрофон
         tk.Label(audio_frame, text="Микрофон:", bg=self.colors['frame_bg'], fg=self.colors['fg']).grid(row=0, column=0, sticky='w', padx=5, pady=5)
 
-        if self.input_devices:
-            self.input_var = tk.StringVar(value=list(self.input_devices.keys())[0])
-            input_menu = tk.OptionMenu(audio_frame, self.input_var, *self.input_devices.keys())
-            input_menu.grid(row=0, column=1, sticky='w', padx=5, pady=5)
-            input_menu.configure(bg=self.colors['button_bg'], fg=self.colors['fg'])
-            self.mic_indicator = tk.Canvas(audio_frame, width=20, height=20, bg='#00ff00', highlightthickness=0)
-            self.mic_indicator.grid(row=0, column=2, padx=(0, 10))
-        else:
-            self.input_var = tk.StringVar(value='Нет устройств')
-            tk.Label(audio_frame, text="Нет микрофонов", bg=self.colors['frame_bg'], fg=self.colors['fg']).grid(row=0, column=1, sticky='w', padx=5, pady=5)
+        self.input_var = tk.StringVar()
+        self.input_menu = tk.OptionMenu(audio_frame, self.input_var, '')
+        self.input_menu.grid(row=0, column=1, sticky='w', padx=5, pady=5)
+        self.input_menu.configure(bg=self.colors['button_bg'], fg=self.colors['fg'])
+        self.fill_device_menu(self.input_menu, self.input_var, self.input_devices)
+        self.mic_indicator = LevelBar(audio_frame)
+        self.mic_indicator.grid(row=0, column=2, padx=(0, 10))
 
         # Динамики
         tk.Label(audio_frame, text="Динамики:", bg=self.colors['frame_bg'], fg=self.colors['fg']).grid(row=0, column=3, sticky='w', padx=5, pady=5)
 
-        if self.output_devices:
-            self.output_var = tk.StringVar(value=list(self.output_devices.keys())[0])
-            output_menu = tk.OptionMenu(audio_frame, self.output_var, *self.output_devices.keys())
-            output_menu.grid(row=0, column=4, sticky='w', padx=5, pady=5)
-            output_menu.configure(bg=self.colors['button_bg'], fg=self.colors['fg'])
-            self.speaker_indicator = tk.Canvas(audio_frame, width=20, height=20, bg='#00ff00', highlightthickness=0)
-            self.speaker_indicator.grid(row=0, column=5, padx=(0, 10))
+        self.output_var = tk.StringVar()
+        self.output_menu = tk.OptionMenu(audio_frame, self.output_var, '')
+        self.output_menu.grid(row=0, column=4, sticky='w', padx=5, pady=5)
+        self.output_menu.configure(bg=self.colors['button_bg'], fg=self.colors['fg'])
+        self.fill_device_menu(self.output_menu, self.output_var, self.output_devices)
+        self.speaker_indicator = LevelBar(audio_frame)
+        self.speaker_indicator.grid(row=0, column=5, padx=(0, 10))
 
-        else:
-            self.output_var = tk.StringVar(value='Нет устройств')
-            tk.Label(audio_frame, text="Нет динамиков", bg=self.colors['frame_bg'], fg=self.colors['fg']).grid(row=0, column=4, sticky='w', padx=5, pady=5)
+        tk.Button(audio_frame, text="🔄", command=self.refresh_devices, bg=self.colors['button_bg'], fg=self.colors['fg']).grid(row=0, column=6, padx=5, pady=5)
         
         # Кнопки управления клиентом
         btn_frame = tk.Frame(main_frame, bg=self.colors['frame_bg'])
@@ -340,8 +440,8 @@ class VoiceChatGUI(tk.Tk):
         
 
     def start_server(self):
-        """Запуск сервера"""
-        if self.server_process:
+        """Запуск сервера в этом же процессе"""
+        if self.server:
             messagebox.showinfo("Информация", "Сервер уже запущен")
             return
 
@@ -351,93 +451,65 @@ class VoiceChatGUI(tk.Tk):
             messagebox.showerror("Ошибка", "Порт должен быть числом")
             return
 
-        # Определяем путь к текущему исполняемому файлу
-        if getattr(sys, 'frozen', False):
-            # В режиме EXE – сам exe
-            exe_path = sys.executable
-        else:
-            # В режиме разработки – python gui.py
-            exe_path = sys.executable
-            # Для разработки запускаем gui.py с аргументом --server
-            # (но тогда нужно учесть, что gui.py будет запущен снова, что нежелательно)
-            # Поэтому лучше в разработке оставить старый способ или тоже использовать эту логику.
-            # Упростим: в разработке тоже будем использовать тот же подход
-            # (т.е. запускать python gui.py --server ...)
-            # Тогда наш код выше с проверкой --server сработает.
-
-        cmd = [exe_path, '--server', '--port', str(port)]
-        if not getattr(sys, 'frozen', False):
-            # В режиме разработки нужно явно указать gui.py
-            cmd = [sys.executable, 'gui.py', '--server', '--port', str(port)]
-
-        # Запускаем сервер как подпроцесс, скрывая окно (Windows)
-        creationflags = 0
-        if sys.platform == 'win32':
-            creationflags = subprocess.CREATE_NO_WINDOW  # или DETACHED_PROCESS
-
-        self.server_process = subprocess.Popen(
-            cmd,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT,
-            text=True,
-            bufsize=1,
-            universal_newlines=True,
-            creationflags=creationflags
-        )
-
-        # Запускаем поток для чтения вывода сервера
-        threading.Thread(target=self.read_server_output, daemon=True).start()
+        from server import ServerThread
+        server = ServerThread(port, events=self.server_events)
+        try:
+            server.start()
+        except Exception as e:
+            messagebox.showerror("Ошибка", f"Не удалось запустить сервер: {e}")
+            return
+        self.server = server
 
         self.start_server_btn.config(state='disabled')
         self.stop_server_btn.config(state='normal')
         self.append_server_log(f"Сервер запущен на порту {port}\n")
 
-
     def stop_server(self):
         """Остановка сервера"""
-        if self.server_process:
-            self.server_process.terminate()
-            try:
-                self.server_process.wait(timeout=5)
-            except:
-                self.server_process.kill()
-
-            self.server_process = None
+        if self.server:
+            self.server.stop()
+            self.server = None
             self.append_server_log("Сервер остановлен\n")
+            self.server_metrics_var.set("Сервер не запущен")
 
         self.start_server_btn.config(state='normal')
         self.stop_server_btn.config(state='disabled')
 
-    def read_server_output(self):
-        """Чтение вывода сервера"""
-        try:
-            while self.server_process and self.server_process.poll() is None:
-                line = self.server_process.stdout.readline()
-                if line:
-                    self.server_log_queue.put(line)
-                else:
-                    break
-        except:
-            pass
-
     def update_server_logs(self):
-        """Обновление логов сервера в интерфейсе"""
+        """Перенос событий сервера (логи и метрики) в интерфейс"""
         try:
             while True:
-                line = self.server_log_queue.get_nowait()
-                self.append_server_log(line)
+                event = self.server_events.get_nowait()
+                if event['kind'] == 'log':
+                    self.append_server_log(self.format_server_log(event))
+                elif event['kind'] == 'metrics' and self.server:
+                    self.server_metrics_var.set(self.format_server_metrics(event))
         except queue.Empty:
             pass
 
-        # Проверяем статус процесса
-        if self.server_process and self.server_process.poll() is not None:
-            self.append_server_log(f"Сервер завершил работу (код: {self.server_process.returncode})\n")
-            self.server_process = None
+        # Проверяем, не остановился ли сервер сам
+        if self.server and not self.server.is_alive():
+            self.append_server_log("Сервер завершил работу\n")
+            self.server = None
+            self.server_metrics_var.set("Сервер не запущен")
             self.start_server_btn.config(state='normal')
             self.stop_server_btn.config(state='disabled')
 
         self.after(100, self.update_server_logs)
 
+    def format_server_log(self, event):
+        """Строка лога из события сервера"""
+        stamp = time.strftime('%H:%M:%S', time.localtime(event['time']))
+        return f"{stamp} [{event['level']}] {event['message']}\n"
+
+    def format_server_metrics(self, event):
+        """Строка состояния из метрик сервера"""
+        text = (f"Подключений: {event['connections']}, комнат: {event['rooms']}, участников: {event['peers']}, "
+                f"регистраций: {event['registrations']}, сообщений: {event['messages']}")
+        if event['relay_port'] is not None:
+            text += f", релей: {event['relay_streams']} потоков, {event['relay_packets']} пакетов"
+        return text
+
     def append_server_log(self, text):
         """Добавление текста в лог сервера"""
         self.server_log.config(state='normal')
@@ -447,6 +519,9 @@ class VoiceChatGUI(tk.Tk):
 
     def connect_client(self):
         """Подключение клиента"""
+        if self.peer_thread and self.peer_stop_event and self.peer_stop_event.is_set():
+            # Предыдущее подключение ещё закрывается: оно отдаёт потоки звуковой карты за доли секунды
+            self.peer_thread.join(timeout=1)
         if self.peer_thread and self.peer_thread.is_alive():
             messagebox.showinfo("Информация", "Клиент уже подключен")
             return
@@ -462,6 +537,9 @@ class VoiceChatGUI(tk.Tk):
         # Создаем очередь и событие остановки
         self.peer_stop_event = threading.Event()
         self.chat_send_q = queue.Queue()
+        from client import LevelMeter, start_peer
+        self.mic_meter = LevelMeter()
+        self.speaker_meter = LevelMeter()
 
         # Запуск клиента в отдельном потоке
         try:
@@ -476,8 +554,9 @@ class VoiceChatGUI(tk.Tk):
                 stop_event=self.peer_stop_event,
                 chat_recv_cb=self.on_chat_message,
                 chat_send_q=self.chat_send_q,
-                mic_rms_cb=self.on_mic_rms,
-                speaker_rms_cb=self.on_speaker_rms
+                mic_meter=self.mic_meter,
+                speaker_meter=self.speaker_meter,
+                audio_backend=self.audio
             )
 
             # Обновление интерфейса
@@ -494,10 +573,10 @@ class VoiceChatGUI(tk.Tk):
         if self.peer_stop_event:
             self.peer_stop_event.set()
         
-        if hasattr(self, 'mic_indicator'):
-            self.mic_indicator.config(bg='#00ff00')
-        if hasattr(self, 'speaker_indicator'):
-            self.speaker_indicator.config(bg='#00ff00')
+        self.mic_meter = None
+        self.speaker_meter = None
+        self.mic_indicator.reset()
+        self.speaker_indicator.reset()
         self.connect_btn.config(state='normal')
         self.disconnect_btn.config(state='disabled')
         self.client_status_var.set("Отключено")
@@ -528,32 +607,12 @@ class VoiceChatGUI(tk.Tk):
         self.chat_text.see('end')
         self.chat_text.config(state='disabled')
 
-    def on_mic_rms(self, level):
-        """Вызывается из клиента при изменении уровня микрофона"""
-        self.after(0, lambda: self.update_mic_indicator(level))
-
-    def on_speaker_rms(self, level):
-        """Вызывается из клиента при изменении уровня динамиков"""
-        self.after(0, lambda: self.update_speaker_indicator(level))
-
-    def update_mic_indicator(self, level):
-        """Обновляет цвет индикатора микрофона"""
-        color = self.get_level_color(level)
-        self.mic_indicator.config(bg=color)
-
-    def update_speaker_indicator(self, level):
-        """Обновляет цвет индикатора динамиков"""
-        color = self.get_level_color(level)
-        self.speaker_indicator.config(bg=color)
-
-    def get_level_color(self, level):
-        """Возвращает цвет в зависимости от уровня (0-100)"""
-        if level < 10:
-            return '#00ff00'  # зелёный
-        elif level < 50:
-            return '#ffff00'  # жёлтый
-        else:
-            return '#ff0000'  # красный
+    def update_meters(self):
+        """Опрашивает уровни микрофона и динамиков с частотой METER_FPS"""
+        for meter, bar in ((self.mic_meter, self.mic_indicator), (self.speaker_meter, self.speaker_indicator)):
+            if meter is not None:
+                bar.show(*meter.read())
+        self.after(1000 // METER_FPS, self.update_meters)
 
 if __name__ == '__main__':
     app = VoiceChatGUI()
@@ -0,0 +1,180 @@
+"""Sample-rate conversion for the audio path.
+
+Resampler converts a stream of int16 mono blocks by a rational factor up/down with a polyphase
+windowed-sinc filter. Filter taps are designed once per ratio and cached; for every block length
+the buffers are allocated once, and the gather indices and per-output coefficients are either
+cached per starting phase or rebuilt in place (see BlockPlan), so converting a block is one
+gather, one multiply-accumulate and one saturating copy into preallocated buffers. SampleFifo
+regroups the converted samples into blocks of a fixed length.
+"""
+import math
+
+import numpy as np
+
+TAPS_PER_PHASE = 24  # input samples each output sample is computed from (more when decimating)
+KAISER_BETA = 8.0  # window shape; about 80 dB stopband
+CUTOFF = 0.9  # passband edge as a fraction of the lower Nyquist frequency
+MAX_BLOCK_PLANS = 8  # block lengths whose buffers a resampler keeps
+MAX_PHASE_TABLES = 8  # starting phases whose tables are kept per block length; longer cycles rebuild in place
+
+_taps = {}
+
+
+def polyphase_taps(up, down, taps_per_phase=TAPS_PER_PHASE):
+    """Low-pass filter for resampling by up/down, as an (up, taps_per_phase) float32 array of phases.
+
+    Phase p holds the prototype taps p, p + up, p + 2*up, ...; each phase sums to about 1.
+    Designed once per (up, down, taps_per_phase) and cached.
+    """
+    key = (up, down, taps_per_phase)
+    phases = _taps.get(key)
+    if phases is None:
+        n = up * taps_per_phase
+        cutoff = CUTOFF * 0.5 / max(up, down)  # cycles per sample at the upsampled rate
+        m = np.arange(n) - (n - 1) / 2
+        h = 2 * cutoff * np.sinc(2 * cutoff * m) * np.kaiser(n, KAISER_BETA)
+        h *= up / h.sum()
+        phases = _taps[key] = np.ascontiguousarray(h.reshape(taps_per_phase, up).T, dtype=np.float32)
+    return phases
+
+
+class Resampler:
+    """Streaming rational resampler from `in_rate` to `out_rate` for int16 mono blocks.
+
+    process() keeps the filter history between calls, so consecutive blocks convert like one
+    continuous signal. The returned array is a view of an internal buffer, valid until the next
+    call. Over time the output has exactly out_rate/in_rate times as many samples as the input,
+    but a single block may come out one sample shorter or longer.
+    """
+
+    def __init__(self, in_rate, out_rate, taps_per_phase=TAPS_PER_PHASE):
+        g = math.gcd(in_rate, out_rate)
+        self.in_rate = in_rate
+        self.out_rate = out_rate
+        self.up = out_rate // g
+        self.down = in_rate // g
+        # When decimating, the filter must span `down/up` times more input samples for the same sharpness
+        self.taps = taps_per_phase * -(-self.down // self.up)
+        self.phases = polyphase_taps(self.up, self.down, self.taps)
+        self.offset = 0  # time of the next output sample after the block start, in upsampled samples
+        self.history = np.zeros(self.taps - 1, dtype=np.float32)
+        self.plans = {}  # block length -> BlockPlan
+
+    def process(self, block):
+        n = len(block)
+        plan = self.plans.get(n)
+        if plan is None:
+            if len(self.plans) >= MAX_BLOCK_PLANS:
+                self.plans.clear()
+            plan = self.plans[n] = BlockPlan(self, n)
+        count, idx, coef, next_offset = plan.tables(self.offset)
+        ext = plan.ext
+        h = self.taps - 1
+        ext[:h] = self.history
+        ext[h:] = block
+        self.history[:] = ext[n:]
+        gathered = plan.gathered[:count]
+        acc = plan.acc[:count]
+        out = plan.out[:count]
+        np.take(ext, idx, out=gathered, mode='clip')  # 'raise' would buffer the output
+        np.einsum('nk,nk->n', gathered, coef, out=acc)
+        np.rint(acc, out=acc)
+        np.clip(acc, -32768, 32767, out=acc)
+        np.copyto(out, acc, casting='unsafe')
+        self.offset = next_offset
+        return out
+
+
+class BlockPlan:
+    """Buffers and filter tables for converting blocks of one length.
+
+    A block starting on filter phase `offset` needs a gather index and a coefficient row per
+    output sample. Consecutive blocks of the same length run through a fixed cycle of starting
+    phases; when the cycle has at most MAX_PHASE_TABLES entries the tables of every phase are
+    kept, otherwise (44.1 kHz against 48 kHz with most block lengths) they are rebuilt for each
+    block into preallocated arrays from the per-phase coefficients, so nothing is allocated once
+    the plan exists.
+    """
+
+    def __init__(self, resampler, n):
+        up, down, taps = resampler.up, resampler.down, resampler.taps
+        self.resampler = resampler
+        self.n = n
+        most = -(-n * up // down)  # outputs of a block starting on phase 0, the most any block yields
+        self.ext = np.zeros(n + taps - 1, dtype=np.float32)  # history + block
+        self.gathered = np.zeros((most, taps), dtype=np.float32)
+        self.acc = np.zeros(most, dtype=np.float32)
+        self.out = np.zeros(most, dtype=np.int16)
+        self.cycle = down // math.gcd(n * up % down, down)  # distinct phases consecutive blocks start on
+        self.cached = {}  # offset -> (count, idx, coef, next offset), for short cycles
+        if self.cycle > MAX_PHASE_TABLES:
+            self.steps = np.arange(most, dtype=np.int64) * down
+            self.times = np.zeros(most, dtype=np.int64)
+            self.base = np.zeros(most, dtype=np.int64)
+            self.phase = np.zeros(most, dtype=np.int64)
+            self.tap_offsets = np.tile((taps - 1) - np.arange(taps, dtype=np.int64), (most, 1))
+            self.idx = np.zeros((most, taps), dtype=np.int64)
+            self.coef = np.zeros((most, taps), dtype=np.float32)
+
+    def tables(self, offset):
+        """(output count, gather index, coefficients, next block's offset) for a block starting at `offset`."""
+        tables = self.cached.get(offset)
+        if tables is not None:
+            return tables
+        r = self.resampler
+        count = max(0, -(-(self.n * r.up - offset) // r.down))  # outputs falling inside this block
+        next_offset = offset + count * r.down - self.n * r.up
+        if self.cycle > MAX_PHASE_TABLES:
+            times = self.times[:count]
+            np.add(self.steps[:count], offset, out=times)
+            base = self.base[:count]  # newest input sample of each output
+            phase = self.phase[:count]
+            np.floor_divide(times, r.up, out=base)
+            np.remainder(times, r.up, out=phase)
+            idx = self.idx[:count]
+            # Broadcasting inside a ufunc would allocate a buffer; copyto broadcasts in place
+            np.copyto(idx, base[:, None])
+            np.add(idx, self.tap_offsets[:count], out=idx)
+            coef = self.coef[:count]
+            np.take(r.phases, phase, axis=0, out=coef, mode='clip')
+            return count, idx, coef, next_offset
+        times = offset + np.arange(count, dtype=np.int64) * r.down
+        idx = (times // r.up)[:, None] + (r.taps - 1) - np.arange(r.taps)[None, :]
+        tables = self.cached[offset] = (count, idx, np.ascontiguousarray(r.phases[times % r.up]), next_offset)
+        return tables
+
+
+class SampleFifo:
+    """Preallocated int16 FIFO that regroups samples into blocks of a fixed size.
+
+    When a push does not fit, the oldest samples are discarded to make room.
+    """
+
+    def __init__(self, capacity):
+        self.buf = np.zeros(capacity, dtype=np.int16)
+        self.count = 0
+        self.overflows = 0
+
+    def push(self, samples):
+        n = len(samples)
+        if n > self.buf.size:
+            samples = samples[n - self.buf.size:]
+            n = self.buf.size
+        excess = self.count + n - self.buf.size
+        if excess > 0:
+            self.overflows += 1
+            self.buf[:self.count - excess] = self.buf[excess:self.count]
+            self.count -= excess
+        self.buf[self.count:self.count + n] = samples
+        self.count += n
+
+    def pop(self, out):
+        """Move the oldest len(out) samples (or all there are) into `out`; returns the filled part of it."""
+        n = min(len(out), self.count)
+        out[:n] = self.buf[:n]
+        self.buf[:self.count - n] = self.buf[n:self.count]
+        self.count -= n
+        return out[:n]
+
+    def clear(self):
+        self.count = 0
@@ -1,97 +1,1171 @@
 import argparse
 import asyncio
+import bisect
 import json
 import logging
-from aiohttp import web, WSMsgType
+import multiprocessing
+import queue
+import secrets
+import signal
+import socket
+import struct
+import threading
+import time
+from aiohttp import web, WSMsgType, WSCloseCode
 
 # Minimal INFO logging for server events
 logging.basicConfig(level=logging.INFO, format='[%(levelname)s] %(message)s')
 
-rooms = {}  # room -> list of peers ({'id', 'ws', 'udp_port', 'remote'})
+# Outbound signaling queues
+SEND_QUEUE_SIZE = 256  # messages per connection
+SLOW_CONSUMER_POLICIES = ('drop', 'disconnect')
+OUTBOX_REPORT_INTERVAL = 30  # seconds
+
+# Session resumption: a peer whose websocket dropped keeps its room slot this long
+SESSION_GRACE = 15  # seconds
+
+# Metrics
+FANOUT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1)  # seconds
+ROOM_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512)
+METRICS_PUSH_INTERVAL = 5  # seconds, workers -> directory hub
+METRICS_EVENT_INTERVAL = 1  # seconds between metric events of an embedded server
+
+MESSAGE_TYPES = ('register', 'list', 'chat', 'leave')  # other types are counted as 'other'
+
+chat_log = logging.getLogger('rendezvous.chat')
+LOG_FIELDS = ('event', 'room', 'peer', 'text')  # `extra` fields copied into JSON log records
+
+
+def log_entry(record):
+    """Log record as a dict: time, level, logger, message and the LOG_FIELDS it carries."""
+    entry = {'time': round(record.created, 3), 'level': record.levelname, 'logger': record.name,
+             'message': record.getMessage()}
+    for field in LOG_FIELDS:
+        if hasattr(record, field):
+            entry[field] = getattr(record, field)
+    return entry
+
+
+class JsonLogFormatter(logging.Formatter):
+    def format(self, record):
+        return json.dumps(log_entry(record), ensure_ascii=False)
+
+
+class EventLogHandler(logging.Handler):
+    """Puts the records logged on one thread into a queue as {'kind': 'log', ...} events."""
+
+    def __init__(self, events, thread_id):
+        super().__init__()
+        self.events = events
+        self.thread_id = thread_id
+
+    def emit(self, record):
+        if record.thread != self.thread_id:
+            return
+        try:
+            self.events.put_nowait({'kind': 'log', **log_entry(record)})
+        except Exception:
+            self.handleError(record)
+
+
+def setup_logging(log_format='text'):
+    if log_format == 'json':
+        handler = logging.StreamHandler()
+        handler.setFormatter(JsonLogFormatter())
+        logging.getLogger().handlers[:] = [handler]
+
+# Directory hub link between worker processes (JSON lines over a local TCP socket)
+HUB_LINE_LIMIT = 4 * 1024 * 1024  # bytes, large enough for any chat message
+HUB_ASK_TIMEOUT = 2.0  # seconds the hub waits for a worker to hand over a claimed session or free a slot
+
+
+class Outbox:
+    """Bounded outbound queue of one websocket, drained by its own writer task.
+
+    send() never waits. When the queue is full the message is dropped, or the connection is
+    closed under the 'disconnect' policy, so one stalled client cannot delay the rest of the room.
+    """
+
+    def __init__(self, ws, maxsize=SEND_QUEUE_SIZE, policy='drop', registry=None, metrics=None):
+        self.ws = ws
+        self.policy = policy
+        self.queue = asyncio.Queue(maxsize)
+        self.dropped = 0
+        self.closing = False
+        self.registry = registry if registry is not None else set()
+        self.metrics = metrics
+        self.task = asyncio.create_task(self._writer())
+        self.registry.add(self)
+
+    @property
+    def depth(self):
+        return self.queue.qsize()
+
+    def send(self, text):
+        try:
+            self.queue.put_nowait(text)
+            return True
+        except asyncio.QueueFull:
+            self.dropped += 1
+            if self.metrics is not None:
+                self.metrics.dropped.inc()
+            if self.policy == 'disconnect' and not self.closing:
+                self.closing = True
+                logging.warning(f'Disconnecting slow consumer ({self.depth} queued messages)')
+                asyncio.create_task(self._disconnect())
+            elif self.dropped == 1:
+                logging.warning('Outbound queue full, dropping messages for a slow consumer')
+            return False
+
+    def send_json(self, msg):
+        return self.send(json.dumps(msg))
+
+    async def close(self):
+        self.registry.discard(self)
+        self.task.cancel()
+        await asyncio.gather(self.task, return_exceptions=True)
+
+    async def _writer(self):
+        while True:
+            text = await self.queue.get()
+            try:
+                await self.ws.send_str(text)
+            except Exception:
+                if self.metrics is not None:
+                    self.metrics.send_errors.inc()
+                return
+
+    async def _disconnect(self):
+        await self.close()
+        await self.ws.close(code=WSCloseCode.POLICY_VIOLATION, message=b'slow consumer')
+
+
+async def outbox_report_loop(outboxes, metrics):
+    last_dropped = 0
+    while True:
+        await asyncio.sleep(OUTBOX_REPORT_INTERVAL)
+        depths = [o.depth for o in outboxes]
+        dropped = metrics.dropped.value()
+        if any(depths) or dropped != last_dropped:
+            logging.info(f'Outbound queues: {len(depths)} connections, {sum(depths)} queued, '
+                         f'max depth {max(depths, default=0)}, {dropped} dropped')
+        last_dropped = dropped
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.values = {}  # label values -> count
+
+    def inc(self, amount=1, labels=()):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def value(self, labels=()):
+        return self.values.get(labels, 0)
+
+    def samples(self):
+        if not self.values and not self.labelnames:
+            return [(self.name, {}, 0)]
+        return [(self.name, dict(zip(self.labelnames, k)), v) for k, v in self.values.items()]
+
+
+class Gauge:
+    """Gauge read from a callback at scrape time, so the hot path never updates it."""
+    kind = 'gauge'
+
+    def __init__(self, name, help, fn):
+        self.name = name
+        self.help = help
+        self.fn = fn
+
+    def samples(self):
+        return [(self.name, {}, self.fn())]
+
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name, help, buckets):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def samples(self):
+        out = []
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            out.append((self.name + '_bucket', {'le': repr(float(bound))}, total))
+        total += self.counts[-1]
+        out.append((self.name + '_bucket', {'le': '+Inf'}, total))
+        out.append((self.name + '_sum', {}, self.sum))
+        out.append((self.name + '_count', {}, total))
+        return out
+
+
+class ServerMetrics:
+    """Counters and histograms of one server process, exported on /metrics in Prometheus text format."""
+
+    def __init__(self, app):
+        self.app = app
+        self.registrations = Counter('rendezvous_registrations_total', 'Successful room registrations')
+        self.messages = Counter('rendezvous_messages_total', 'Websocket messages received, by type', ('type',))
+        self.send_errors = Counter('rendezvous_send_errors_total', 'Websocket sends that failed')
+        self.dropped = Counter('rendezvous_outbox_dropped_total', 'Messages dropped for slow consumers')
+        self.resumes = Counter('rendezvous_session_resumes_total', 'Peers that reconnected within the grace period')
+        self.expired = Counter('rendezvous_sessions_expired_total', 'Dropped peers that did not come back in time')
+        self.fanout = Histogram('rendezvous_fanout_seconds', 'Time to queue one room message on all local members',
+                                FANOUT_BUCKETS)
+        self.metrics = [
+            Gauge('rendezvous_websockets_active', 'Open websocket connections', lambda: len(app['outboxes'])),
+            Gauge('rendezvous_rooms', 'Rooms with members on this process', lambda: len(app['rooms'].rooms)),
+            Gauge('rendezvous_outbox_depth', 'Messages queued on all outboxes',
+                  lambda: sum(o.depth for o in app['outboxes'])),
+            Gauge('rendezvous_sessions_detached', 'Peers in their grace period without a websocket',
+                  lambda: sum(1 for p in app['sessions'].values() if p['outbox'] is None)),
+            self.registrations, self.messages, self.send_errors, self.dropped, self.resumes, self.expired,
+            self.fanout,
+        ]
+
+    def collect(self, labels=None):
+        """Return metric families as JSON-friendly lists [name, kind, help, samples]."""
+        room_sizes = Histogram('rendezvous_room_peers', 'Members per room on this process', ROOM_SIZE_BUCKETS)
+        for members in self.app['rooms'].rooms.values():
+            room_sizes.observe(len(members))
+        families = [family(m, labels) for m in self.metrics + [room_sizes]]
+        relay = self.app['directory'].relay if isinstance(self.app['directory'], MemoryDirectory) else None
+        if relay is not None:
+            families += relay_families(relay, labels)
+        return families
+
+
+def family(metric, labels=None):
+    extra = labels or {}
+    return [metric.name, metric.kind, metric.help,
+            [[name, {**extra, **sample_labels}, value] for name, sample_labels, value in metric.samples()]]
+
+
+def relay_families(relay, labels=None):
+    counters = []
+    for name, help, value in (
+            ('rendezvous_relay_packets_total', 'Datagrams forwarded by the UDP relay', relay.packets),
+            ('rendezvous_relay_bytes_total', 'Payload bytes forwarded by the UDP relay', relay.bytes),
+            ('rendezvous_relay_dropped_total', 'Datagrams the UDP relay refused to forward', relay.dropped)):
+        counter = Counter(name, help)
+        counter.inc(value)
+        counters.append(family(counter, labels))
+    gauge = Gauge('rendezvous_relay_streams', 'SSRCs bound on the UDP relay',
+                  lambda: sum(len(t) for t in relay.tables.values()))
+    return counters + [family(gauge, labels)]
+
+
+def render_metrics(families):
+    """Render families (possibly from several processes) in the Prometheus text exposition format."""
+    merged = {}
+    for name, kind, help, samples in families:
+        merged.setdefault(name, [kind, help, []])[2].extend(samples)
+    lines = []
+    for name, (kind, help, samples) in merged.items():
+        lines.append(f'# HELP {name} {help}')
+        lines.append(f'# TYPE {name} {kind}')
+        for sample_name, labels, value in samples:
+            if labels:
+                label_text = ','.join(f'{k}="{_escape_label(v)}"' for k, v in labels.items())
+                lines.append(f'{sample_name}{{{label_text}}} {value}')
+            else:
+                lines.append(f'{sample_name} {value}')
+    return '\n'.join(lines) + '\n'
+
+
+def _escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class RoomRegistry:
+    """Connections of this process, rooms keyed by name and members keyed by peer id (O(1) join/leave).
+
+    Peers are dicts {'id', 'outbox', 'room', 'ssrc', 'info', 'backlog', 'session', 'expiry',
+    'relay_key'}; 'info' is the public part sent to other members and is built once at
+    registration, 'relay_key' is only ever sent to the peer itself. While a peer has no websocket
+    ('outbox' is None, see detach_peer) messages wait in its backlog. Which peers exist
+    server-wide is the job of the room directory.
+    """
+
+    def __init__(self):
+        self.rooms = {}  # room -> {peer id: peer}
+
+    def join(self, peer):
+        """Add the peer to its room; returns False if the id is already taken there."""
+        members = self.rooms.setdefault(peer['room'], {})
+        if peer['id'] in members:
+            return False
+        members[peer['id']] = peer
+        return True
+
+    def leave(self, peer):
+        """Remove the peer; returns False if it was not (or no longer) a member."""
+        members = self.rooms.get(peer['room'])
+        if not members or members.get(peer['id']) is not peer:
+            return False
+        del members[peer['id']]
+        if not members:
+            del self.rooms[peer['room']]
+        return True
+
+    def members(self, room):
+        return self.rooms.get(room, {}).values()
+
+    def get(self, room, peer_id):
+        return self.rooms.get(room, {}).get(peer_id)
+
+    def names(self):
+        return list(self.rooms)
+
+
+class MemoryDirectory:
+    """Server-wide room directory kept in this process.
+
+    Holds the public info of every member, enforces unique ids per room and hands every
+    published message to `deliver(room, text, exclude_id)`, which fans it out to local
+    connections. A single-process server uses it directly; with --workers the DirectoryHub
+    runs one on behalf of all workers. When the UDP relay runs next to the directory, it is
+    kept in sync with room membership here.
+
+    Session tokens are recorded here as well, so that a peer can resume its session through
+    any process sharing the directory (see claim_session).
+    """
+
+    def __init__(self):
+        self.rooms = {}  # room -> {peer id: info}
+        self.sessions = {}  # token -> (room, peer id, relay key)
+        self.session_tokens = {}  # (room, peer id) -> token
+        self.relay = None
+        self.deliver = None
+
+    async def start(self, deliver, drop=None, evict=None):
+        self.deliver = deliver
+
+    async def close(self):
+        pass
+
+    async def join(self, room, info, relay_key=None):
+        """Add a member; returns the info of the other members, or None if the id is taken.
+
+        With the relay running, the SSRC must be free server-wide as well; `relay_key` is the
+        secret the member's binding packets have to carry.
+        """
+        members = self.rooms.get(room, {})
+        if info['id'] in members:
+            return None
+        if self.relay is not None and isinstance(info.get('ssrc'), int):
+            if not self.relay.register(info['ssrc'], room, relay_key):
+                return None
+        others = list(members.values())
+        self.rooms.setdefault(room, members)[info['id']] = info
+        return others
+
+    async def leave(self, room, peer_id):
+        """Remove a member, end its session and announce it to the room as left."""
+        members = self.rooms.get(room)
+        if not members or peer_id not in members:
+            return
+        info = members.pop(peer_id)
+        if not members:
+            del self.rooms[room]
+        token = self.session_tokens.pop((room, peer_id), None)
+        if token is not None:
+            del self.sessions[token]
+        if self.relay is not None and isinstance(info.get('ssrc'), int):
+            self.relay.unregister(info['ssrc'], room)
+        self.publish(room, json.dumps({'type': 'peer_left', 'id': peer_id}))
+
+    def add_session(self, token, room, peer_id, relay_key=None):
+        if peer_id in self.rooms.get(room, ()):
+            self.sessions[token] = (room, peer_id, relay_key)
+            self.session_tokens[(room, peer_id)] = token
+
+    def session(self, token, room, peer_id):
+        """{'info', 'relay_key'} of the member holding session `token`, or None if it does not match."""
+        entry = self.sessions.get(token)
+        if entry is None or entry[0] != room or entry[1] != peer_id:
+            return None
+        return {'info': self.rooms[room][peer_id], 'relay_key': entry[2]}
+
+    async def claim_session(self, token, room, peer_id, attach):
+        """Take over the room slot of session `token` for this process.
+
+        `attach(record)` builds the local peer from {'info', 'relay_key', 'backlog'} and returns
+        it; it runs before any later room message is delivered here. Returns that peer, or None
+        if there is no such session. In a single process the session's peer is always local
+        already, so this only matters behind a DirectoryHub.
+        """
+        record = self.session(token, room, peer_id)
+        if record is None:
+            return None
+        return attach({**record, 'backlog': []})
+
+    async def evict_detached(self, room, peer_id):
+        """Free the slot of `peer_id` if another process keeps it detached; returns whether it did.
+
+        In a single process every detached slot is local and freed by the caller itself.
+        """
+        return False
+
+    def publish(self, room, text, exclude=None):
+        if self.deliver is not None:
+            self.deliver(room, text, exclude)
+
+    async def room_names(self):
+        return list(self.rooms)
+
+    async def members(self, room):
+        """Public info of every member of the room."""
+        return list(self.rooms.get(room, {}).values())
+
+    def push_metrics(self, families):
+        pass
+
+    async def cluster_metrics(self):
+        """Metric families of other processes sharing this directory; none in a single process."""
+        return []
+
+
+class DirectoryHub:
+    """Shares one MemoryDirectory between worker processes over a local TCP socket.
+
+    Workers send join/leave/publish/rooms/members requests as JSON lines; every published message is
+    pushed back to all workers, which deliver it to their own members. Every member belongs to
+    the worker it joined through, and only that worker's leave removes it. Peers of a worker whose
+    connection drops are removed and announced as left.
+
+    A session resumed through another worker moves there (claim): the hub asks the old worker to
+    drop its copy and hand over the backlog, holds the room's messages meanwhile, and replies to
+    the new worker with both. A fresh registration for an id whose slot another worker keeps
+    detached asks that worker to free it (evict).
+    """
+
+    def __init__(self, directory=None):
+        self.directory = directory or MemoryDirectory()
+        self.workers = set()
+        self.worker_metrics = {}  # writer -> families last pushed by that worker
+        self.owners = {}  # (room, peer id) -> writer of the worker serving that member
+        self.holds = {}  # room -> {peer id: messages published while its session moves between workers}
+        self.asks = {}  # request id -> future of a worker's answer to the hub
+        self.next_ask = 0
+        self.tasks = set()
+        self.server = None
+
+    async def start(self, host='127.0.0.1', port=0):
+        """Start listening and return the port workers should connect to."""
+        await self.directory.start(self._deliver)
+        self.server = await asyncio.start_server(self._handle_worker, host, port, limit=HUB_LINE_LIMIT)
+        return self.server.sockets[0].getsockname()[1]
+
+    async def close(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+        for writer in list(self.workers):
+            writer.close()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+
+    def _deliver(self, room, text, exclude):
+        line = (json.dumps({'op': 'deliver', 'room': room, 'text': text, 'exclude': exclude}) + '\n').encode()
+        for writer in self.workers:
+            writer.write(line)
+        held = self.holds.get(room)
+        if held:
+            for peer_id, texts in held.items():
+                if peer_id != exclude:
+                    texts.append(text)
+
+    async def _handle_worker(self, reader, writer):
+        task = asyncio.current_task()
+        self.tasks.add(task)
+        self.workers.add(writer)
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                req = json.loads(line)
+                op = req.get('op')
+                if op == 'join':
+                    others = await self.directory.join(req['room'], req['info'], req.get('relay_key'))
+                    if others is not None:
+                        self.owners[(req['room'], req['info']['id'])] = writer
+                    self._reply(writer, req, others)
+                elif op == 'leave':
+                    # A worker whose peer has just been claimed elsewhere may still send its leave
+                    if self.owners.get((req['room'], req['id'])) is writer:
+                        del self.owners[(req['room'], req['id'])]
+                        await self.directory.leave(req['room'], req['id'])
+                elif op == 'publish':
+                    self.directory.publish(req['room'], req['text'], req.get('exclude'))
+                elif op == 'session':
+                    if self.owners.get((req['room'], req['id'])) is writer:
+                        self.directory.add_session(req['token'], req['room'], req['id'], req.get('relay_key'))
+                elif op == 'claim':
+                    self._spawn(self._claim(writer, req))
+                elif op == 'evict':
+                    self._spawn(self._evict(writer, req))
+                elif op == 'answer':
+                    fut = self.asks.pop(req['req'], None)
+                    if fut is not None and not fut.done():
+                        fut.set_result(req['result'])
+                elif op == 'rooms':
+                    self._reply(writer, req, await self.directory.room_names())
+                elif op == 'members':
+                    self._reply(writer, req, await self.directory.members(req['room']))
+                elif op == 'metrics':
+                    self.worker_metrics[writer] = req['families']
+                elif op == 'cluster_metrics':
+                    self._reply(writer, req, self._cluster_metrics(exclude=writer))
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError) as e:
+            logging.warning(f'Directory hub: worker link failed: {e}')
+        finally:
+            self.tasks.discard(task)
+            self.workers.discard(writer)
+            self.worker_metrics.pop(writer, None)
+            for key in [key for key, owner in self.owners.items() if owner is writer]:
+                del self.owners[key]
+                await self.directory.leave(*key)
+            writer.close()
+
+    def _spawn(self, coro):
+        task = asyncio.ensure_future(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def _claim(self, writer, req):
+        """Move the member holding session req['token'] to the worker behind `writer`."""
+        room, peer_id = req['room'], req['id']
+        record = self.directory.session(req['token'], room, peer_id)
+        owner = self.owners.get((room, peer_id))
+        if record is None or owner is None or owner is writer:
+            self._reply(writer, req, None)
+            return
+        # From here on the old worker's leave is ignored, and messages for the peer are held until
+        # the new worker has it. Whatever was published earlier is in the old worker's backlog.
+        self.owners[(room, peer_id)] = writer
+        held = self.holds.setdefault(room, {})[peer_id] = []
+        backlog = await self._ask(owner, {'op': 'drop', 'room': room, 'id': peer_id})
+        if backlog is None:
+            logging.warning(f'Directory hub: no backlog for {peer_id} from its old worker')
+            backlog = []
+        del self.holds[room][peer_id]
+        if not self.holds[room]:
+            del self.holds[room]
+        if writer in self.workers:
+            self._reply(writer, req, {**record, 'backlog': backlog + held})
+        elif self.owners.get((room, peer_id)) is writer:
+            # The new worker went away in the meantime
+            del self.owners[(room, peer_id)]
+            await self.directory.leave(room, peer_id)
+
+    async def _evict(self, writer, req):
+        """Ask the worker holding req['id'] to free the slot if it is detached; replies whether it did."""
+        owner = self.owners.get((req['room'], req['id']))
+        evicted = False
+        if owner is not None and owner is not writer:
+            # The owner sends its leave before answering, so the slot is free once the answer is in
+            evicted = bool(await self._ask(owner, {'op': 'evict', 'room': req['room'], 'id': req['id']}))
+        if writer in self.workers:
+            self._reply(writer, req, evicted)
+
+    async def _ask(self, worker, msg):
+        """Send a request to a worker and wait for its answer; None if it does not answer in time."""
+        if worker not in self.workers:
+            return None
+        self.next_ask += 1
+        ask_id = msg['req'] = self.next_ask
+        fut = self.asks[ask_id] = asyncio.get_running_loop().create_future()
+        worker.write((json.dumps(msg) + '\n').encode())
+        try:
+            return await asyncio.wait_for(fut, HUB_ASK_TIMEOUT)
+        except asyncio.TimeoutError:
+            return None
+        finally:
+            self.asks.pop(ask_id, None)
+
+    def _cluster_metrics(self, exclude=None):
+        families = [f for w, fs in self.worker_metrics.items() if w is not exclude for f in fs]
+        if self.directory.relay is not None:
+            families += relay_families(self.directory.relay)
+        return families
+
+    @staticmethod
+    def _reply(writer, req, result):
+        writer.write((json.dumps({'op': 'reply', 'req': req['req'], 'result': result}) + '\n').encode())
+
+
+class SocketDirectory:
+    """Worker side of the DirectoryHub link; same interface as MemoryDirectory."""
+
+    def __init__(self, port, host='127.0.0.1'):
+        self.host = host
+        self.port = port
+        self.reader = None
+        self.writer = None
+        self.deliver = None
+        self.drop = None
+        self.evict = None
+        self.pending = {}  # request id -> future
+        self.attach = {}  # claim request id -> attach callback
+        self.next_req = 0
+        self.task = None
+        self.closing = False
+
+    async def start(self, deliver, drop=None, evict=None):
+        """`drop(room, peer_id)` forgets a local peer whose session another worker claimed and
+        returns its backlog; coroutine `evict(room, peer_id)` removes a local peer if its slot is
+        detached and returns whether it did."""
+        self.deliver = deliver
+        self.drop = drop
+        self.evict = evict
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port, limit=HUB_LINE_LIMIT)
+        self.task = asyncio.create_task(self._read_loop())
+
+    async def close(self):
+        self.closing = True
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+        if self.writer is not None:
+            self.writer.close()
+
+    async def join(self, room, info, relay_key=None):
+        return await self._request({'op': 'join', 'room': room, 'info': info, 'relay_key': relay_key})
+
+    async def leave(self, room, peer_id):
+        self._send({'op': 'leave', 'room': room, 'id': peer_id})
+
+    def publish(self, room, text, exclude=None):
+        self._send({'op': 'publish', 'room': room, 'text': text, 'exclude': exclude})
+
+    def add_session(self, token, room, peer_id, relay_key=None):
+        self._send({'op': 'session', 'token': token, 'room': room, 'id': peer_id, 'relay_key': relay_key})
+
+    async def evict_detached(self, room, peer_id):
+        return await self._request({'op': 'evict', 'room': room, 'id': peer_id})
+
+    async def claim_session(self, token, room, peer_id, attach):
+        return await self._request({'op': 'claim', 'token': token, 'room': room, 'id': peer_id}, attach)
+
+    async def room_names(self):
+        return await self._request({'op': 'rooms'})
+
+    async def members(self, room):
+        return await self._request({'op': 'members', 'room': room})
+
+    def push_metrics(self, families):
+        self._send({'op': 'metrics', 'families': families})
+
+    async def cluster_metrics(self):
+        """Families last pushed by the other workers, plus the relay running next to the hub."""
+        return await self._request({'op': 'cluster_metrics'})
+
+    def _send(self, msg):
+        self.writer.write((json.dumps(msg) + '\n').encode())
+
+    async def _request(self, msg, attach=None):
+        """Send a request and wait for its result; `attach(result)` runs in the read loop as soon as
+        the reply arrives, before any room message behind it is delivered, and replaces the result."""
+        self.next_req += 1
+        msg['req'] = self.next_req
+        fut = asyncio.get_running_loop().create_future()
+        self.pending[self.next_req] = fut
+        if attach is not None:
+            self.attach[self.next_req] = attach
+        self._send(msg)
+        return await fut
+
+    async def _read_loop(self):
+        try:
+            while True:
+                line = await self.reader.readline()
+                if not line:
+                    break
+                msg = json.loads(line)
+                if msg['op'] == 'deliver':
+                    self.deliver(msg['room'], msg['text'], msg.get('exclude'))
+                elif msg['op'] == 'reply':
+                    result = msg['result']
+                    attach = self.attach.pop(msg['req'], None)
+                    if attach is not None and result is not None:
+                        result = attach(result)
+                    fut = self.pending.pop(msg['req'], None)
+                    if fut is not None and not fut.done():
+                        fut.set_result(result)
+                elif msg['op'] == 'drop':
+                    backlog = self.drop(msg['room'], msg['id']) if self.drop is not None else []
+                    self._send({'op': 'answer', 'req': msg['req'], 'result': backlog})
+                elif msg['op'] == 'evict':
+                    evicted = await self.evict(msg['room'], msg['id']) if self.evict is not None else False
+                    self._send({'op': 'answer', 'req': msg['req'], 'result': evicted})
+        finally:
+            if not self.closing:
+                logging.error('Lost connection to the directory hub')
+            for fut in self.pending.values():
+                if not fut.done():
+                    fut.set_exception(ConnectionError('directory hub unavailable'))
+            self.pending.clear()
+            self.attach.clear()
+
+
+# Relayed datagrams are prefixed with the sender and destination SSRC; destination 0 only binds the sender
+RELAY_HEADER = struct.Struct('!II')
+RELAY_KEY = struct.Struct('!Q')  # follows the header of binding packets
+RELAY_REPORT_INTERVAL = 10  # seconds
+
+
+class RelayProtocol(asyncio.DatagramProtocol):
+    """TURN-like UDP relay for peers whose hole-punching failed.
+
+    Only SSRCs registered over the websocket are served, and packets are forwarded only between
+    SSRCs of the same room. A sender's address is learned only from binding packets that carry the
+    relay key the server gave that peer privately, so members who know each other's SSRCs cannot
+    redirect someone else's stream; relayed packets from any other address are dropped. The
+    payload is passed on as a memoryview slice of the received datagram, so forwarding does not
+    copy it.
+    """
+
+    def __init__(self):
+        self.transport = None
+        self.ssrc_room = {}  # ssrc -> (room, relay key), filled on websocket registration
+        self.tables = {}  # room -> {ssrc: public address}
+        self.packets = 0
+        self.bytes = 0
+        self.dropped = 0
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def register(self, ssrc, room, key):
+        """Serve `ssrc` in `room`; returns False if another member already holds it."""
+        if ssrc in self.ssrc_room:
+            return False
+        self.ssrc_room[ssrc] = (room, key)
+        return True
+
+    def unregister(self, ssrc, room):
+        entry = self.ssrc_room.get(ssrc)
+        if entry is None or entry[0] != room:
+            return
+        del self.ssrc_room[ssrc]
+        table = self.tables.get(room)
+        if table is not None:
+            table.pop(ssrc, None)
+            if not table:
+                del self.tables[room]
+
+    def datagram_received(self, data, addr):
+        if len(data) < RELAY_HEADER.size:
+            self.dropped += 1
+            return
+        src, dst = RELAY_HEADER.unpack_from(data)
+        entry = self.ssrc_room.get(src)
+        if entry is None:
+            self.dropped += 1
+            return
+        room, key = entry
+        table = self.tables.get(room)
+        if dst == 0:
+            # Binding packet: learn (or, after NAT rebinding, refresh) the sender's address
+            if len(data) < RELAY_HEADER.size + RELAY_KEY.size or \
+                    RELAY_KEY.unpack_from(data, RELAY_HEADER.size)[0] != key:
+                self.dropped += 1
+                return
+            if table is None:
+                table = self.tables[room] = {}
+            table[src] = addr
+            return
+        if table is None or table.get(src) != addr:
+            self.dropped += 1
+            return
+        target = table.get(dst)
+        if target is None:
+            self.dropped += 1
+            return
+        self.transport.sendto(memoryview(data)[RELAY_HEADER.size:], target)
+        self.packets += 1
+        self.bytes += len(data) - RELAY_HEADER.size
+
+    def error_received(self, exc):
+        logging.debug(f'Relay socket error: {exc}')
+
+
+async def relay_report_loop(proto: RelayProtocol):
+    last_packets, last_bytes, last_time = 0, 0, time.monotonic()
+    while True:
+        await asyncio.sleep(RELAY_REPORT_INTERVAL)
+        now = time.monotonic()
+        elapsed = now - last_time
+        pps = (proto.packets - last_packets) / elapsed
+        bps = (proto.bytes - last_bytes) / elapsed
+        last_packets, last_bytes, last_time = proto.packets, proto.bytes, now
+        if pps:
+            streams = sum(len(t) for t in proto.tables.values())
+            logging.info(f'Relay: {pps:.0f} pkt/s, {bps / 1024:.1f} KiB/s, {streams} bound streams, '
+                         f'{proto.dropped} dropped total')
+
+
+async def start_relay(directory, port):
+    """Start the UDP relay next to `directory`; returns the protocol and its report task."""
+    loop = asyncio.get_running_loop()
+    transport, proto = await loop.create_datagram_endpoint(RelayProtocol, local_addr=('0.0.0.0', port))
+    directory.relay = proto
+    logging.info(f'Started UDP relay on port {transport.get_extra_info("sockname")[1]}')
+    return proto, asyncio.create_task(relay_report_loop(proto))
 
 
 async def websocket_handler(request):
     ws = web.WebSocketResponse()
     await ws.prepare(request)
 
+    app = request.app
+    rooms = app['rooms']
+    directory = app['directory']
+    metrics = app['metrics']
+    outbox = Outbox(ws, app['send_queue_size'], app['slow_consumer_policy'], app['outboxes'], metrics)
     peer = None
     try:
         async for msg in ws:
             if msg.type == WSMsgType.TEXT:
                 data = json.loads(msg.data)
                 t = data.get('type')
+                metrics.messages.inc(labels=(t if t in MESSAGE_TYPES else 'other',))
                 if t == 'register':
                     room = data.get('room')
                     pid = data.get('id')
                     udp_port = data.get('udp_port')
                     if not room or not pid or udp_port is None:
-                        await ws.send_json({'type': 'error', 'message': 'missing fields'})
+                        outbox.send_json({'type': 'error', 'message': 'missing fields'})
+                        continue
+                    if peer is not None:
+                        await leave_room(app, peer)
+                        peer = None
+                    token = data.get('session')
+                    resumed = app['sessions'].get(token)
+                    if resumed is not None and (resumed['room'] != room or resumed['id'] != pid):
+                        resumed = None
+                    if resumed is None and token and not rooms.get(room, pid):
+                        # The session may be held by another worker sharing the directory
+                        resumed = await directory.claim_session(token, room, pid,
+                                                                lambda record: adopt_peer(app, token, room, record))
+                    if resumed is not None:
+                        peer = resume_peer(app, resumed, outbox)
+                        logging.info(f"Resumed session: {pid} room={room}")
+                        if app['relay_port'] is not None and isinstance(peer['ssrc'], int):
+                            outbox.send_json({'type': 'relay', 'port': app['relay_port'], 'key': peer['relay_key']})
+                        others = [info for info in await directory.members(room) if info['id'] != pid]
+                        outbox.send_json({'type': 'session', 'token': peer['session'], 'resumed': True,
+                                          'grace': app['session_grace']})
+                        outbox.send_json({'type': 'peers', 'peers': others})
+                        for text in peer['backlog']:
+                            outbox.send(text)
+                        peer['backlog'] = None
                         continue
 
                     remote_ip = request.remote
-                    peer = {'id': pid, 'ws': ws, 'udp_port': int(udp_port), 'remote': remote_ip, 'room': room}
-                    rooms.setdefault(room, []).append(peer)
+                    ssrc = data.get('ssrc')
+                    info = {
+                        'id': pid,
+                        'ip': remote_ip,
+                        'udp_port': int(udp_port),
+                        # Codec list in the client's preference order; old clients only speak PCM
+                        'codecs': data.get('codecs') or ['pcm'],
+                        'ssrc': ssrc
+                    }
+                    # Rate the client sends media at; receivers convert it to their output device
+                    if isinstance(data.get('sample_rate'), int):
+                        info['sample_rate'] = data['sample_rate']
+                    # Until the peer list is sent, messages for the new member are held in its backlog
+                    candidate = {'id': pid, 'outbox': outbox, 'room': room, 'ssrc': ssrc, 'info': info,
+                                 'backlog': [], 'session': None, 'expiry': None,
+                                 'relay_key': secrets.randbits(64)}
+                    # A client that restarted without its session token replaces its detached slot
+                    await evict_peer(app, room, pid)
+                    if not rooms.join(candidate):
+                        outbox.send_json({'type': 'error', 'message': 'id already taken in this room'})
+                        continue
+                    others = await directory.join(room, info, candidate['relay_key'])
+                    if others is None and await directory.evict_detached(room, pid):
+                        others = await directory.join(room, info, candidate['relay_key'])
+                    if others is None:
+                        rooms.leave(candidate)
+                        outbox.send_json({'type': 'error', 'message': 'id or ssrc already taken'})
+                        continue
+                    peer = candidate
+                    metrics.registrations.inc()
                     logging.info(f"Register: {pid} @ {remote_ip}:{udp_port} room={room}")
-                    await notify_room(room)
+                    if app['relay_port'] is not None and isinstance(ssrc, int):
+                        outbox.send_json({'type': 'relay', 'port': app['relay_port'], 'key': peer['relay_key']})
+                    if app['session_grace'] > 0:
+                        peer['session'] = secrets.token_urlsafe(16)
+                        app['sessions'][peer['session']] = peer
+                        directory.add_session(peer['session'], room, pid, peer['relay_key'])
+                        outbox.send_json({'type': 'session', 'token': peer['session'], 'resumed': False,
+                                          'grace': app['session_grace']})
+                    outbox.send_json({'type': 'peers', 'peers': others})
+                    for text in peer['backlog']:
+                        outbox.send(text)
+                    peer['backlog'] = None
+                    directory.publish(room, json.dumps({'type': 'peer_joined', 'peer': info}), exclude=pid)
+                elif t == 'leave':
+                    # Deliberate hang-up: free the slot now instead of after the grace period
+                    if peer is not None:
+                        await leave_room(app, peer)
+                        peer = None
                 elif t == 'list':
-                    await ws.send_json({'type': 'rooms', 'rooms': list(rooms.keys())})
+                    outbox.send_json({'type': 'rooms', 'rooms': await directory.room_names()})
                 elif t == 'chat':
-                    print("SERVER CHAT:", peer["id"], data.get("text"))
-                    room = peer['room']
+                    if peer is None:
+                        outbox.send_json({'type': 'error', 'message': 'not registered'})
+                        continue
+                    if app['log_chat']:
+                        chat_log.info(f"Chat in {peer['room']} from {peer['id']}",
+                                      extra={'event': 'chat', 'room': peer['room'], 'peer': peer['id'],
+                                             'text': data.get('text', '')})
                     msg = {
                         'type': 'chat',
                         'from': peer['id'],
                         'text': data.get('text', '')
                     }
-
-                    for p in rooms.get(room, []):
-                        if p is not peer:
-                            await p['ws'].send_json(msg)
+                    directory.publish(peer['room'], json.dumps(msg), exclude=peer['id'])
                 else:
-                    await ws.send_json({'type': 'error', 'message': 'unknown type'})
+                    outbox.send_json({'type': 'error', 'message': 'unknown type'})
             elif msg.type == WSMsgType.ERROR:
-                print('ws connection closed with exception %s' % ws.exception())
+                logging.warning(f'ws connection closed with exception {ws.exception()}')
     finally:
-        if peer:
-            room = peer.get('room')
-            if room and peer in rooms.get(room, []):
-                rooms[room].remove(peer)
-                logging.info(f"Removed peer {peer.get('id')} from room {room}")
-                if not rooms[room]:
-                    del rooms[room]
-                else:
-                    await notify_room(room)
+        # A resumed session has moved to another websocket already
+        if peer and peer['outbox'] is outbox:
+            if peer['session'] is not None:
+                detach_peer(app, peer)
+            else:
+                await leave_room(app, peer)
+        await outbox.close()
 
     return ws
 
 
-async def notify_room(room):
-    """Notify all peers in the room about other peers' public addresses."""
-    peers = rooms.get(room, [])
-    info = []
-    for p in peers:
-        info.append({'id': p['id'], 'ip': p['remote'], 'udp_port': p['udp_port']})
+def detach_peer(app, peer):
+    """Keep the room slot of a peer whose websocket closed for the session grace period.
 
-    for p in peers:
-        try:
-            await p['ws'].send_json({'type': 'peers', 'peers': [x for x in info if x['id'] != p['id']]})
-        except Exception:
-            pass
+    Room messages wait in its backlog (up to the outbox size) until the peer resumes the session
+    with its token; if it does not come back in time, it leaves the room.
+    """
+    peer['outbox'] = None
+    peer['backlog'] = []
+    logging.info(f"Peer {peer['id']} disconnected from room {peer['room']}, "
+                 f"keeping the slot for {app['session_grace']} s")
+    expire_later(app, peer)
+
+
+def expire_later(app, peer):
+    """Remove a detached peer from its room unless it resumes within the session grace period."""
+    def expire():
+        if peer['outbox'] is None:
+            app['metrics'].expired.inc()
+            asyncio.ensure_future(leave_room(app, peer))
+    peer['expiry'] = asyncio.get_running_loop().call_later(app['session_grace'], expire)
+
+
+def resume_peer(app, peer, outbox):
+    """Attach a new websocket to a peer's session; returns the peer."""
+    if peer['expiry'] is not None:
+        peer['expiry'].cancel()
+        peer['expiry'] = None
+    old = peer['outbox']
+    if old is not None and old is not outbox:
+        # The client noticed the drop before we did; its handler cleans up once the socket is closed
+        asyncio.ensure_future(old.ws.close(code=WSCloseCode.GOING_AWAY, message=b'session resumed'))
+    if peer['backlog'] is None:
+        peer['backlog'] = []
+    peer['outbox'] = outbox
+    app['metrics'].resumes.inc()
+    return peer
+
+
+async def leave_room(app, peer):
+    if peer.get('expiry') is not None:
+        peer['expiry'].cancel()
+        peer['expiry'] = None
+    if peer.get('session') is not None:
+        app['sessions'].pop(peer['session'], None)
+    if app['rooms'].leave(peer):
+        logging.info(f"Removed peer {peer['id']} from room {peer['room']}")
+        await app['directory'].leave(peer['room'], peer['id'])
+
+
+def adopt_peer(app, token, room, record):
+    """Local peer for a session claimed from another worker; returns it, detached, or None.
+
+    `record` carries the public info, relay key and backlog the directory handed over.
+    """
+    info = record['info']
+    peer = {'id': info['id'], 'outbox': None, 'room': room, 'ssrc': info.get('ssrc'), 'info': info,
+            'backlog': record['backlog'][:app['send_queue_size']], 'session': token, 'expiry': None,
+            'relay_key': record['relay_key']}
+    if not app['rooms'].join(peer):
+        asyncio.ensure_future(app['directory'].leave(room, info['id']))
+        return None
+    app['sessions'][token] = peer
+    expire_later(app, peer)  # in case the websocket that claimed it is gone before resuming
+    return peer
+
+
+async def evict_peer(app, room, peer_id):
+    """Remove a peer whose slot is detached, for a new registration with the same id; returns whether it did."""
+    peer = app['rooms'].get(room, peer_id)
+    if peer is None or peer['outbox'] is not None:
+        return False
+    logging.info(f"Peer {peer_id} registered again without its session, freeing the old slot")
+    await leave_room(app, peer)
+    return True
+
+
+def drop_peer(app, room, peer_id):
+    """Forget a peer whose session another worker has taken over; returns its backlog.
+
+    The peer stays in the room, so nothing is announced; a websocket still attached to it here
+    is closed.
+    """
+    peer = app['rooms'].get(room, peer_id)
+    if peer is None:
+        return []
+    if peer['expiry'] is not None:
+        peer['expiry'].cancel()
+        peer['expiry'] = None
+    app['sessions'].pop(peer['session'], None)
+    app['rooms'].leave(peer)
+    old = peer['outbox']
+    backlog = peer['backlog'] or []
+    peer['outbox'] = peer['backlog'] = None
+    if old is not None:
+        asyncio.ensure_future(old.ws.close(code=WSCloseCode.GOING_AWAY, message=b'session resumed'))
+    logging.info(f"Session of {peer_id} in room {room} moved to another worker")
+    return backlog
+
+
+def deliver_local(app, room, text, exclude=None):
+    """Queue an already serialized message on the outbox of every local member of the room."""
+    start = time.perf_counter()
+    for p in app['rooms'].members(room):
+        if p['id'] == exclude:
+            continue
+        if p['backlog'] is not None:
+            if len(p['backlog']) < app['send_queue_size']:
+                p['backlog'].append(text)
+        else:
+            p['outbox'].send(text)
+    app['metrics'].fanout.observe(time.perf_counter() - start)
 
 
 async def index(request):
     return web.Response(text='Rendezvous server for UDP hole-punching')
 
 
-async def create_server_runner(port: int):
-    """Create and start the aiohttp AppRunner and return it. Use this when embedding the server in another process."""
+async def metrics_handler(request):
+    app = request.app
+    families = app['metrics'].collect(app['metrics_labels'])
+    try:
+        families += await app['directory'].cluster_metrics()
+    except ConnectionError:
+        pass
+    return web.Response(text=render_metrics(families), content_type='text/plain', charset='utf-8',
+                        headers={'X-Prometheus-Format': '0.0.4'})
+
+
+async def metrics_push_loop(app):
+    """In worker mode, periodically hand this worker's metrics to the hub so any worker can serve /metrics."""
+    while True:
+        app['directory'].push_metrics(app['metrics'].collect(app['metrics_labels']))
+        await asyncio.sleep(METRICS_PUSH_INTERVAL)
+
+
+def create_app(relay_port=None, send_queue_size=SEND_QUEUE_SIZE, slow_consumer_policy='drop', directory=None,
+               log_chat=False, worker=None, session_grace=SESSION_GRACE):
+    """Build the aiohttp application.
+
+    Without `directory` the server keeps rooms in-process, and `relay_port` starts the UDP relay
+    on the same event loop. With an external directory (worker mode) the relay runs next to the
+    directory hub and `relay_port` is only announced to clients. `worker` labels this process's
+    samples on /metrics; `log_chat` logs chat messages to the 'rendezvous.chat' logger. A peer
+    whose websocket drops keeps its room slot for `session_grace` seconds and can resume its
+    session with the token it was given; 0 removes it at once.
+    """
+    if slow_consumer_policy not in SLOW_CONSUMER_POLICIES:
+        raise ValueError(f'unknown slow consumer policy: {slow_consumer_policy}')
     app = web.Application()
+    app['send_queue_size'] = send_queue_size
+    app['slow_consumer_policy'] = slow_consumer_policy
+    app['rooms'] = RoomRegistry()
+    app['directory'] = directory or MemoryDirectory()
+    app['relay_port'] = relay_port if directory is not None else None
+    app['outboxes'] = set()
+    app['log_chat'] = log_chat
+    app['session_grace'] = session_grace
+    app['sessions'] = {}  # session token -> peer, for peers registered on this process
+    app['metrics'] = ServerMetrics(app)
+    app['metrics_labels'] = {'worker': str(worker)} if worker is not None else None
     app.router.add_get('/', index)
     app.router.add_get('/ws', websocket_handler)
+    app.router.add_get('/metrics', metrics_handler)
+
+    async def start_background(app):
+        await app['directory'].start(lambda room, text, exclude: deliver_local(app, room, text, exclude),
+                                     lambda room, peer_id: drop_peer(app, room, peer_id),
+                                     lambda room, peer_id: evict_peer(app, room, peer_id))
+        app['outbox_report'] = asyncio.create_task(outbox_report_loop(app['outboxes'], app['metrics']))
+        if worker is not None:
+            app['metrics_push'] = asyncio.create_task(metrics_push_loop(app))
+        if relay_port is not None and directory is None:
+            proto, app['relay_report'] = await start_relay(app['directory'], relay_port)
+            app['relay_port'] = proto.transport.get_extra_info('sockname')[1]
+
+    async def stop_background(app):
+        for peer in app['sessions'].values():
+            if peer['expiry'] is not None:
+                peer['expiry'].cancel()  # the rooms go away with the server anyway
+        app['outbox_report'].cancel()
+        if 'metrics_push' in app:
+            app['metrics_push'].cancel()
+        if 'relay_report' in app:
+            app['relay_report'].cancel()
+            app['directory'].relay.transport.close()
+            app['directory'].relay = None
+        await app['directory'].close()
+
+    app.on_startup.append(start_background)
+    app.on_cleanup.append(stop_background)
+    return app
+
+
+async def create_server_runner(port: int, relay_port=None, send_queue_size=SEND_QUEUE_SIZE,
+                               slow_consumer_policy='drop', directory=None, log_chat=False,
+                               session_grace=SESSION_GRACE):
+    """Create and start the aiohttp AppRunner and return it. Use this when embedding the server in another process."""
+    app = create_app(relay_port, send_queue_size, slow_consumer_policy, directory, log_chat,
+                     session_grace=session_grace)
     runner = web.AppRunner(app)
     await runner.setup()
     site = web.TCPSite(runner, '0.0.0.0', port)
-    await site.start()
+    try:
+        await site.start()
+    except OSError:
+        await runner.cleanup()
+        raise
     logging.info(f'Started rendezvous server on port {port} (in-process)')
     return runner
 
@@ -105,14 +1179,180 @@ async def stop_server_runner(runner: web.AppRunner):
         pass
 
 
+def metrics_event(app):
+    """Current load of an in-process server as a {'kind': 'metrics', ...} event."""
+    metrics = app['metrics']
+    relay = app['directory'].relay if isinstance(app['directory'], MemoryDirectory) else None
+    return {
+        'kind': 'metrics',
+        'time': round(time.time(), 3),
+        'connections': len(app['outboxes']),
+        'rooms': len(app['rooms'].rooms),
+        'peers': sum(len(members) for members in app['rooms'].rooms.values()),
+        'registrations': metrics.registrations.value(),
+        'messages': sum(metrics.messages.values.values()),
+        'send_errors': metrics.send_errors.value(),
+        'dropped': metrics.dropped.value(),
+        'relay_port': app['relay_port'],
+        'relay_streams': sum(len(t) for t in relay.tables.values()) if relay is not None else 0,
+        'relay_packets': relay.packets if relay is not None else 0,
+    }
+
+
+class ServerThread:
+    """The server on its own event loop in a background thread, for embedding in a GUI.
+
+    Everything the server logs and, every `metrics_interval` seconds, a metrics_event() snapshot
+    go to the `events` queue as dicts, so the host can show them without parsing text. start()
+    returns once the port is bound and raises if it could not be; stop() shuts the server down.
+    """
+
+    def __init__(self, port, relay_port=None, events=None, metrics_interval=METRICS_EVENT_INTERVAL, **options):
+        self.port = port
+        self.relay_port = relay_port
+        self.events = events if events is not None else queue.Queue()
+        self.metrics_interval = metrics_interval
+        self.options = options  # more create_server_runner() arguments
+        self.thread = None
+        self.loop = None
+        self.stopping = None
+
+    def start(self, timeout=10):
+        started = threading.Event()
+        errors = []
+        self.thread = threading.Thread(target=self._run, args=(started, errors), name='rendezvous server',
+                                       daemon=True)
+        self.thread.start()
+        if not started.wait(timeout):
+            raise TimeoutError('the server did not start in time')
+        if errors:
+            raise errors[0]
+
+    def stop(self, timeout=5):
+        loop, thread = self.loop, self.thread
+        if loop is not None and thread is not None and thread.is_alive():
+            try:
+                loop.call_soon_threadsafe(self.stopping.set)
+            except RuntimeError:
+                pass  # the loop has just finished
+            thread.join(timeout)
+
+    def is_alive(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def _run(self, started, errors):
+        handler = EventLogHandler(self.events, threading.get_ident())
+        logging.getLogger().addHandler(handler)
+        try:
+            asyncio.run(self._serve(started, errors))
+        except Exception as e:
+            errors.append(e)
+        finally:
+            logging.getLogger().removeHandler(handler)
+            started.set()
+            self.loop = None
+
+    async def _serve(self, started, errors):
+        self.loop = asyncio.get_running_loop()
+        self.stopping = asyncio.Event()
+        try:
+            runner = await create_server_runner(self.port, self.relay_port, **self.options)
+        except Exception as e:
+            errors.append(e)
+            return
+        started.set()
+        try:
+            while not self.stopping.is_set():
+                self.events.put_nowait(metrics_event(runner.app))
+                try:
+                    await asyncio.wait_for(self.stopping.wait(), self.metrics_interval)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            await stop_server_runner(runner)
+
+
+def run_worker(index, port, hub_port, relay_port, send_queue_size, slow_consumer_policy, log_chat, log_format,
+               session_grace=SESSION_GRACE):
+    """Entry point of one worker process in --workers mode; all workers share the port via SO_REUSEPORT."""
+    setup_logging(log_format)
+    app = create_app(relay_port, send_queue_size, slow_consumer_policy, directory=SocketDirectory(hub_port),
+                     log_chat=log_chat, worker=index, session_grace=session_grace)
+    web.run_app(app, port=port, reuse_port=True, print=None)
+
+
+async def run_workers(args):
+    """Run the directory hub (and relay) in this process and serve websockets from worker processes."""
+    hub = DirectoryHub()
+    relay_report = None
+    relay_port = None
+    if args.relay_port is not None:
+        proto, relay_report = await start_relay(hub.directory, args.relay_port)
+        relay_port = proto.transport.get_extra_info('sockname')[1]
+    hub_port = await hub.start()
+
+    workers = []
+    for index in range(args.workers):
+        proc = multiprocessing.Process(
+            target=run_worker,
+            args=(index, args.port, hub_port, relay_port, args.send_queue_size, args.slow_consumer_policy,
+                  args.log_chat, args.log_format, args.session_grace),
+            daemon=True
+        )
+        proc.start()
+        workers.append(proc)
+    logging.info(f'Starting rendezvous server on port {args.port} with {args.workers} workers')
+
+    stop = asyncio.Event()
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stop.set)
+    try:
+        while not stop.is_set():
+            if not all(proc.is_alive() for proc in workers):
+                logging.error('A worker process exited, shutting down')
+                break
+            try:
+                await asyncio.wait_for(stop.wait(), 1)
+            except asyncio.TimeoutError:
+                pass
+    finally:
+        for proc in workers:
+            proc.terminate()
+        for proc in workers:
+            proc.join(timeout=5)
+        if relay_report is not None:
+            relay_report.cancel()
+            hub.directory.relay.transport.close()
+        await hub.close()
+
+
 def main():
     p = argparse.ArgumentParser()
     p.add_argument('--port', type=int, default=17789, help='Port to listen on')
+    p.add_argument('--relay-port', type=int, default=None, help='Run the UDP relay fallback on this port')
+    p.add_argument('--send-queue-size', type=int, default=SEND_QUEUE_SIZE,
+                   help='Outbound messages queued per connection before the slow consumer policy applies')
+    p.add_argument('--slow-consumer-policy', choices=SLOW_CONSUMER_POLICIES, default='drop',
+                   help='What to do when a connection\'s outbound queue is full')
+    p.add_argument('--workers', type=int, default=1, help='Worker processes sharing the port (needs SO_REUSEPORT)')
+    p.add_argument('--log-chat', action='store_true', help='Log chat messages (room, sender, text)')
+    p.add_argument('--session-grace', type=float, default=SESSION_GRACE,
+                   help='Seconds a disconnected peer keeps its room slot for reconnecting (0 = remove at once)')
+    p.add_argument('--log-format', choices=('text', 'json'), default='text',
+                   help='json writes one JSON object per log record, including structured fields')
     args = p.parse_args()
+    setup_logging(args.log_format)
 
-    app = web.Application()
-    app.router.add_get('/', index)
-    app.router.add_get('/ws', websocket_handler)
+    if args.workers > 1:
+        if not hasattr(socket, 'SO_REUSEPORT'):
+            p.error('--workers needs SO_REUSEPORT, which this platform does not support')
+        try:
+            asyncio.run(run_workers(args))
+        except KeyboardInterrupt:
+            pass
+        return
+
+    app = create_app(args.relay_port, args.send_queue_size, args.slow_consumer_policy, log_chat=args.log_chat,
+                     session_grace=args.session_grace)
     logging.info(f'Starting rendezvous server on port {args.port}')
     web.run_app(app, port=args.port)
 